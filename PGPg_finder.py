@@ -1,8 +1,16 @@
 #!/usr/bin/env python3
 
 import argparse
+import glob
+import json
 import os
+import shutil
+import signal
 import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 # Caminho do diretório onde este script está localizado
 dir_path = os.path.dirname(os.path.realpath(__file__))
@@ -14,12 +22,88 @@ workflows = {
     "meta_wf": "workflows/meta_wf.sh",
 }
 
-def call_workflow(workflow, args):
+# Tabela final produzida por cada workflow
+workflow_results = {
+    "genome_wf": "gene_counts.txt",
+    "metafast_wf": "gene_counts.txt",
+    "meta_wf": "diamond_merged.txt",
+}
+
+GENOME_EXTENSIONS = (".fasta", ".fna", ".fa")
+COMPRESSED_EXTENSIONS = (".gz", ".zst")
+# Per-sample reports merged in the output directory of -j, --append and --worker runs
+SAMPLE_REPORTS = ("adaptive_screen.tsv", "dedup_report.tsv")
+
+telemetry_script = os.path.join(dir_path, "vis-scripts/telemetry.py")
+autotune_script = os.path.join(dir_path, "vis-scripts/autotune.py")
+
+
+def discover_samples(workflow, input_dir):
+    """Return (sample, input_file) pairs in the same order the workflow scripts visit them."""
+    samples = []
+    if workflow == "genome_wf":
+        for root, _, files in os.walk(input_dir):
+            for name in sorted(files):
+                base = name
+                for extension in COMPRESSED_EXTENSIONS:
+                    if base.endswith(extension):
+                        base = base[:-len(extension)]
+                if base.endswith(GENOME_EXTENSIONS):
+                    samples.append((base.rsplit(".", 1)[0], os.path.join(root, name)))
+        # genome_wf sorts the paths found in all subdirectories
+        samples.sort(key=lambda sample: sample[1])
+    else:
+        for reads_1 in sorted(glob.glob(os.path.join(input_dir, "*_*1.*"))):
+            name = os.path.basename(reads_1)
+            if "_1." in name:
+                samples.append((name.rsplit("_1.", 1)[0], reads_1))
+            else:
+                # Skipped by the workflow scripts too
+                print(f"Warning: skipping {reads_1}: first read files must be named <sample>_1.<extension>")
+    return samples
+
+
+def build_command(workflow, args, output, threads):
     command = ["bash", os.path.join(dir_path, workflows[workflow]),
-               "-i", args.input, "-o", args.output, "-t", str(args.threads)]
+               "-i", args.input, "-o", output, "-t", str(threads)]
 
     if hasattr(args, "assembly") and args.assembly:
         command.extend(["-a", args.assembly])
+    if getattr(args, "genes", None):
+        command.extend(["--genes", args.genes])
+    if getattr(args, "batch", False):
+        command.append("--batch")
+    if getattr(args, "stream", False):
+        command.append("--stream")
+    if getattr(args, "pe_stream", False):
+        command.append("--pe-stream")
+    if getattr(args, "adaptive", False):
+        command.append("--adaptive")
+    if getattr(args, "adaptive_chunk", None):
+        command.extend(["--adaptive-chunk", str(args.adaptive_chunk)])
+    if getattr(args, "adaptive_threshold", None):
+        command.extend(["--adaptive-threshold", str(args.adaptive_threshold)])
+    if getattr(args, "dedup", False):
+        command.append("--dedup")
+    if getattr(args, "annotation_cache", None):
+        command.extend(["--annotation-cache", os.path.abspath(args.annotation_cache)])
+    if getattr(args, "annotation_cache_size", None):
+        command.extend(["--annotation-cache-size", str(args.annotation_cache_size)])
+    if getattr(args, "catalog", False):
+        command.append("--catalog")
+    if getattr(args, "catalog_id", None):
+        command.extend(["--catalog-id", str(args.catalog_id)])
+    if args.cache:
+        command.append("--cache")
+    if args.compress:
+        command.append("--compress")
+    if args.telemetry:
+        # Per-sample runs (-j, --append) all write to the telemetry file of the project
+        command.extend(["--telemetry", telemetry_path(args)])
+    if getattr(args, "abund_mode", None):
+        command.extend(["--abund-mode", args.abund_mode])
+    if getattr(args, "coverage", None):
+        command.extend(["--coverage", args.coverage])
     if args.dmode:
         command.extend(["--dmode", args.dmode])
     if args.piden:
@@ -32,8 +116,402 @@ def call_workflow(workflow, args):
         command.extend(["--extra", args.extra])
     if args.evalue:
         command.extend(["--evalue", str(args.evalue)])
+    return command
+
+
+def telemetry_path(args):
+    """Telemetry file of the run, or None when --telemetry is not set."""
+    if not getattr(args, "telemetry", False):
+        return None
+    return os.path.join(os.path.abspath(args.output), "telemetry.jsonl")
+
+
+def telemetry_command(telemetry, stage, command, threads=1, sample="all"):
+    """Wrap a command so that its resource usage is recorded as a stage, when telemetry is on."""
+    if not telemetry:
+        return command
+    return [sys.executable, telemetry_script, "run", "-f", telemetry, "--stage", stage,
+            "--sample", sample, "--threads", str(threads), "--"] + command
+
+
+def apply_autotune(workflow, args):
+    """
+    Plan threads, concurrent samples and DIAMOND -b/-c for this machine (--autotune)
+
+    The plan is saved to <output>/autotune_plan.json and applied to args;
+    -t, when given, caps the threads of the plan. With --dry-run the plan and
+    its predicted memory peak are only printed. Returns the exit code of the
+    planning, or None when the workflow should run.
+    """
+    inputs = [path for _, path in discover_samples(workflow, args.input)]
+    command = [sys.executable, autotune_script, "-w", workflow, "-i"] + inputs
+    if args.threads:
+        command.extend(["-t", str(args.threads)])
+    if getattr(args, "batch", False):
+        command.append("--batch")
+    if args.dry_run:
+        return subprocess.call(command + ["--dry-run"])
+    os.makedirs(args.output, exist_ok=True)
+    plan_file = os.path.join(args.output, "autotune_plan.json")
+    if subprocess.call(command + ["-o", plan_file]) != 0:
+        return 1
+    with open(plan_file) as fi:
+        plan = json.load(fi)
+    args.jobs = plan["jobs"]
+    args.threads = plan["total_threads"]
+    # DIAMOND memory options given with --extra take precedence
+    extra = (args.extra or "").split()
+    if not {"-b", "--block-size", "-c", "--index-chunks"} & set(extra):
+        args.extra = " ".join(extra + plan["diamond"]["options"].split())
+    return None
+
+
+def call_workflow(workflow, args):
+    telemetry = telemetry_path(args)
+    if telemetry:
+        os.makedirs(args.output, exist_ok=True)
+        # Every record of this run carries the same run name
+        os.environ["PGPG_RUN"] = time.strftime("%Y%m%d-%H%M%S")
+    returncode = run_workflow(workflow, args)
+    if telemetry and os.path.exists(telemetry):
+        summary = subprocess.run([sys.executable, telemetry_script, "summary", "-f", telemetry],
+                                 stdout=subprocess.PIPE, universal_newlines=True).stdout
+        with open(os.path.join(args.output, "telemetry_summary.txt"), "w") as fo:
+            fo.write(summary)
+        print(summary)
+    return returncode
+
+
+def run_workflow(workflow, args):
+    # The gene catalog pools all samples, so they run together in one workflow call
+    if getattr(args, "catalog", False):
+        if getattr(args, "append", False) or args.worker:
+            print("Error: --catalog cannot be combined with --append or --worker.")
+            return 1
+        return subprocess.call(build_command(workflow, args, args.output, args.threads))
+    if args.worker:
+        if getattr(args, "append", False):
+            print("Error: --worker cannot be combined with --append.")
+            return 1
+        return run_worker(workflow, args)
+    if getattr(args, "append", False):
+        return run_append(workflow, args)
+    # The batched mode already runs gene calling concurrently and DIAMOND once
+    if getattr(args, "jobs", 1) > 1 and not getattr(args, "batch", False):
+        return run_parallel(workflow, args)
+    return subprocess.call(build_command(workflow, args, args.output, args.threads))
+
+
+def run_sample(workflow, args, sample, threads, logs_dir):
+    """Run one sample of a workflow in its own output directory and return (exit code, seconds)."""
+    sample_dir = os.path.join(args.output, "samples", sample)
+    os.makedirs(sample_dir, exist_ok=True)
+    command = build_command(workflow, args, sample_dir, threads)
+    command.extend(["--sample", sample, "--no-heatmap"])
+
+    start = time.time()
+    with open(os.path.join(logs_dir, f"{sample}.log"), "w") as log:
+        returncode = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT)
+    return returncode, time.time() - start
+
+
+def merge_sample_results(workflow, output, samples):
+    """Concatenate per-sample result tables, in sample order, into a single table."""
+    result_name = workflow_results[workflow]
+    merged_path = os.path.join(output, result_name)
+    with open(merged_path, "w") as fo:
+        fo.write("Sample\tID\tCount\n")
+        for sample in samples:
+            sample_result = os.path.join(output, "samples", sample, result_name)
+            if not os.path.exists(sample_result):
+                continue
+            with open(sample_result) as fi:
+                next(fi, None)
+                for line in fi:
+                    fo.write(line)
+    return merged_path
+
+
+def merge_cache_manifests(output, samples):
+    """Collect the stage cache manifests of the per-sample runs in <output>/cache_manifest.tsv."""
+    manifests = [os.path.join(output, "samples", sample, "cache_manifest.tsv") for sample in samples]
+    manifests = [path for path in manifests if os.path.exists(path)]
+    if not manifests:
+        return
+    with open(os.path.join(output, "cache_manifest.tsv"), "w") as fo:
+        fo.write("Time\tSample\tStage\tStatus\tKey\n")
+        for path in manifests:
+            with open(path) as fi:
+                next(fi, None)
+                fo.writelines(fi)
+
+
+def merge_sample_reports(output, samples):
+    """Collect the per-sample reports (--adaptive reads used, --dedup ratios) in <output>, in sample order."""
+    for name in SAMPLE_REPORTS:
+        reports = [os.path.join(output, "samples", sample, name) for sample in samples]
+        reports = [path for path in reports if os.path.exists(path)]
+        if not reports:
+            continue
+        with open(os.path.join(output, name), "w") as fo:
+            for number, path in enumerate(reports):
+                with open(path) as fi:
+                    header = next(fi, "")
+                    if number == 0:
+                        fo.write(header)
+                    fo.writelines(fi)
+
+
+def run_heatmaps(table, output, threads=1, store=None, telemetry=None):
+    heatmap_script = os.path.join(dir_path, "vis-scripts/heatmap_plabase.py")
+    command = [sys.executable, heatmap_script, table, output,
+               os.path.join(dir_path, "database/pathways_plabase.txt"),
+               os.path.join(dir_path, "database/summary.txt"),
+               "-j", str(threads)]
+    if store:
+        command.extend(["--store", store])
+    return subprocess.call(telemetry_command(telemetry, "heatmap", command, threads))
+
+
+def build_index():
+    index_script = os.path.join(dir_path, "vis-scripts/plabase_index.py")
+    return subprocess.call([sys.executable, index_script,
+                            "-p", os.path.join(dir_path, "database/pathways_plabase.txt"),
+                            "-s", os.path.join(dir_path, "database/summary.txt")])
+
+
+def run_parallel(workflow, args):
+    """
+    Run up to args.jobs samples at once, splitting the -t budget between them.
+
+    Every sample is processed by the regular workflow script in
+    <output>/samples/<sample>, with its log in <output>/logs/<sample>.log.
+    The per-sample tables are then merged in sample order, so the final table
+    holds the same rows as a serial run, and the heatmaps are built once.
+    """
+    samples = discover_samples(workflow, args.input)
+    if not samples:
+        print(f"Error: No input samples found in {args.input}.")
+        return 1
+
+    failed = run_samples(workflow, args, samples)
+    merge_cache_manifests(args.output, [sample for sample, _ in samples])
+    merge_sample_reports(args.output, [sample for sample, _ in samples])
+    ordered = [sample for sample, _ in samples if sample not in failed]
+    merged = merge_sample_results(workflow, args.output, ordered)
+    print(f"Merged results of {len(ordered)} samples into {merged}")
+    if failed:
+        print(f"Error: {len(failed)} samples failed ({', '.join(failed)}). Check {os.path.join(args.output, 'logs')}.")
+        return 1
+    return run_heatmaps(merged, args.output, args.threads, telemetry=telemetry_path(args))
+
+
+def run_samples(workflow, args, samples):
+    """Run (sample, input) pairs up to args.jobs at a time, write logs/samples_status.tsv and return the failed samples."""
+    jobs = min(args.jobs, len(samples))
+    threads = max(1, args.threads // jobs)
+    logs_dir = os.path.join(args.output, "logs")
+    os.makedirs(logs_dir, exist_ok=True)
+    print(f"Running {len(samples)} samples, {jobs} at a time with {threads} threads each.")
+
+    # Largest inputs first, so long samples do not end up alone at the tail of the run
+    queue = sorted(samples, key=lambda item: os.path.getsize(item[1]), reverse=True)
+    status = {}
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {sample: pool.submit(run_sample, workflow, args, sample, threads, logs_dir)
+                   for sample, _ in queue}
+        for sample, future in futures.items():
+            try:
+                status[sample] = future.result()
+            except Exception as error:
+                # A sample that cannot be started fails alone; the others are still merged
+                print(f"Error: {sample} could not be run: {error}")
+                status[sample] = (1, 0.0)
+
+    failed = []
+    with open(os.path.join(logs_dir, "samples_status.tsv"), "w") as fo:
+        fo.write("Sample\tExit_code\tSeconds\n")
+        for sample, _ in samples:
+            returncode, seconds = status[sample]
+            fo.write(f"{sample}\t{returncode}\t{seconds:.1f}\n")
+            if returncode != 0:
+                failed.append(sample)
+    return failed
+
+
+def run_leased_sample(workflow, args, queue, lease, logs_dir):
+    """
+    Run the sample of a queue lease while renewing the lease, and return (exit code, seconds)
+
+    The sample runs in a private work directory that replaces <output>/samples/<sample>
+    on success. If the lease is lost (taken over after missed heartbeats), the run is stopped.
+    """
+    work_dir = queue.work_dir(lease)
+    command = build_command(workflow, args, work_dir, args.threads)
+    command.extend(["--sample", lease.sample, "--no-heatmap"])
+    lost = threading.Event()
+    done = threading.Event()
+
+    start = time.time()
+    with open(os.path.join(logs_dir, f"{lease.sample}.log"), "w") as log:
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+
+        def heartbeat():
+            while not done.wait(queue.lease / 3):
+                if not lease.heartbeat():
+                    lost.set()
+                    os.killpg(process.pid, signal.SIGTERM)
+                    return
+
+        threading.Thread(target=heartbeat, daemon=True).start()
+        returncode = process.wait()
+        done.set()
+    seconds = time.time() - start
+    if returncode == 0 and not lost.is_set():
+        sample_dir = os.path.join(args.output, "samples", lease.sample)
+        shutil.rmtree(sample_dir, ignore_errors=True)
+        os.makedirs(os.path.dirname(sample_dir), exist_ok=True)
+        os.rename(work_dir, sample_dir)
+    else:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return (None if lost.is_set() else returncode), seconds
+
+
+def reduce_queue(workflow, args, queue):
+    """Merge the results of the finished samples of a queue, as run_parallel does, and write logs/samples_status.tsv."""
+    samples = queue.samples()
+    results = {sample: queue.result(sample) for sample in samples}
+    with open(os.path.join(args.output, "logs", "samples_status.tsv"), "w") as fo:
+        fo.write("Sample\tExit_code\tSeconds\tWorker\n")
+        for sample in samples:
+            result = results[sample]
+            fo.write(f"{sample}\t{result['exit_code']}\t{result['seconds']:.1f}\t{result['worker']}\n")
+    done = [sample for sample in samples if results[sample]["state"] == "done"]
+    failed = [sample for sample in samples if results[sample]["state"] == "failed"]
+    # Every sample is finished: what is left in the work directory belongs to crashed workers
+    for name in os.listdir(os.path.join(queue.path, "work")):
+        shutil.rmtree(os.path.join(queue.path, "work", name), ignore_errors=True)
+    merge_cache_manifests(args.output, samples)
+    merge_sample_reports(args.output, samples)
+    merged = merge_sample_results(workflow, args.output, done)
+    print(f"Merged results of {len(done)} samples into {merged}")
+    if failed:
+        print(f"Error: {len(failed)} samples failed ({', '.join(failed)}). Check {os.path.join(args.output, 'logs')}.")
+    returncode = run_heatmaps(merged, args.output, args.threads, telemetry=telemetry_path(args))
+    return 1 if failed else returncode
+
+
+def run_worker(workflow, args):
+    """
+    Pull samples from the work queue of the output directory until it is drained (--worker)
+
+    Any number of workers, on any node sharing the output directory, can run
+    at once; each runs one sample at a time with -t threads. Samples of
+    workers that stopped renewing their lease are run again by the others.
+    The worker that finds every sample finished merges the results.
+    """
+    sys.path.insert(0, os.path.join(dir_path, "vis-scripts"))
+    from work_queue import WorkQueue, worker_name
+
+    queue = WorkQueue(os.path.join(args.output, "queue"), args.lease)
+    added = queue.add(discover_samples(workflow, args.input))
+    logs_dir = os.path.join(args.output, "logs")
+    os.makedirs(logs_dir, exist_ok=True)
+    worker = worker_name()
+    print(f"Worker {worker}: {added} samples added to the queue, {len(queue.samples())} in total.")
+
+    while True:
+        lease = queue.claim(worker)
+        if lease is None:
+            if queue.finished():
+                break
+            # Samples still run elsewhere: wait, in case their worker dies
+            time.sleep(min(queue.lease / 3, 30))
+            continue
+        print(f"Worker {worker}: running {lease.sample} (attempt {lease.attempt})")
+        returncode, seconds = run_leased_sample(workflow, args, queue, lease, logs_dir)
+        if returncode is None:
+            print(f"Worker {worker}: lost the lease of {lease.sample}")
+        elif returncode == 0:
+            queue.complete(lease, seconds)
+        elif queue.fail(lease, returncode, seconds):
+            print(f"Worker {worker}: {lease.sample} failed (exit code {returncode}), no attempts left")
+        else:
+            print(f"Worker {worker}: {lease.sample} failed (exit code {returncode}), returned to the queue")
+
+    lease = queue.claim_reduce(worker)
+    if lease is None:
+        print(f"Worker {worker}: queue drained.")
+        return 0
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(queue.lease / 3):
+            lease.heartbeat()
+
+    threading.Thread(target=heartbeat, daemon=True).start()
+    try:
+        returncode = reduce_queue(workflow, args, queue)
+    finally:
+        stop.set()
+    queue.complete_reduce(lease)
+    return returncode
+
+
+def registered_samples(store):
+    registry = os.path.join(store, "samples.tsv")
+    if not os.path.exists(registry):
+        return set()
+    with open(registry) as fi:
+        next(fi, None)
+        return {line.split("\t", 1)[0] for line in fi if line.strip()}
+
+
+def run_append(workflow, args):
+    """
+    Process only the samples that are not yet in the project store of the output directory.
+
+    The store (<output>/project) keeps a registry of the samples, a shard with
+    the rows of every sample and the aggregated count matrix. New samples are
+    run as in run_parallel, added to the store, and the result table, BIOM
+    tables and heatmaps are then rebuilt from the store.
+    """
+    store = os.path.join(args.output, "project")
+    store_script = os.path.join(dir_path, "vis-scripts/project_store.py")
+    telemetry = telemetry_path(args)
+    result_table = os.path.join(args.output, workflow_results[workflow])
+    registered = registered_samples(store)
+    if not registered and os.path.exists(result_table):
+        # Results of a run without --append become the first samples of the project
+        if subprocess.call(telemetry_command(telemetry, "project_store", [sys.executable, store_script, "add",
+                                                                          "-p", store, "-i", result_table])) != 0:
+            return 1
+        registered = registered_samples(store)
+
+    samples = discover_samples(workflow, args.input)
+    new = [(sample, path) for sample, path in samples if sample not in registered]
+    print(f"{len(new)} new samples, {len(registered)} already in the project.")
+    if not new:
+        return 0
+
+    failed = run_samples(workflow, args, new)
+    added = [sample for sample, _ in new if sample not in failed]
+    if added:
+        tables = [os.path.join(args.output, "samples", sample, workflow_results[workflow]) for sample in added]
+        add_command = [sys.executable, store_script, "add", "-p", store, "-s"] + added + ["-i"] + tables
+        if subprocess.call(telemetry_command(telemetry, "project_store", add_command)) != 0:
+            return 1
+        subprocess.call(telemetry_command(telemetry, "project_store",
+                                          [sys.executable, store_script, "export", "-p", store, "-o", result_table]))
+        merge_cache_manifests(args.output, [sample for sample, _ in samples])
+        merge_sample_reports(args.output, [sample for sample, _ in samples])
+        print(f"Added {len(added)} samples to {store}")
+    if failed:
+        print(f"Error: {len(failed)} samples failed ({', '.join(failed)}). Check {os.path.join(args.output, 'logs')}.")
+    if added and run_heatmaps(result_table, args.output, args.threads, store, telemetry) != 0:
+        return 1
+    return 1 if failed else 0
 
-    subprocess.call(command)
 
 def print_workflows():
     GREEN = "\033[32m"
@@ -53,6 +531,7 @@ PGPg_finder is a tool that offers different workflows for genome and metagenome
 
 {BLUE}Usage:{RESET}
   PGPg_finder -w (genome_wf or metafast_wf or meta_wf) -h for command-specific help
+  PGPg_finder --build-index    compile the PLaBAse annotation index (done automatically on first use)
 
 PGPg_finder v1.1.0 | by Thierry Pellegrinetty <thierry.pellegrinetti@hotmail.com>
 Check https://github.com/tpellegrinetti/PGPg_finder for updates
@@ -75,17 +554,38 @@ def print_workflow_help(workflow):
 Performs genome annotation with DIAMOND against the PGPT-db database of PLaBAse.
 
 {GREEN} Required arguments: {RESET}
-  -i <input_dir>         Directory with assemblies (.fasta, .fa, .fna)
+  -i <input_dir>         Directory with assemblies (.fasta, .fa, .fna, optionally .gz or .zst)
   -o <output_dir>        Output directory
 
 {BLUE} Optional arguments: {RESET}
   -t <threads>           Number of threads (default: 1)
+  -j <jobs>              Samples processed at the same time, sharing the -t threads (default: 1)
+  -g <genes_dir>         Use predicted proteins (<sample>.faa) instead of running Prodigal
   --dmode                DIAMOND mode (fast, sensitive, very-sensitive)
   --piden                Minimum identity (%) (default: 30)
   --qcov                 Minimum query coverage (%) (default: 30)
   --bitscore             Minimum bit score
   --evalue               Max e-value (default: 1e-5)
   --extra                Extra DIAMOND options
+  --cache                Reuse outputs of unchanged stages from a previous run in the same output directory
+  --append               Only process samples not yet in the project of the output directory, then update its tables
+  --telemetry            Record wall/CPU time, memory and I/O of every stage in <output_dir>/telemetry.jsonl
+  --compress             Write intermediate files gzip-compressed (multi-threaded with pigz when installed)
+  --autotune             Choose threads, samples run at once (-j) and DIAMOND -b/-c from the cores, memory,
+                         database and input sizes (plan in <output_dir>/autotune_plan.json; -t caps the threads)
+  --dry-run              With --autotune, only print the plan and its predicted memory peak
+  --worker               Pull samples from a queue in the output directory; start workers on any nodes
+                         sharing it, the last one merges the results
+  --lease                Seconds without heartbeat after which a worker's sample is run again (default: 300)
+  --batch                Search all genomes with a single DIAMOND run (faster for many genomes)
+  --stream               Count hits from the DIAMOND output stream, without writing _diamond.txt files
+  --dedup                Search identical proteins once and count their hits for every copy
+                         (dedup ratio and DIAMOND time saved in dedup_report.tsv)
+  --annotation-cache     Persistent cache of protein annotations (SQLite file) shared by all runs; proteins
+                         already annotated with the same database and settings are not aligned again
+  --annotation-cache-size
+                         Size limit of the annotation cache in MB, least recently used entries are evicted
+                         (default: 1024)
 
 {GREEN}Usage:{RESET}
   PGPg_finder -w genome_wf -i input_dir -o output_dir -t 12
@@ -102,12 +602,32 @@ Annotates short-read metagenomes directly using DIAMOND and PGPT-db.
 
 {BLUE} Optional arguments: {RESET}
   -t <threads>           Number of threads (default: 1)
+  -j <jobs>              Samples processed at the same time, sharing the -t threads (default: 1)
   --dmode                DIAMOND mode (fast, sensitive, very-sensitive)
   --piden                Minimum identity (%)
   --qcov                 Minimum query coverage (%)
   --bitscore             Minimum bit score
   --evalue               Max e-value
   --extra                Extra DIAMOND options
+  --cache                Reuse outputs of unchanged stages from a previous run in the same output directory
+  --append               Only process samples not yet in the project of the output directory, then update its tables
+  --telemetry            Record wall/CPU time, memory and I/O of every stage in <output_dir>/telemetry.jsonl
+  --compress             Write intermediate files gzip-compressed (multi-threaded with pigz when installed)
+  --autotune             Choose threads, samples run at once (-j) and DIAMOND -b/-c from the cores, memory,
+                         database and input sizes (plan in <output_dir>/autotune_plan.json; -t caps the threads)
+  --dry-run              With --autotune, only print the plan and its predicted memory peak
+  --worker               Pull samples from a queue in the output directory; start workers on any nodes
+                         sharing it, the last one merges the results
+  --lease                Seconds without heartbeat after which a worker's sample is run again (default: 300)
+  --stream               Count hits from the DIAMOND output stream, without writing _diamond.txt files
+  --pe-stream            Stream both mates and singletons into DIAMOND (no trimmed FASTQ files);
+                         each read pair is counted once
+  --adaptive             Search growing random chunks of reads and stop once the Lv3 profile converges
+                         (faster screening; reads used per sample in adaptive_screen.tsv)
+  --adaptive-chunk       Reads of the first chunk (default: 100000)
+  --adaptive-threshold   Bray-Curtis dissimilarity of successive profiles to stop at (default: 0.02)
+  --dedup                Search identical reads once and count their hits for every copy
+                         (dedup ratio and DIAMOND time saved in dedup_report.tsv)
 
 {GREEN}Usage:{RESET}
   PGPg_finder -w metafast_wf -i input_dir -o output_dir -t 12
@@ -124,13 +644,33 @@ Annotates assembled contigs using DIAMOND and PGPT-db.
 
 {BLUE} Optional arguments: {RESET}
   -t <threads>           Number of threads (default: 1)
+  -j <jobs>              Samples processed at the same time, sharing the -t threads (default: 1)
   -a <assembly>          Use pre-assembled contigs (FASTA)
+  -g <genes_dir>         Use predicted genes (<sample>.faa and <sample>.ffn); skips assembly and Prodigal
+  --abund-mode           Gene abundance normalisation: cpm (default), tpm or rpkm
+  --coverage             Coverage engine: stream (bowtie2 output read directly, no SAM/pileup files)
+                         or pileup (BBMap). Default: pileup if pileup.sh is installed, else stream.
+                         kmer matches reads by k-mers to the DIAMOND-annotated genes only, without
+                         Bowtie2 (approximate abundances, much faster)
+  --catalog              Dereplicate the genes of all samples into one catalog, annotate it once and
+                         map every sample to it (catalog/catalog_abundance.tsv, gene x sample)
+  --catalog-id           Minimum identity to a catalog representative (default: 0.95, needs cd-hit-est)
   --dmode                DIAMOND mode (fast, sensitive, very-sensitive)
   --piden                Minimum identity (%)
   --qcov                 Minimum query coverage (%)
   --bitscore             Minimum bit score
   --evalue               Max e-value
   --extra                Extra DIAMOND options
+  --cache                Reuse outputs of unchanged stages from a previous run in the same output directory
+  --append               Only process samples not yet in the project of the output directory, then update its tables
+  --telemetry            Record wall/CPU time, memory and I/O of every stage in <output_dir>/telemetry.jsonl
+  --compress             Write intermediate files gzip-compressed (multi-threaded with pigz when installed)
+  --autotune             Choose threads, samples run at once (-j) and DIAMOND -b/-c from the cores, memory,
+                         database and input sizes (plan in <output_dir>/autotune_plan.json; -t caps the threads)
+  --dry-run              With --autotune, only print the plan and its predicted memory peak
+  --worker               Pull samples from a queue in the output directory; start workers on any nodes
+                         sharing it, the last one merges the results
+  --lease                Seconds without heartbeat after which a worker's sample is run again (default: 300)
 
 {GREEN}Usage:{RESET}
   PGPg_finder -w meta_wf -i input_dir -o output_dir -t 12
@@ -150,6 +690,7 @@ def main():
 
     parser.add_argument('-w', '--workflow', choices=workflows.keys())
     parser.add_argument('--list-workflows', action='store_true')
+    parser.add_argument('--build-index', action='store_true')
     parser.add_argument('-h', '--help', action='store_true')
 
     args, remaining_args = parser.parse_known_args()
@@ -165,25 +706,65 @@ def main():
         print_workflows()
         return
 
+    if args.build_index:
+        sys.exit(build_index())
+
     if args.workflow:
         print_workflow_help(args.workflow)
 
         subparser = argparse.ArgumentParser()
         subparser.add_argument('-i', '--input', required=True)
         subparser.add_argument('-o', '--output', required=True)
-        subparser.add_argument('-t', '--threads', type=int, default=1)
+        subparser.add_argument('-t', '--threads', type=int)
+        subparser.add_argument('-j', '--jobs', type=int, default=1)
         subparser.add_argument('--dmode')
         subparser.add_argument('--piden', type=float)
         subparser.add_argument('--qcov', type=float)
         subparser.add_argument('--bitscore', type=float)
         subparser.add_argument('--evalue')
         subparser.add_argument('--extra')
+        subparser.add_argument('--cache', action='store_true')
+        subparser.add_argument('--append', action='store_true')
+        subparser.add_argument('--telemetry', action='store_true')
+        subparser.add_argument('--compress', action='store_true')
+        subparser.add_argument('--autotune', action='store_true')
+        subparser.add_argument('--worker', action='store_true')
+        subparser.add_argument('--lease', type=float, default=300.0)
+        subparser.add_argument('--dry-run', action='store_true')
 
         if args.workflow == "meta_wf":
             subparser.add_argument('-a', '--assembly')
+            subparser.add_argument('--abund-mode', choices=['cpm', 'tpm', 'rpkm'])
+            subparser.add_argument('--coverage', choices=['stream', 'pileup', 'kmer'])
+            subparser.add_argument('--catalog', action='store_true')
+            subparser.add_argument('--catalog-id', type=float)
+        if args.workflow == "genome_wf":
+            subparser.add_argument('--batch', action='store_true')
+            subparser.add_argument('--annotation-cache')
+            subparser.add_argument('--annotation-cache-size', type=float)
+        if args.workflow in ("genome_wf", "meta_wf"):
+            subparser.add_argument('-g', '--genes')
+        if args.workflow in ("genome_wf", "metafast_wf"):
+            subparser.add_argument('--stream', action='store_true')
+            subparser.add_argument('--dedup', action='store_true')
+        if args.workflow == "metafast_wf":
+            subparser.add_argument('--pe-stream', action='store_true')
+            subparser.add_argument('--adaptive', action='store_true')
+            subparser.add_argument('--adaptive-chunk', type=int)
+            subparser.add_argument('--adaptive-threshold', type=float)
 
         parsed_args = subparser.parse_args(remaining_args)
-        call_workflow(args.workflow, parsed_args)
+        if parsed_args.jobs < 1:
+            subparser.error('-j/--jobs must be at least 1')
+        if parsed_args.dry_run and not parsed_args.autotune:
+            subparser.error('--dry-run requires --autotune')
+        if parsed_args.autotune:
+            returncode = apply_autotune(args.workflow, parsed_args)
+            if returncode is not None:
+                sys.exit(returncode)
+        if parsed_args.threads is None:
+            parsed_args.threads = 1
+        sys.exit(call_workflow(args.workflow, parsed_args))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,83 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'vis-scripts'))
+from gene_relative_abundance import gene_relative_abun
+from synthetic import write_pileup
+
+
+def legacy_gene_relative_abun(pileup_file, basename, output_dir):
+    """Implementation of gene_relative_abundance.py before the single-pass rewrite (reference only)."""
+    total_ave_fold = float(0)
+    file_out = os.path.join(output_dir, basename + '.abundance')
+    with open(file_out, 'a') as fo:
+        fo.write("#ID\tgene_abundance\n")
+    with open(pileup_file) as fi:
+        for line in fi:
+            if line.startswith('#ID'):
+                continue
+            else:
+                ave_fold = line.split('\t')[1]
+                total_ave_fold += float(ave_fold)
+    with open(pileup_file) as fi:
+        for line in fi:
+            if line.startswith('#ID'):
+                continue
+            else:
+                gene_id = line.split('\t')[0]
+                ave_fold = line.split('\t')[1]
+                gene_abund = (float(ave_fold) / float(total_ave_fold)) * float(1000000)
+                with open(file_out, 'a') as fo:
+                    fo.write(gene_id + "\t" + str(gene_abund) + "\n")
+
+
+def read_abundance(path):
+    with open(path) as fi:
+        next(fi)
+        return [line.rstrip('\n').split('\t') for line in fi]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark gene_relative_abundance.py against the previous implementation.')
+    parser.add_argument('-g', '--genes', type=int, default=500000, help='Number of genes in the synthetic pileup')
+    parser.add_argument('--skip-legacy', action='store_true', help='Only time the current implementation')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pileup = os.path.join(tmp, 'sample.pileup')
+        write_pileup(pileup, args.genes)
+        print(f"Synthetic pileup: {args.genes} genes, {os.path.getsize(pileup) / 1e6:.1f} MB")
+
+        results = {}
+        for mode in ('cpm', 'tpm', 'rpkm'):
+            out_dir = os.path.join(tmp, mode)
+            os.makedirs(out_dir)
+            start = time.perf_counter()
+            gene_relative_abun(pileup, 'sample', out_dir, mode)
+            results[mode] = time.perf_counter() - start
+            print(f"current ({mode}):\t{results[mode]:.2f} s\t{args.genes / results[mode]:,.0f} genes/s")
+
+        if not args.skip_legacy:
+            legacy_dir = os.path.join(tmp, 'legacy')
+            os.makedirs(legacy_dir)
+            start = time.perf_counter()
+            legacy_gene_relative_abun(pileup, 'sample', legacy_dir)
+            legacy = time.perf_counter() - start
+            print(f"legacy (cpm):\t{legacy:.2f} s\t{args.genes / legacy:,.0f} genes/s")
+            print(f"speed-up (cpm):\t{legacy / results['cpm']:.1f}x")
+
+            current = read_abundance(os.path.join(tmp, 'cpm', 'sample.abundance'))
+            previous = read_abundance(os.path.join(legacy_dir, 'sample.abundance'))
+            same = len(current) == len(previous) and all(
+                a[0] == b[0] and abs(float(a[1]) - float(b[1])) <= 1e-9 * max(1.0, abs(float(b[1])))
+                for a, b in zip(current, previous))
+            print(f"outputs match:\t{same}")
+            if not same:
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
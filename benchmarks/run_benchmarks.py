@@ -0,0 +1,282 @@
+import os
+import sys
+import json
+import glob
+import shutil
+import platform
+import argparse
+import subprocess
+import tempfile
+import time
+
+from synthetic import (REPO_DIR, plabase_ids, write_diamond, write_pileup, write_gene_counts, write_genomes,
+                       write_reads)
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+STUBS_DIR = os.path.join(BENCH_DIR, 'stubs')
+VIS_SCRIPTS = os.path.join(REPO_DIR, 'vis-scripts')
+BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+
+# samples/hits: size of the synthetic tables; workflow_samples/reads: genomes or
+# read pairs (reads per mate) run through the workflows with the stub tools
+SCALES = {
+    'tiny': {'samples': 10, 'hits': 10 ** 3, 'workflow_samples': 2, 'reads': 500},
+    'small': {'samples': 10, 'hits': 10 ** 5, 'workflow_samples': 4, 'reads': 2000},
+    'medium': {'samples': 100, 'hits': 10 ** 6, 'workflow_samples': 10, 'reads': 10000},
+    'large': {'samples': 1000, 'hits': 10 ** 7, 'workflow_samples': 20, 'reads': 50000},
+    'huge': {'samples': 5000, 'hits': 10 ** 8, 'workflow_samples': 50, 'reads': 100000},
+}
+STAGES = ['count_hits', 'gene_relative_abundance', 'merge_blastp', 'merge_abund_blastp', 'heatmap_tables',
+          'heatmap_plabase', 'genome_wf', 'metafast_wf', 'meta_wf']
+# The line-by-line merge_blastp.py path is too slow to time beyond this size
+LEGACY_MAX_HITS = 10 ** 6
+# Differences below these are treated as noise when comparing with the baseline
+MIN_WALL_DELTA = 0.5
+MIN_RSS_DELTA = 20
+
+
+def measure(command, log_path, env=None):
+    """
+    Run a command and measure it
+
+    :return: (wall time in seconds, peak RSS in MB of the command and its children)
+    """
+    with open(log_path, 'w') as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, env=env)
+        _, status, usage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - start
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    if process.returncode != 0:
+        raise RuntimeError(f"{' '.join(command)} failed ({process.returncode}), see {log_path}")
+    # ru_maxrss is in KB on Linux
+    return wall, usage.ru_maxrss / 1024
+
+
+class Workspace:
+    """
+    Synthetic inputs of one scale and a copy of the pipeline that runs with the stub tools
+
+    The copy holds PGPg_finder.py, the workflows, vis-scripts, pgpg_finder and the PLaBAse
+    tables, with empty DIAMOND databases, so the workflows pass their checks
+    without the real database; the stubs are put first on PATH.
+    """
+
+    def __init__(self, path, scale):
+        self.path = path
+        self.scale = scale
+        self.data = os.path.join(path, 'data')
+        self.runs = os.path.join(path, 'runs')
+        self.pipeline = os.path.join(path, 'pipeline')
+        self.database = os.path.join(self.pipeline, 'database')
+        self.env = dict(os.environ, PATH=STUBS_DIR + os.pathsep + os.environ.get('PATH', ''))
+        self._inputs = {}
+
+    def setup(self):
+        for directory in (self.data, self.runs, self.database):
+            os.makedirs(directory, exist_ok=True)
+        shutil.copy(os.path.join(REPO_DIR, 'PGPg_finder.py'), self.pipeline)
+        for directory in ('workflows', 'vis-scripts', 'pgpg_finder'):
+            shutil.copytree(os.path.join(REPO_DIR, directory), os.path.join(self.pipeline, directory),
+                            ignore=shutil.ignore_patterns('__pycache__'))
+        for table in glob.glob(os.path.join(REPO_DIR, 'database', '*.txt')):
+            shutil.copy(table, self.database)
+        for db in ('genome.dmnd', 'metagenome.dmnd'):
+            open(os.path.join(self.database, db), 'w').close()
+        # Compiled once here so the heatmap stages do not include it
+        subprocess.run([sys.executable, os.path.join(VIS_SCRIPTS, 'plabase_index.py'), '-p', self.pathways,
+                        '-s', self.summary], check=True, stdout=subprocess.DEVNULL)
+
+    @property
+    def pathways(self):
+        return os.path.join(self.database, 'pathways_plabase.txt')
+
+    @property
+    def summary(self):
+        return os.path.join(self.database, 'summary.txt')
+
+    def input(self, kind):
+        """Path of a synthetic input, generated on first use."""
+        if kind not in self._inputs:
+            hits, samples = self.scale['hits'], self.scale['samples']
+            if kind == 'diamond':
+                path = os.path.join(self.data, 'bench_diamond.txt')
+                write_diamond(path, hits, plabase_ids(self.pathways))
+            elif kind == 'pileup':
+                path = os.path.join(self.data, 'bench.pileup')
+                write_pileup(path, hits)
+            elif kind == 'gene_counts':
+                path = os.path.join(self.data, 'gene_counts.txt')
+                write_gene_counts(path, samples, hits, plabase_ids(self.pathways))
+            elif kind == 'genomes':
+                path = os.path.join(self.data, 'genomes')
+                write_genomes(path, self.scale['workflow_samples'])
+            else:
+                path = os.path.join(self.data, 'reads')
+                write_reads(path, self.scale['workflow_samples'], self.scale['reads'])
+            self._inputs[kind] = path
+        return self._inputs[kind]
+
+    def run_dir(self, stage):
+        path = os.path.join(self.runs, stage)
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+        return path
+
+    def run(self, stage, command):
+        return measure(command, os.path.join(self.runs, stage + '.log'), self.env)
+
+
+def script(name):
+    return [sys.executable, os.path.join(VIS_SCRIPTS, name)]
+
+
+def run_stage(stage, ws, threads):
+    """
+    Run one stage on the workspace inputs
+
+    :return: (wall time, peak RSS in MB, items processed, unit of the items), or None when skipped
+    """
+    hits, samples = ws.scale['hits'], ws.scale['samples']
+    if stage == 'count_hits':
+        out = ws.run_dir(stage)
+        wall, rss = ws.run(stage, script('count_hits.py') + ['-i', ws.input('diamond'), '-s', 'bench',
+                                                             '-o', os.path.join(out, 'gene_counts.txt')])
+        return wall, rss, hits, 'hits'
+    if stage == 'gene_relative_abundance':
+        out = ws.run_dir(stage)
+        wall, rss = ws.run(stage, script('gene_relative_abundance.py') + ['-p', ws.input('pileup'), '-b', 'bench',
+                                                                          '-o', out])
+        return wall, rss, hits, 'genes'
+    if stage in ('merge_blastp', 'merge_abund_blastp'):
+        abundance = os.path.join(ws.runs, 'abundance', 'bench.abundance')
+        if not os.path.exists(abundance):
+            out = ws.run_dir('abundance')
+            subprocess.run(script('gene_relative_abundance.py') + ['-p', ws.input('pileup'), '-b', 'bench', '-o', out],
+                           check=True, stdout=subprocess.DEVNULL)
+        out = ws.run_dir(stage)
+        table = os.path.join(out, 'gene_counts.txt')
+        if stage == 'merge_abund_blastp':
+            wall, rss = ws.run(stage, script('merge_abund_blastp.py') + ['-a', abundance, '-d', ws.input('diamond'),
+                                                                         '-o', table])
+            return wall, rss, hits, 'hits'
+        if hits > LEGACY_MAX_HITS:
+            return None
+        # Legacy two-step path: merge_blastp.py, then the merge on its table
+        merged = os.path.join(out, 'bench_diamond_table.txt')
+        wall, rss = ws.run(stage, script('merge_blastp.py') + ['-b', ws.input('diamond'), '-o', merged])
+        merge_wall, merge_rss = ws.run(stage + '_merge', script('merge_abund_blastp.py') + ['-a', abundance,
+                                                                                            '-b', merged, '-o', table])
+        return wall + merge_wall, max(rss, merge_rss), hits, 'hits'
+    if stage in ('heatmap_tables', 'heatmap_plabase'):
+        out = ws.run_dir(stage)
+        command = script('heatmap_plabase.py') + [ws.input('gene_counts'), out, ws.pathways, ws.summary,
+                                                  '-j', str(threads)]
+        if stage == 'heatmap_tables':
+            command.append('--no-figures')
+        wall, rss = ws.run(stage, command)
+        return wall, rss, samples, 'samples'
+
+    # Whole workflows, through PGPg_finder.py and the stub tools
+    out = os.path.join(ws.run_dir(stage), 'results')
+    inputs = ws.input('genomes' if stage == 'genome_wf' else 'reads')
+    command = [sys.executable, os.path.join(ws.pipeline, 'PGPg_finder.py'), '-w', stage, '-i', inputs, '-o', out,
+               '-t', str(threads)]
+    if stage == 'meta_wf':
+        command += ['--coverage', 'stream']
+    wall, rss = ws.run(stage, command)
+    return wall, rss, ws.scale['workflow_samples'], 'samples'
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare stage measurements with a baseline of the same scale
+
+    :return: list of (stage, metric, baseline value, current value) over the tolerance
+    """
+    regressions = []
+    for stage, current in results['stages'].items():
+        reference = baseline.get('stages', {}).get(stage)
+        if reference is None:
+            continue
+        for metric, min_delta in (('wall', MIN_WALL_DELTA), ('rss_mb', MIN_RSS_DELTA)):
+            limit = reference[metric] * (1 + tolerance)
+            if current[metric] > limit and current[metric] - reference[metric] > min_delta:
+                regressions.append((stage, metric, reference[metric], current[metric]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the PGPg_finder stages on synthetic data, offline.')
+    parser.add_argument('-s', '--scale', choices=SCALES.keys(), default='small', help='Size of the synthetic data')
+    parser.add_argument('--samples', type=int, help='Override the number of samples of the scale')
+    parser.add_argument('--hits', type=int, help='Override the number of hits of the scale')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES, help='Stages to run (default: all)')
+    parser.add_argument('-t', '--threads', type=int, default=1, help='Threads given to the workflows and heatmaps')
+    parser.add_argument('-o', '--output', help='Write the measurements to this JSON file')
+    parser.add_argument('--baseline', default=BASELINE, help='Baseline JSON to compare with (default: %(default)s)')
+    parser.add_argument('--save-baseline', action='store_true', help='Store the measurements in the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Relative increase of wall time or peak RSS flagged as regression (default: 0.2)')
+    parser.add_argument('--keep', help='Keep the synthetic data and outputs in this directory')
+    args = parser.parse_args()
+
+    scale = dict(SCALES[args.scale])
+    if args.samples:
+        scale['samples'] = args.samples
+    if args.hits:
+        scale['hits'] = args.hits
+    # Baselines are only comparable at the same size
+    scale_key = args.scale if not (args.samples or args.hits) else f"{args.scale}-{scale['samples']}x{scale['hits']}"
+
+    results = {'scale': scale_key, **scale, 'threads': args.threads, 'python': platform.python_version(),
+               'machine': platform.machine(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'stages': {}}
+    print(f"Scale {scale_key}: {scale['samples']} samples, {scale['hits']:,} hits, "
+          f"{scale['workflow_samples']} workflow samples")
+
+    work_dir = args.keep or tempfile.mkdtemp(prefix='pgpg_bench_')
+    try:
+        ws = Workspace(work_dir, scale)
+        ws.setup()
+        print(f"{'stage':<25}{'wall (s)':>10}{'RSS (MB)':>10}{'throughput':>22}")
+        for stage in STAGES:
+            if stage not in args.stages:
+                continue
+            measured = run_stage(stage, ws, args.threads)
+            if measured is None:
+                print(f"{stage:<25}{'skipped':>10}")
+                continue
+            wall, rss, items, unit = measured
+            throughput = items / wall if wall else 0.0
+            results['stages'][stage] = {'wall': round(wall, 3), 'rss_mb': round(rss, 1), 'items': items,
+                                        'unit': unit, 'throughput': round(throughput, 1)}
+            print(f"{stage:<25}{wall:>10.2f}{rss:>10.1f}{throughput:>14,.1f} {unit}/s")
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as fo:
+            json.dump(results, fo, indent=2)
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as fi:
+            baselines = json.load(fi)
+    regressions = []
+    if scale_key in baselines:
+        regressions = compare(results, baselines[scale_key], args.tolerance)
+        for stage, metric, reference, current in regressions:
+            print(f"REGRESSION {stage} {metric}: {reference} -> {current} (+{(current / reference - 1) * 100:.0f}%)")
+        if not regressions:
+            print(f"No regression against {args.baseline} (tolerance {args.tolerance:.0%})")
+    if args.save_baseline:
+        baselines[scale_key] = results
+        with open(args.baseline, 'w') as fo:
+            json.dump(baselines, fo, indent=2)
+        print(f"Baseline {scale_key} saved to {args.baseline}")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+import os
+import argparse
+
+import numpy as np
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+PATHWAYS = os.path.join(REPO_DIR, 'database', 'pathways_plabase.txt')
+PILEUP_HEADER = ("#ID\tAvg_fold\tLength\tRef_GC\tCovered_percent\tCovered_bases\t"
+                 "Plus_reads\tMinus_reads\tRead_GC\tMedian_fold\tStd_Dev\n")
+# Number of lines generated at a time
+CHUNK = 200000
+
+
+def plabase_ids(pathways=PATHWAYS):
+    """Real PGPT IDs of the PLaBAse pathways table."""
+    with open(pathways) as fi:
+        column = next(fi).rstrip('\n').split('\t').index('ID')
+        return np.array([line.split('\t')[column] for line in fi if line.strip()])
+
+
+def id_weights(n, seed=1):
+    """Skewed (Zipf-like) hit probabilities of n IDs, as seen in real samples."""
+    rng = np.random.default_rng(seed)
+    weights = 1.0 / np.arange(1, n + 1) ** 0.8
+    return rng.permutation(weights / weights.sum())
+
+
+def gene_name(i):
+    return f"k141_{i // 3}_{i % 3 + 1}"
+
+
+def write_diamond(path, genes, ids, fraction=1.0, seed=1):
+    """
+    Write DIAMOND tabular hits (outfmt 6) against real PGPT IDs
+
+    :param path: output file
+    :param genes: number of query genes (k141_<contig>_<gene>, as Prodigal names them)
+    :param ids: PGPT IDs hit by the genes
+    :param fraction: fraction of the genes with a hit
+    :param seed: random seed
+    :return: number of hits written
+    """
+    rng = np.random.default_rng(seed)
+    weights = id_weights(len(ids), seed)
+    written = 0
+    with open(path, 'w', buffering=1 << 20) as fo:
+        for start in range(0, genes, CHUNK):
+            queries = np.arange(start, min(start + CHUNK, genes))
+            if fraction < 1.0:
+                queries = queries[rng.random(len(queries)) < fraction]
+            n = len(queries)
+            subjects = ids[rng.choice(len(ids), n, p=weights)]
+            suffixes = rng.integers(1, 1000000, n)
+            identity = rng.uniform(30, 100, n)
+            bitscore = rng.uniform(40, 900, n)
+            fo.writelines(f"{gene_name(q)}\t{s}_{x}\t{p:.1f}\t100\t0\t0\t1\t100\t1\t100\t1e-20\t{b:.1f}\n"
+                          for q, s, x, p, b in zip(queries.tolist(), subjects.tolist(), suffixes.tolist(),
+                                                   identity.tolist(), bitscore.tolist()))
+            written += n
+    return written
+
+
+def write_pileup(path, genes, seed=1):
+    """Write a BBMap pileup file with the given number of genes (k141_<contig>_<gene>)."""
+    rng = np.random.default_rng(seed)
+    with open(path, 'w', buffering=1 << 20) as fo:
+        fo.write(PILEUP_HEADER)
+        for start in range(0, genes, CHUNK):
+            n = min(CHUNK, genes - start)
+            length = rng.integers(150, 3000, n)
+            plus, minus = rng.integers(0, 500, n), rng.integers(0, 500, n)
+            fold = (plus + minus) * 150 / length
+            fo.writelines(f"{gene_name(i)}\t{f:.4f}\t{n_bases}\t0.5000\t90.0000\t{n_bases}\t{p}\t{m}\t0.5000\t{int(f)}\t1.00\n"
+                          for i, f, n_bases, p, m in zip(range(start, start + n), fold.tolist(), length.tolist(),
+                                                         plus.tolist(), minus.tolist()))
+
+
+def write_gene_counts(path, samples, hits, ids, seed=1):
+    """
+    Write a gene counts table (Sample, ID, Count) with the hits spread over the samples
+
+    :return: number of rows written
+    """
+    rng = np.random.default_rng(seed)
+    weights = id_weights(len(ids), seed)
+    per_sample = max(1, hits // samples)
+    rows = 0
+    with open(path, 'w', buffering=1 << 20) as fo:
+        fo.write("Sample\tID\tCount\n")
+        for s in range(samples):
+            counts = rng.multinomial(per_sample, weights)
+            present = np.flatnonzero(counts)
+            sample = f"S{s + 1:04d}"
+            fo.writelines(f"{sample}\t{subject}_1\t{count}\n"
+                          for subject, count in zip(ids[present].tolist(), counts[present].tolist()))
+            rows += len(present)
+    return rows
+
+
+def _sequence(rng, length):
+    return ''.join(rng.choice(list('ACGT'), length))
+
+
+def write_genomes(directory, samples, contigs=20, length=5000, seed=1):
+    """Write one random genome (<sample>.fna) per sample."""
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    for s in range(samples):
+        with open(os.path.join(directory, f"S{s + 1:04d}.fna"), 'w') as fo:
+            for c in range(contigs):
+                fo.write(f">contig_{c + 1}\n{_sequence(rng, length)}\n")
+
+
+def write_reads(directory, samples, reads, length=150, seed=1):
+    """Write paired FASTQ files (<sample>_1.fastq, <sample>_2.fastq) per sample."""
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    quality = 'I' * length
+    for s in range(samples):
+        sample = f"S{s + 1:04d}"
+        for mate in (1, 2):
+            letters = rng.choice(np.array(list('ACGT')), (reads, length))
+            with open(os.path.join(directory, f"{sample}_{mate}.fastq"), 'w', buffering=1 << 20) as fo:
+                fo.writelines(f"@{sample}.{r + 1}/{mate}\n{''.join(row)}\n+\n{quality}\n"
+                              for r, row in enumerate(letters.tolist()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic PGPg_finder inputs with real PLaBAse IDs.')
+    parser.add_argument('kind', choices=['diamond', 'pileup', 'gene-counts', 'genomes', 'reads'],
+                        help='diamond: DIAMOND tabular hits; pileup: BBMap pileup; gene-counts: Sample/ID/Count table; '
+                             'genomes: one FASTA per sample; reads: paired FASTQ per sample')
+    parser.add_argument('-o', '--output', required=True, help='Output file (directory for genomes and reads)')
+    parser.add_argument('-n', '--hits', type=int, default=100000,
+                        help='Number of hits (genes for pileup, reads per sample for reads)')
+    parser.add_argument('-s', '--samples', type=int, default=10, help='Number of samples')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed')
+    args = parser.parse_args()
+
+    if args.kind == 'diamond':
+        write_diamond(args.output, args.hits, plabase_ids(), seed=args.seed)
+    elif args.kind == 'pileup':
+        write_pileup(args.output, args.hits, args.seed)
+    elif args.kind == 'gene-counts':
+        write_gene_counts(args.output, args.samples, args.hits, plabase_ids(), args.seed)
+    elif args.kind == 'genomes':
+        write_genomes(args.output, args.samples, seed=args.seed)
+    else:
+        write_reads(args.output, args.samples, args.hits, seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
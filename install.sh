@@ -17,7 +17,7 @@ echo ""
 # Install necessary programs
 echo "Now, let's install the dependencies..."
 conda install -c bioconda prodigal diamond megahit bowtie2 samtools gawk pear trimmomatic -y
-conda install pandas seaborn matplotlib
+conda install pandas scipy seaborn matplotlib h5py
 echo "Dependencies installed successfully!"
 echo ""
 
@@ -64,6 +64,9 @@ echo "Making diamond db for genome and metagenome"
 diamond makedb --in PGPT_BASE_nr_Aug2021n_ul_1.fasta --db genome
 diamond makedb --in mgPGPT-db_Feb2022_ul_dwnld.fasta --db metagenome
 
+echo "Compiling the PLaBAse annotation index"
+python ../vis-scripts/plabase_index.py -p pathways_plabase.txt -s summary.txt
+
 echo "remove fasta files"
 
 rm PGPT_BASE_nr_Aug2021n_ul_1.fasta
@@ -0,0 +1,53 @@
+"""
+PGPg_finder post-processing as a Python API
+
+The workflow scripts call the command lines in vis-scripts/, which are thin
+wrappers around these modules. The same functions work on in-memory tables:
+
+    from pgpg_finder import gene_abundances, read_hits, join_abundance, load_index, CountMatrix, write_outputs
+
+    abundances = gene_abundances('S1.pileup', mode='tpm')
+    table = join_abundance(abundances, read_hits('S1_diamond.txt'), 'S1')
+    matrix = CountMatrix.from_gene_counts(table, load_index('pathways_plabase.txt', 'summary.txt'))
+    write_outputs(matrix, 'results', figures=False)
+
+Names are imported from their module on first use, so importing the package
+is cheap; matplotlib and seaborn are only imported to render heatmaps.
+"""
+import importlib
+
+__version__ = '1.1.0'
+
+# Public name -> module of the package defining it
+_API = {
+    'open_file': 'compressed_io',
+    'MODES': 'abundance',
+    'gene_abundances': 'abundance',
+    'read_abundance': 'abundance',
+    'write_abundance': 'abundance',
+    'read_pileup': 'abundance',
+    'normalise': 'abundance',
+    'read_hits': 'annotations',
+    'join_abundance': 'merge',
+    'write_merged': 'merge',
+    'COLUMNS': 'plabase_index',
+    'load_index': 'plabase_index',
+    'CountMatrix': 'count_matrix',
+    'ProjectStore': 'project_store',
+    'write_outputs': 'heatmap',
+    'postprocess_samples': 'postprocess',
+}
+
+__all__ = sorted(_API)
+
+
+def __getattr__(name):
+    if name not in _API:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f'.{_API[name]}', __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_API))
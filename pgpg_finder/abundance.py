@@ -0,0 +1,154 @@
+import os
+import csv
+import argparse
+import logging
+
+import numpy as np
+import pandas as pd
+
+from .compressed_io import open_file
+
+# Normalisation modes:
+#   cpm  - average fold of each gene per million of the total average fold (default)
+#   tpm  - mapped reads per kb of gene, per million of the sample total
+#   rpkm - mapped reads per kb of gene per million mapped reads
+MODES = ('cpm', 'tpm', 'rpkm')
+
+PILEUP_COLUMNS = {'id': '#ID', 'fold': 'Avg_fold', 'length': 'Length',
+                  'plus': 'Plus_reads', 'minus': 'Minus_reads'}
+
+
+def read_pileup(pileup_file, mode='cpm', chunksize=1000000):
+    """
+    Parse a BBMap pileup file in a single pass
+
+    The file is read in chunks and only the columns needed by the
+    normalisation mode are converted to numeric arrays.
+
+    :param pileup_file: coverage depths of genes generated by BBMap pileup
+    :param mode: normalisation mode (cpm, tpm or rpkm)
+    :param chunksize: number of lines parsed at a time
+    :return: (gene IDs, dict of numpy arrays with 'fold', 'length' and 'reads')
+    """
+    columns = [PILEUP_COLUMNS['id'], PILEUP_COLUMNS['fold']]
+    if mode != 'cpm':
+        columns += [PILEUP_COLUMNS['length'], PILEUP_COLUMNS['plus'], PILEUP_COLUMNS['minus']]
+
+    ids, chunks = [], []
+    with open_file(pileup_file, 'rb') as fi:
+        reader = pd.read_csv(fi, sep='\t', usecols=columns, dtype={PILEUP_COLUMNS['id']: str},
+                             quoting=csv.QUOTE_NONE, chunksize=chunksize)
+        for chunk in reader:
+            ids.append(chunk[PILEUP_COLUMNS['id']].to_numpy())
+            chunks.append(chunk[columns[1:]].to_numpy(dtype=np.float64))
+
+    if not chunks:
+        return np.array([], dtype=object), {'fold': np.zeros(0), 'length': np.zeros(0), 'reads': np.zeros(0)}
+    values = np.concatenate(chunks)
+    data = {'fold': values[:, 0]}
+    if mode != 'cpm':
+        data['length'] = values[:, 1]
+        data['reads'] = values[:, 2] + values[:, 3]
+    return np.concatenate(ids), data
+
+
+def normalise(data, mode='cpm'):
+    """
+    Compute per-million gene abundances
+
+    :param data: dict of numpy arrays as returned by read_pileup
+    :param mode: normalisation mode (cpm, tpm or rpkm)
+    :return: numpy array of gene abundances
+    """
+    if mode == 'cpm':
+        values, total = data['fold'], data['fold'].sum()
+    elif mode == 'tpm':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = np.where(data['length'] > 0, data['reads'] / (data['length'] / 1000.0), 0.0)
+        total = values.sum()
+    elif mode == 'rpkm':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = np.where(data['length'] > 0, data['reads'] / (data['length'] / 1000.0), 0.0)
+        total = data['reads'].sum()
+    else:
+        raise ValueError(f"Unknown normalisation mode: {mode}")
+
+    if total == 0:
+        logging.warning('No coverage found, all gene abundances are zero')
+        return np.zeros(len(values))
+    return values / total * 1000000.0
+
+
+def write_abundance(ids, abundances, file_out):
+    """
+    Write a gene abundance table with buffered bulk writes
+
+    :param ids: gene IDs
+    :param abundances: gene abundances, in the same order as ids
+    :param file_out: output .abundance file
+    :return: None
+    """
+    with open_file(file_out, 'w') as fo:
+        fo.write("#ID\tgene_abundance\n")
+        step = 100000
+        for start in range(0, len(ids), step):
+            fo.writelines(f"{gene_id}\t{abundance!r}\n" for gene_id, abundance in
+                          zip(ids[start:start + step], abundances[start:start + step].tolist()))
+
+
+def gene_abundances(pileup_file, mode='cpm'):
+    """
+    Relative abundance of the genes of a BBMap pileup file, in memory
+
+    :param pileup_file: coverage depths of genes generated by BBMap pileup
+    :param mode: normalisation mode (cpm, tpm or rpkm)
+    :return: pandas Series of gene abundances indexed by gene ID
+    """
+    ids, data = read_pileup(pileup_file, mode)
+    return pd.Series(normalise(data, mode), index=pd.Index(ids, name='#ID'), name='gene_abundance')
+
+
+def read_abundance(abundance_file):
+    """
+    Read a gene abundance table (.abundance, plain or compressed)
+
+    :return: pandas Series of gene abundances indexed by gene ID
+    """
+    with open_file(abundance_file, 'rb') as fi:
+        table = pd.read_csv(fi, sep='\t', dtype={'#ID': str}, quoting=csv.QUOTE_NONE, float_precision='round_trip')
+    return pd.Series(table['gene_abundance'].to_numpy(dtype=np.float64),
+                     index=pd.Index(table['#ID'].to_numpy(), name='#ID'), name='gene_abundance')
+
+
+def gene_relative_abun(pileup_file, basename, output_dir, mode='cpm'):
+    """
+    Calculate relative abundance of genes in a file generated by BBMap pileup
+
+    :param pileup_file: coverage depths of genes generated by BBMap pileup
+    :param basename: basename of a sample that will be calculated
+    :param output_dir: directory to output the results
+    :param mode: normalisation mode (cpm, tpm or rpkm)
+    :return: pandas Series of gene abundances indexed by gene ID
+    """
+    logging.info('Gene relative abundance calculation')
+    abundances = gene_abundances(pileup_file, mode)
+    file_out = os.path.join(output_dir, basename + '.abundance')
+    write_abundance(abundances.index.to_numpy(), abundances.to_numpy(), file_out)
+    return abundances
+
+
+def main(argv=None):
+    """Command line: abundance table of one sample."""
+    parser = argparse.ArgumentParser(description='Calculate relative abundance of genes')
+    parser.add_argument('-p', '--pileup', required=True, help='Input pileup file')
+    parser.add_argument('-b', '--basename', required=True, help='Basename of the sample to be calculated')
+    parser.add_argument('-o', '--output', required=True, help='Output directory')
+    parser.add_argument('-m', '--mode', choices=MODES, default='cpm',
+                        help='Normalisation: cpm (average fold per million, default), tpm or rpkm')
+    args = parser.parse_args(argv)
+
+    gene_relative_abun(args.pileup, args.basename, args.output, args.mode)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+import os
+import sys
+import argparse
+
+import pandas as pd
+
+from .compressed_io import open_file, strip_compression
+
+
+def read_hits(diamond_file):
+    """
+    Read the query and subject IDs of a DIAMOND tabular output, in memory
+
+    :param diamond_file: DIAMOND tabular output (plain or compressed), '-' reads the hits from stdin
+    :return: DataFrame with gene_id and accession columns, in the order of the hits
+    """
+    genes, accessions = [], []
+    hits = sys.stdin if diamond_file == '-' else open_file(diamond_file, 'r')
+    try:
+        for line in hits:
+            elements = line.split(None, 2)
+            if len(elements) < 2 or elements[0].startswith('#'):
+                continue
+            genes.append(elements[0])
+            accessions.append(elements[1])
+    finally:
+        if hits is not sys.stdin:
+            hits.close()
+    return pd.DataFrame({'gene_id': pd.Series(genes, dtype=object), 'accession': pd.Series(accessions, dtype=object)})
+
+
+def merge_blastp_annotations(blastout_file, output):
+    print('Merge blastp annotations')
+    with open(output, 'w') as fo:
+        fo.write('#sample\tgene_id\taccession\n')
+    if strip_compression(blastout_file).endswith('.txt'):
+        basename = os.path.basename(blastout_file).split('_diamond')[0]
+        with open_file(blastout_file, 'r') as fi:
+            for line in fi:
+                elements = line.split()
+                gene_id = elements[0]
+                accession = elements[1]
+                with open(output, 'a') as fo:
+                    fo.write(basename + '\t' + gene_id + '\t' + accession + '\n')
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge blastp annotations into a single file.")
+    parser.add_argument("-b", "--blastout_file", required=True, help="Path to the blastp output file.")
+    parser.add_argument("-o", "--output", required=True, help="Output file to write merged annotations.")
+    args = parser.parse_args()
+
+    merge_blastp_annotations(args.blastout_file, args.output)
+
+if __name__ == "__main__":
+    main()
+
@@ -0,0 +1,129 @@
+import json
+import logging
+from datetime import datetime
+
+import numpy as np
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+GENERATED_BY = 'PGPg_finder'
+TABLE_TYPE = 'OTU table'
+FORMAT_URL = 'http://biom-format.org'
+# Number of observations serialised at a time
+CHUNK_ROWS = 5000
+
+
+def _element_type(matrix):
+    return 'int' if np.issubdtype(matrix.dtype, np.integer) else 'float'
+
+
+def write_biom_json(path, observation_ids, sample_ids, matrix, taxonomy=None, table_id=None):
+    """
+    Write a BIOM 1.0 (JSON) table, streaming the sparse entries and observations
+
+    :param path: output .biom file
+    :param observation_ids: observation (PGPT) IDs
+    :param sample_ids: sample IDs
+    :param matrix: scipy sparse observation x sample matrix
+    :param taxonomy: optional list with the taxonomy (list of strings) of every observation
+    :param table_id: table ID
+    :return: None
+    """
+    matrix = matrix.tocsr()
+    header = {
+        'id': table_id,
+        'format': 'Biological Observation Matrix 1.0.0',
+        'format_url': FORMAT_URL,
+        'matrix_type': 'sparse',
+        'generated_by': GENERATED_BY,
+        'date': datetime.now().isoformat(),
+        'type': TABLE_TYPE,
+        'matrix_element_type': _element_type(matrix),
+        'shape': [matrix.shape[0], matrix.shape[1]],
+    }
+    with open(path, 'w', buffering=1 << 20) as fo:
+        fo.write(json.dumps(header)[:-1])
+
+        fo.write(', "data": [')
+        separator = ''
+        for start in range(0, matrix.shape[0], CHUNK_ROWS):
+            block = matrix[start:start + CHUNK_ROWS].tocoo()
+            if block.nnz:
+                entries = np.column_stack([block.row + start, block.col]).tolist()
+                for entry, value in zip(entries, block.data.tolist()):
+                    entry.append(value)
+                fo.write(separator + json.dumps(entries)[1:-1])
+                separator = ', '
+
+        fo.write('], "rows": [')
+        for start in range(0, len(observation_ids), CHUNK_ROWS):
+            rows = [{'id': str(observation_id),
+                     'metadata': {'taxonomy': taxonomy[i]} if taxonomy is not None else None}
+                    for i, observation_id in enumerate(observation_ids[start:start + CHUNK_ROWS], start)]
+            fo.write((', ' if start else '') + json.dumps(rows)[1:-1])
+
+        fo.write('], "columns": ')
+        fo.write(json.dumps([{'id': str(sample_id), 'metadata': None} for sample_id in sample_ids]))
+        fo.write('}\n')
+
+
+def write_biom_hdf5(path, observation_ids, sample_ids, matrix, taxonomy=None, table_id=None):
+    """
+    Write a BIOM 2.1 (HDF5) table, with the matrix in both CSR and CSC layouts
+
+    Requires h5py.
+
+    :param path: output .biom file
+    :param observation_ids: observation (PGPT) IDs
+    :param sample_ids: sample IDs
+    :param matrix: scipy sparse observation x sample matrix
+    :param taxonomy: optional list with the taxonomy (list of strings) of every observation
+    :param table_id: table ID
+    :return: None
+    """
+    if h5py is None:
+        raise ImportError('h5py is required to write HDF5 BIOM tables')
+    by_observation = matrix.tocsr()
+    by_sample = matrix.T.tocsr()
+    strings = h5py.string_dtype()
+    with h5py.File(path, 'w') as fo:
+        fo.attrs['id'] = table_id or 'No Table ID'
+        fo.attrs['type'] = TABLE_TYPE
+        fo.attrs['format-url'] = FORMAT_URL
+        fo.attrs['format-version'] = (2, 1)
+        fo.attrs['generated-by'] = GENERATED_BY
+        fo.attrs['creation-date'] = datetime.now().isoformat()
+        fo.attrs['shape'] = matrix.shape
+        fo.attrs['nnz'] = by_observation.nnz
+
+        for axis, ids, layout in (('observation', observation_ids, by_observation), ('sample', sample_ids, by_sample)):
+            group = fo.create_group(axis)
+            group.create_dataset('ids', data=np.asarray([str(i) for i in ids], dtype=object), dtype=strings)
+            group.create_dataset('matrix/data', data=layout.data.astype(np.float64))
+            group.create_dataset('matrix/indices', data=layout.indices.astype(np.int32))
+            group.create_dataset('matrix/indptr', data=layout.indptr.astype(np.int32))
+            group.create_group('metadata')
+            group.create_group('group-metadata')
+
+        if taxonomy is not None and len(taxonomy):
+            fo['observation/metadata'].create_dataset('taxonomy', data=np.asarray(taxonomy, dtype=object),
+                                                      dtype=strings)
+
+
+def write_biom(json_path, hdf5_path, observation_ids, sample_ids, matrix, taxonomy=None):
+    """
+    Write the JSON BIOM table and, when h5py is installed, the HDF5 one
+
+    :return: list of the tables written
+    """
+    write_biom_json(json_path, observation_ids, sample_ids, matrix, taxonomy)
+    written = [json_path]
+    if h5py is None:
+        logging.warning('h5py is not installed, skipping the HDF5 BIOM table (table.biom); install it with: conda install h5py')
+    else:
+        write_biom_hdf5(hdf5_path, observation_ids, sample_ids, matrix, taxonomy)
+        written.append(hdf5_path)
+    return written
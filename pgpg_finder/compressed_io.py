@@ -0,0 +1,252 @@
+import io
+import sys
+import gzip
+import shutil
+import signal
+import threading
+import argparse
+import subprocess
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Suffixes of the compressed files written by the workflows
+COMPRESSED_SUFFIXES = ('.gz', '.zst')
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+BUFFER_SIZE = 1 << 20
+
+
+def compression(path):
+    """Codec of a file name: 'gz', 'zst' or None."""
+    for suffix in COMPRESSED_SUFFIXES:
+        if str(path).endswith(suffix):
+            return suffix[1:]
+    return None
+
+
+def strip_compression(name):
+    """File name without a .gz or .zst suffix."""
+    codec = compression(name)
+    return name[:-len(codec) - 1] if codec else name
+
+
+def _codec(head):
+    if head.startswith(GZIP_MAGIC):
+        return 'gz'
+    if head.startswith(ZSTD_MAGIC):
+        return 'zst'
+    return None
+
+
+def file_compression(path):
+    """Codec of a file from its magic bytes: 'gz', 'zst' or None."""
+    with open(path, 'rb') as fi:
+        return _codec(fi.read(4))
+
+
+class _Prefixed(io.RawIOBase):
+    """Unbuffered stream that replays the bytes already read from a pipe before the rest of it."""
+
+    def __init__(self, head, raw):
+        self._head = head
+        self._raw = raw
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self._head:
+            n = min(len(buffer), len(self._head))
+            buffer[:n] = self._head[:n]
+            self._head = self._head[n:]
+            return n
+        return self._raw.readinto(buffer)
+
+    def close(self):
+        self._raw.close()
+        super().close()
+
+
+def _open_source(path):
+    """
+    Open a file for reading and detect its codec from the magic bytes
+
+    Only the first bytes are read; files are rewound and pipes or FIFOs are
+    replayed from the start.
+
+    :return: (codec, unbuffered stream from the start of the file)
+    """
+    raw = open(path, 'rb', buffering=0)
+    head = b''
+    while len(head) < 4:
+        block = raw.read(4 - len(head))
+        if not block:
+            break
+        head += block
+    if raw.seekable():
+        raw.seek(0)
+        return _codec(head), raw
+    return _codec(head), _Prefixed(head, raw)
+
+
+def _feed(source, target):
+    # Copy a replayed pipe into the stdin of a decompressor
+    try:
+        copy_stream(source, target)
+    except BrokenPipeError:
+        pass
+    finally:
+        source.close()
+        try:
+            target.close()
+        except BrokenPipeError:
+            pass
+
+
+class _ProcessFile:
+    """Binary stream of a (de)compression tool; closing it waits for the tool and checks its exit code."""
+
+    def __init__(self, process, stream, path):
+        self._process = process
+        self._stream = stream
+        self.name = path
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def __iter__(self):
+        return iter(self._stream)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def closed(self):
+        return self._stream.closed
+
+    def close(self):
+        if self._stream.closed:
+            return
+        self._stream.close()
+        code = self._process.wait()
+        # A reader closed before the end stops the decompressor with SIGPIPE
+        if code != 0 and code != -signal.SIGPIPE:
+            raise OSError(f"{self._process.args[0]} failed on {self.name} (exit {code})")
+
+
+def _tool(codec, threads, decompress):
+    # Multi-threaded command-line codecs, when installed
+    if codec == 'gz':
+        for tool in ('pigz', 'gzip'):
+            if shutil.which(tool):
+                command = [tool, '-dc'] if decompress else [tool, '-c']
+                if tool == 'pigz' and threads > 1:
+                    command[1:1] = ['-p', str(threads)]
+                return command
+    elif shutil.which('zstd'):
+        return ['zstd', '-dcq'] if decompress else ['zstd', '-cq', f'-T{threads}']
+    return None
+
+
+def open_file(path, mode='rb', threads=1):
+    """
+    Open a plain, gzip or zstd file
+
+    Files are read according to their content (magic bytes), so compressed
+    inputs are accepted whatever their name, and written compressed when
+    their name ends with .gz or .zst. pigz and zstd are used when installed
+    (multi-threaded, in a separate process), gzip or zstandard otherwise.
+
+    :param path: file path
+    :param mode: 'rb', 'r', 'wb', 'w', 'ab' or 'a' ('t' is implied without 'b')
+    :param threads: compression threads
+    :return: file object
+    """
+    binary = 'b' in mode
+    kind = mode.replace('b', '').replace('t', '')
+    if kind == 'r':
+        codec, raw = _open_source(path)
+        command = _tool(codec, threads, decompress=True) if codec else None
+        if codec is None:
+            stream = io.BufferedReader(raw, buffer_size=BUFFER_SIZE)
+        elif command and isinstance(raw, _Prefixed):
+            process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=BUFFER_SIZE)
+            threading.Thread(target=_feed, args=(raw, process.stdin), daemon=True).start()
+            stream = _ProcessFile(process, process.stdout, path)
+        elif command:
+            process = subprocess.Popen(command, stdin=raw, stdout=subprocess.PIPE, bufsize=BUFFER_SIZE)
+            raw.close()
+            stream = _ProcessFile(process, process.stdout, path)
+        elif codec == 'gz' and isinstance(raw, _Prefixed):
+            stream = gzip.GzipFile(fileobj=io.BufferedReader(raw, buffer_size=BUFFER_SIZE), mode='rb')
+        elif codec == 'gz':
+            raw.close()
+            stream = gzip.open(path, 'rb')
+        elif zstandard is not None:
+            stream = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw, closefd=True),
+                                       buffer_size=BUFFER_SIZE)
+        else:
+            raw.close()
+            raise OSError(f"{path} is zstd-compressed: zstd or the zstandard module is required")
+    else:
+        codec = compression(path)
+        if codec is None:
+            stream = open(path, kind + 'b', buffering=BUFFER_SIZE)
+        else:
+            # Appending adds a new gzip member / zstd frame, both readable as one stream
+            command = _tool(codec, threads, decompress=False)
+            if command:
+                with open(path, kind + 'b') as raw:
+                    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=raw, bufsize=BUFFER_SIZE)
+                stream = _ProcessFile(process, process.stdin, path)
+            elif codec == 'gz':
+                stream = gzip.open(path, kind + 'b', compresslevel=6)
+            elif zstandard is not None:
+                stream = zstandard.ZstdCompressor(threads=threads).stream_writer(open(path, kind + 'b'),
+                                                                                 closefd=True)
+            else:
+                raise OSError(f"Writing {path} requires zstd or the zstandard module")
+    if binary:
+        return stream
+    return io.TextIOWrapper(stream)
+
+
+def copy_stream(source, target):
+    """Copy a binary stream to another in large blocks."""
+    while True:
+        block = source.read(BUFFER_SIZE)
+        if not block:
+            break
+        target.write(block)
+
+
+def main(argv=None):
+    """Command line: cat and compress."""
+    parser = argparse.ArgumentParser(description='Read and write plain, gzip and zstd files')
+    subparsers = parser.add_subparsers(dest='action', required=True)
+    cat_parser = subparsers.add_parser('cat', help='Write files to stdout, decompressed')
+    cat_parser.add_argument('files', nargs='+', help='Plain, gzip or zstd files')
+    compress_parser = subparsers.add_parser('compress', help='Compress stdin into a .gz or .zst file')
+    compress_parser.add_argument('-o', '--output', required=True, help='Output file (.gz or .zst)')
+    compress_parser.add_argument('-t', '--threads', type=int, default=1, help='Compression threads')
+    args = parser.parse_args(argv)
+
+    if args.action == 'cat':
+        for path in args.files:
+            with open_file(path, 'rb') as fi:
+                copy_stream(fi, sys.stdout.buffer)
+    else:
+        if compression(args.output) is None:
+            parser.error('the output must end with .gz or .zst')
+        with open_file(args.output, 'wb', threads=args.threads) as fo:
+            copy_stream(sys.stdin.buffer, fo)
+
+
+if __name__ == "__main__":
+    main()
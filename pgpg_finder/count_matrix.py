@@ -0,0 +1,149 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from .plabase_index import subject_prefixes
+
+
+def count_arrays(gene_counts):
+    """
+    Sparse sample x PGPT ID counts of a gene counts table
+
+    Distinct subjects and samples are resolved and sorted once, then broadcast to all rows.
+
+    :param gene_counts: DataFrame with Sample, ID (DIAMOND subject IDs) and Count columns
+    :return: (scipy CSR matrix, sorted PGPT IDs, sorted samples)
+    """
+    subject_codes, subjects = pd.factorize(gene_counts['ID'])
+    ids, id_codes = np.unique(subject_prefixes(subjects), return_inverse=True)
+    sample_codes, samples = pd.factorize(gene_counts['Sample'].astype(str))
+    samples, sample_order = np.unique(np.asarray(samples, dtype=str), return_inverse=True)
+    values = gene_counts['Count'].to_numpy()
+    counts = sparse.coo_matrix((values, (sample_order.ravel()[sample_codes], id_codes.ravel()[subject_codes])),
+                               shape=(len(samples), len(ids))).tocsr()
+    counts.sum_duplicates()
+    return counts, ids.astype(object), samples.astype(object)
+
+
+def combine_counts(parts):
+    """
+    Stack sample x PGPT ID count matrices over the union of their IDs
+
+    When a sample appears in several parts, the rows of the last part are kept.
+
+    :param parts: list of (counts, PGPT IDs, samples) as returned by count_arrays
+    :return: (scipy CSR matrix, sorted PGPT IDs, sorted samples)
+    """
+    ids = np.unique(np.concatenate([np.asarray(part_ids, dtype=str) for _, part_ids, _ in parts]))
+    blocks = []
+    for counts, part_ids, samples in parts:
+        block = counts.tocoo()
+        columns = np.searchsorted(ids, np.asarray(part_ids, dtype=str))
+        blocks.append(sparse.csr_matrix((block.data, (block.row, columns[block.col])), shape=(len(samples), len(ids))))
+    names = np.concatenate([np.asarray(samples, dtype=str) for _, _, samples in parts])
+    samples, last = np.unique(names[::-1], return_index=True)
+    counts = sparse.vstack(blocks).tocsr()[len(names) - 1 - last]
+    # IDs only seen in replaced samples
+    used = counts.getnnz(axis=0) > 0
+    return counts[:, used].tocsr(), ids[used].astype(object), samples.astype(object)
+
+
+class CountMatrix:
+    """
+    Sparse sample x PGPT count matrix annotated with the PLaBAse index
+
+    Counts are held once, with one column per distinct PGPT ID (sorted) and
+    one row per sample (sorted). Every level of the hierarchy is obtained by
+    multiplying the matrix with a sparse 0/1 aggregation matrix that maps PGPT
+    IDs to the labels of that level, so no table is built from a long
+    DataFrame.
+    """
+
+    def __init__(self, counts, ids, rows, samples, index):
+        self.counts = counts
+        self.ids = ids
+        self.rows = rows
+        self.samples = samples
+        self.index = index
+        self._codes = {}
+
+    @classmethod
+    def from_gene_counts(cls, gene_counts, index):
+        """
+        Build the matrix from a gene counts table
+
+        :param gene_counts: DataFrame with Sample, ID (DIAMOND subject IDs) and Count columns
+        :param index: PlabaseIndex
+        :return: CountMatrix
+        """
+        counts, ids, samples = count_arrays(gene_counts)
+        return cls(counts, ids, index.lookup(ids)[1], samples, index)
+
+    @classmethod
+    def from_counts(cls, counts, ids, samples, index):
+        """Wrap a sample x PGPT ID matrix (sorted IDs and samples), e.g. loaded from a project store."""
+        return cls(counts, ids, index.lookup(ids)[1], samples, index)
+
+    def codes(self, column):
+        """Category codes of an annotation column for every PGPT ID (-1 when not annotated)."""
+        if column not in self._codes:
+            self._codes[column] = self.index.codes(column, self.rows).astype(np.int64)
+        return self._codes[column]
+
+    def labels(self, column, mask=None):
+        """
+        Labels of a column in order of first appearance among the (sorted) PGPT IDs
+
+        :param column: annotation column (Lv1-Lv5, PGPT_ID or LV_SUM)
+        :param mask: optional boolean array selecting PGPT IDs
+        :return: (label codes in order, per-ID position of the label in that order or -1)
+        """
+        codes = self.codes(column)
+        if mask is not None:
+            codes = np.where(mask, codes, -1)
+        valid = codes >= 0
+        uniques, first = np.unique(codes[valid], return_index=True)
+        order = uniques[np.argsort(first, kind='stable')]
+        position = np.full(len(self.index.meta['categories'][column]) + 1, -1, dtype=np.int64)
+        position[order] = np.arange(len(order))
+        return order, position[codes]
+
+    def groups(self, column):
+        """Yield (label, mask of its PGPT IDs) for every label of a column, in order of first appearance."""
+        order, position = self.labels(column)
+        categories = self.index.meta['categories'][column]
+        for i, code in enumerate(order):
+            yield categories[code], position == i
+
+    def aggregation(self, column, mask=None):
+        """Sparse PGPT x label matrix with a 1 where an ID belongs to a label, and the label codes."""
+        order, position = self.labels(column, mask)
+        members = np.flatnonzero(position >= 0)
+        matrix = sparse.csr_matrix((np.ones(len(members), dtype=self.counts.dtype), (members, position[members])),
+                                   shape=(len(self.ids), len(order)))
+        return matrix, order
+
+    def table(self, column, normalized=False, mask=None):
+        """
+        Label x sample table of a hierarchy level
+
+        :param column: annotation column to aggregate on
+        :param normalized: express counts as percentage of the table total
+        :param mask: optional boolean array selecting the PGPT IDs aggregated
+        :return: DataFrame indexed by label with one column per sample
+        """
+        matrix, order = self.aggregation(column, mask)
+        values = (self.counts @ matrix).T.toarray()
+        if normalized:
+            values = values / values.sum() * 100
+        categories = np.asarray(self.index.meta['categories'][column], dtype=object)
+        return pd.DataFrame(values, index=pd.Index(categories[order], name=column),
+                            columns=pd.Index(self.samples, name='Sample'))
+
+    def id_table(self, columns=()):
+        """PGPT ID x sample table of the counts, preceded by annotation columns."""
+        df = pd.DataFrame(self.counts.T.toarray(), columns=self.samples)
+        annotations = pd.DataFrame({'ID': self.ids})
+        for column in columns:
+            annotations[column] = self.index.column(column, self.rows)
+        return pd.concat([annotations, df], axis=1)
@@ -0,0 +1,213 @@
+import pandas as pd
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from .biom_table import write_biom
+from .count_matrix import CountMatrix
+from .plabase_index import COLUMNS, load_index
+from .project_store import ProjectStore
+
+# Above ANNOT_MAX_CELLS the cell values are not written on the heatmap, above
+# RASTER_MIN_CELLS the figure is saved as a PNG instead of a (huge) SVG.
+# Figure size is capped so that very large tables do not exhaust memory.
+ANNOT_MAX_CELLS = 1500
+RASTER_MIN_CELLS = 20000
+MAX_FIGURE_INCHES = 200
+MAX_FIGURE_PIXELS = 12000
+RENDER_CACHE = '.render_cache.json'
+
+
+def _plotting():
+    """Import matplotlib and seaborn on first use: tables alone do not pay for them."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    return plt, sns
+
+
+def generate_heatmap(df, output_path, title, normalized=True):
+    """Generate a heatmap from a DataFrame and return the path of the written figure."""
+    plt, sns = _plotting()
+    cells = df.shape[0] * df.shape[1]
+    if cells > RASTER_MIN_CELLS:
+        output_path = os.path.splitext(output_path)[0] + '.png'
+    plt.rcParams.update({'font.size': 20})
+    figsize = (min(max(20, df.shape[1]*2), MAX_FIGURE_INCHES), min(max(10, df.shape[0]*0.5), MAX_FIGURE_INCHES))
+    dpi = min(100, MAX_FIGURE_PIXELS / max(figsize))
+    fig, ax = plt.subplots(figsize=figsize, dpi=dpi)
+    try:
+        sns.heatmap(df, cmap="Spectral_r", ax=ax, annot=cells <= ANNOT_MAX_CELLS,
+                    rasterized=cells > RASTER_MIN_CELLS)
+        ax.set_title(title)
+        fig.savefig(output_path, bbox_inches='tight', dpi=dpi)
+    finally:
+        plt.close(fig)
+    return output_path
+
+
+def _render_key(df, title):
+    digest = hashlib.sha256(df.to_csv(sep='\t').encode())
+    digest.update(f"{title}|{ANNOT_MAX_CELLS}|{RASTER_MIN_CELLS}".encode())
+    return digest.hexdigest()
+
+
+def _render(job):
+    df, output_path, title, normalized = job
+    return generate_heatmap(df, output_path, title, normalized)
+
+
+def render_heatmaps(jobs, figures_dir, workers=1):
+    """
+    Render a list of (df, output_path, title, normalized) heatmap jobs
+
+    Figures are distributed over a process pool. A figure is skipped when the
+    table and title it was rendered from are unchanged since the last run
+    (tracked in <figures_dir>/.render_cache.json) and the file still exists.
+    """
+    cache_path = os.path.join(figures_dir, RENDER_CACHE)
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path) as fi:
+            cache = json.load(fi)
+
+    pending, keys = [], []
+    for job in jobs:
+        df, output_path, title, _ = job
+        key = _render_key(df, title)
+        cached = cache.get(output_path)
+        if cached and cached['key'] == key and os.path.exists(cached['figure']):
+            continue
+        pending.append(job)
+        keys.append(key)
+    print(f"Rendering {len(pending)} heatmaps ({len(jobs) - len(pending)} unchanged).")
+
+    if workers > 1 and len(pending) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(pending))) as pool:
+            figures = list(pool.map(_render, pending))
+    else:
+        figures = [_render(job) for job in pending]
+
+    for job, key, figure in zip(pending, keys, figures):
+        cache[job[1]] = {'key': key, 'figure': figure}
+    with open(cache_path, 'w') as fo:
+        json.dump(cache, fo, indent=1)
+
+
+def generate_facet_heatmap(matrix, level, output_path, normalized=True, jobs=None):
+    """Generate facet heatmaps of a CountMatrix level for every Lv2 (queued in jobs when given)."""
+    for lv2, members in matrix.groups('Lv2'):
+        df_pivot = matrix.table(level, normalized, mask=members)
+        if df_pivot.size > 0:
+            heatmap_title = f"{'Normalized' if normalized else 'Non-normalized'} gene counts by sample and {level} with Lv2={lv2}"
+            job = (df_pivot, os.path.join(output_path, f'{level}_heatmap_facet_{lv2}.svg'), heatmap_title, normalized)
+            if jobs is None:
+                _render(job)
+            else:
+                jobs.append(job)
+        else:
+            print(f"No data for {level} with Lv2={lv2}. Skipping heatmap.")
+
+
+def write_outputs(matrix, out_dir, jobs=1, figures=True):
+    """
+    Write the PLaBAse tables, heatmaps and BIOM tables of a count matrix
+
+    :param matrix: CountMatrix (CountMatrix.from_gene_counts or ProjectStore.load_matrix)
+    :param out_dir: output directory (tables/ and figures/ are created in it)
+    :param jobs: number of processes used to render figures
+    :param figures: render the heatmaps; without them matplotlib and seaborn are never imported
+    :return: None
+    """
+    tables_dir = os.path.join(out_dir, 'tables')
+    figures_dir = os.path.join(out_dir, 'figures')
+    os.makedirs(tables_dir, exist_ok=True)
+    os.makedirs(figures_dir, exist_ok=True)
+
+    tables_normalized_dir = os.path.join(tables_dir, 'normalized')
+    tables_nonnormalized_dir = os.path.join(tables_dir, 'non-normalized')
+    figures_normalized_dir = os.path.join(figures_dir, 'normalized')
+    figures_nonnormalized_dir = os.path.join(figures_dir, 'non-normalized')
+
+    os.makedirs(tables_normalized_dir, exist_ok=True)
+    os.makedirs(tables_nonnormalized_dir, exist_ok=True)
+    os.makedirs(figures_normalized_dir, exist_ok=True)
+    os.makedirs(figures_nonnormalized_dir, exist_ok=True)
+
+    heatmap_jobs = []
+    for level in range(4, 2, -1):
+        lv = f"Lv{level}"
+
+        df_pivot = matrix.table(lv)
+        df_pivot.to_csv(os.path.join(tables_nonnormalized_dir, f'gene_counts_{lv}.txt'), sep='\t')
+
+        df_pivot_normalized = matrix.table(lv, normalized=True)
+        df_pivot_normalized.to_csv(os.path.join(tables_normalized_dir, f'normalized_gene_counts_{lv}.txt'), sep='\t')
+
+        if lv != "Lv5":
+            heatmap_jobs.append((df_pivot, os.path.join(figures_nonnormalized_dir, f'{lv}_heatmap.svg'), f"Non-normalized gene counts by sample and {lv}", False))
+            heatmap_jobs.append((df_pivot_normalized, os.path.join(figures_normalized_dir, f'{lv}_heatmap.svg'), f"Normalized gene counts by sample and {lv}", True))
+
+        generate_facet_heatmap(matrix, lv, figures_normalized_dir, normalized=True, jobs=heatmap_jobs)
+        generate_facet_heatmap(matrix, lv, figures_nonnormalized_dir, normalized=False, jobs=heatmap_jobs)
+
+    tables_summary_dir = os.path.join(tables_dir, 'summary')
+    figures_summary_dir = os.path.join(figures_dir, 'summary')
+
+    os.makedirs(tables_summary_dir, exist_ok=True)
+    os.makedirs(figures_summary_dir, exist_ok=True)
+
+    # Percentage of the total count of the IDs with a summary category
+    df_normalized = matrix.table('LV_SUM', normalized=True)
+    df_normalized.to_csv(os.path.join(tables_summary_dir, 'normalized_summary_table.txt'), sep='\t')
+
+    heatmap_output_path_normalized = os.path.join(figures_summary_dir, 'normalized_summary_heatmap.svg')
+    heatmap_jobs.append((df_normalized, heatmap_output_path_normalized, "Normalized Summary Heatmap", True))
+    if figures:
+        render_heatmaps(heatmap_jobs, figures_dir, jobs)
+
+    ###Generating summarized and biom file:
+        # Generate the table with the sum of IDs
+    df_sum_with_pathways = matrix.id_table(COLUMNS)
+    df_sum_with_pathways.to_csv(os.path.join(tables_dir, 'gene_counts_sum_with_pathways.txt'), sep='\t', index=False)
+
+    # Combine 'Lv1', 'Lv2', 'Lv3', 'Lv4', 'Lv5' and 'PGPT_ID' into a single taxonomy column
+    pathway_columns = df_sum_with_pathways[COLUMNS].fillna('nan')
+    df_combined = df_sum_with_pathways.drop(columns=COLUMNS).rename(columns={'ID': '#OTU_ID'})
+    df_combined['taxonomy'] = pathway_columns['Lv1'].str.cat(pathway_columns[COLUMNS[1:]], sep=';')
+    with open(os.path.join(tables_dir, 'gene_counts_sum_with_combined_pathways.txt'), 'w') as fo:
+        fo.write("# Constructed from biom file\n")
+        df_combined.to_csv(fo, sep='\t', index=False)
+
+    # BIOM tables written straight from the count matrix
+    write_biom(os.path.join(tables_dir, 'table.json.biom'), os.path.join(tables_dir, 'table.biom'),
+               matrix.ids, matrix.samples, matrix.counts.T, pathway_columns.to_numpy().tolist())
+
+
+def main(argv=None):
+    """Command line: outputs of a gene counts table or of a project store."""
+    parser = argparse.ArgumentParser(description='Generate PLaBAse tables, heatmaps and BIOM table from gene counts.')
+    parser.add_argument('gene_counts', help='Gene counts table (Sample, ID, Count)')
+    parser.add_argument('out_dir', help='Output directory')
+    parser.add_argument('pathways', help='PLaBAse pathways table')
+    parser.add_argument('summary', help='PLaBAse summary table')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes used to render figures')
+    parser.add_argument('--index', help='PLaBAse index directory (default: plabase_index next to the pathways table)')
+    parser.add_argument('--store', help='Read the counts from this project store instead of the gene counts table')
+    parser.add_argument('--no-figures', action='store_true', help='Only write the tables, skip rendering the heatmaps')
+    args = parser.parse_args(argv)
+
+    index = load_index(args.pathways, args.summary, args.index)
+    if args.store:
+        matrix = ProjectStore(args.store).load_matrix(index)
+    else:
+        gene_counts = pd.read_csv(args.gene_counts, sep="\t", float_precision="round_trip")
+        matrix = CountMatrix.from_gene_counts(gene_counts, index)
+    write_outputs(matrix, args.out_dir, args.jobs, not args.no_figures)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+import os
+import sys
+import argparse
+import logging
+
+import pandas as pd
+
+from .compressed_io import open_file
+
+MERGED_HEADER = 'Sample\tID\tCount\n'
+
+def merge_abun_tab(abundance_file, blastp, output):
+    logging.info('Merge abundance table with blastp table')
+
+    # Check if the file exists. If not, writes the header.
+    if not os.path.exists(output):
+        with open(output, 'w') as fo:
+            fo.write('Sample\tID\tCount\n')  
+
+    abun_tab_dict = {}
+    basename = os.path.basename(abundance_file).rsplit('.', 1)[0]
+    with open_file(abundance_file, 'r') as fi:
+        next(fi)
+        for line in fi:
+            line = line.strip('\n')
+            gene_id, abundance = line.split('\t')
+            if gene_id != "#ID":
+                key = str(basename) + '+' + str(gene_id)
+                abun_tab_dict[key] = abundance
+
+    a = []
+    with open_file(blastp, 'r') as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            else:
+                a.append(line.strip())
+
+    for item in sorted(a):
+        basename = item.split('\t')[0]
+        gene_id = item.split('\t')[1]
+        accession = item.split('\t')[2]
+        key = basename + '+' + gene_id
+        if key in abun_tab_dict:
+            abundance = abun_tab_dict[key]
+            with open(output, 'a') as fo:
+                fo.write(basename + '\t' + accession + '\t' + abundance + '\n')
+
+def merge_abun_hits(abundance_file, diamond_file, output, sample=None):
+    """
+    Join DIAMOND hits with gene abundances in a single streaming pass
+
+    Replaces merge_blastp.py followed by merge_abun_tab: only the abundance
+    table is held in memory (as a hash index), the hits are streamed against it
+    and the Sample/ID/Count rows are written with buffered I/O, without the
+    intermediate <sample>_diamond_table.txt.
+
+    :param abundance_file: gene abundance table (.abundance)
+    :param diamond_file: DIAMOND tabular output, '-' reads the hits from stdin
+    :param output: merged table, the header is written if the file does not exist
+    :param sample: sample name (default: basename of the abundance file)
+    :return: number of rows written
+    """
+    logging.info('Merge abundance table with DIAMOND hits')
+    if sample is None:
+        sample = os.path.basename(abundance_file).rsplit('.', 1)[0]
+
+    abun_index = {}
+    with open_file(abundance_file, 'r') as fi:
+        for line in fi:
+            if line.startswith('#'):
+                continue
+            gene_id, abundance = line.rstrip('\n').split('\t')
+            abun_index[gene_id] = abundance
+
+    write_header = not os.path.exists(output)
+    written = 0
+    hits = sys.stdin if diamond_file == '-' else open_file(diamond_file, 'r')
+    try:
+        with open(output, 'a', buffering=1 << 20) as fo:
+            if write_header:
+                fo.write(MERGED_HEADER)
+            for line in hits:
+                elements = line.split(None, 2)
+                if len(elements) < 2 or elements[0].startswith('#'):
+                    continue
+                abundance = abun_index.get(elements[0])
+                if abundance is not None:
+                    fo.write(sample + '\t' + elements[1] + '\t' + abundance + '\n')
+                    written += 1
+    finally:
+        if hits is not sys.stdin:
+            hits.close()
+    return written
+
+
+def join_abundance(abundances, hits, sample):
+    """
+    Join DIAMOND hits with gene abundances, in memory
+
+    Same rows as merge_abun_hits: hits of genes without an abundance are
+    dropped, and the hits keep their order.
+
+    :param abundances: Series of gene abundances indexed by gene ID (abundance.gene_abundances)
+    :param hits: DataFrame with gene_id and accession columns (annotations.read_hits)
+    :param sample: sample name
+    :return: DataFrame with Sample, ID and Count columns
+    """
+    if abundances.index.has_duplicates:
+        abundances = abundances[~abundances.index.duplicated(keep='last')]
+    counts = hits['gene_id'].map(abundances)
+    found = counts.notna().to_numpy()
+    return pd.DataFrame({'Sample': pd.Series([sample] * int(found.sum()), dtype=object),
+                         'ID': hits['accession'].to_numpy()[found],
+                         'Count': counts.to_numpy(dtype=float)[found]})
+
+
+def write_merged(table, output):
+    """
+    Append a Sample/ID/Count table with buffered bulk writes
+
+    Abundances are written as in the .abundance files, so the rows are those
+    merge_abun_hits writes. The header is written if the file does not exist.
+    """
+    write_header = not os.path.exists(output)
+    with open(output, 'a', buffering=1 << 20) as fo:
+        if write_header:
+            fo.write(MERGED_HEADER)
+        fo.writelines(f"{sample}\t{subject}\t{count!r}\n" for sample, subject, count in
+                      zip(table['Sample'].tolist(), table['ID'].tolist(), table['Count'].tolist()))
+    return len(table)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge abundance table with blastp table.')
+    parser.add_argument('-a', '--abundance_file', help='Path to the abundance file', required=True)
+    hits = parser.add_mutually_exclusive_group(required=True)
+    hits.add_argument('-b', '--blastp', help='Filepath of the merged blastp table')
+    hits.add_argument('-d', '--diamond', help="DIAMOND output to join directly, without merge_blastp.py ('-' reads stdin)")
+    parser.add_argument('-s', '--sample', help='Sample name used with --diamond (default: abundance file basename)')
+    parser.add_argument('-o', '--output', help='Output file', required=True)
+    args = parser.parse_args()
+    if args.diamond:
+        merge_abun_hits(args.abundance_file, args.diamond, args.output, args.sample)
+    else:
+        merge_abun_tab(args.abundance_file, args.blastp, args.output)
+
+if __name__ == '__main__':
+    main()
+
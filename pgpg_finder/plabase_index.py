@@ -0,0 +1,197 @@
+import os
+import json
+import hashlib
+import argparse
+import logging
+
+import numpy as np
+import pandas as pd
+
+INDEX_VERSION = 1
+INDEX_DIR = 'plabase_index'
+META_FILE = 'meta.json'
+# Annotation columns of the pathways table, stored as categorical codes
+COLUMNS = ['Lv1', 'Lv2', 'Lv3', 'Lv4', 'Lv5', 'PGPT_ID']
+
+
+def _checksum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fi:
+        for block in iter(lambda: fi.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _labels(categories):
+    # Categories followed by NaN, so that code -1 (unannotated) takes NaN
+    return np.append(np.asarray(categories, dtype=object), np.nan)
+
+
+def subject_prefixes(subject_ids):
+    """PGPT IDs of DIAMOND subject IDs (<PGPT ID>_<suffix>), as a numpy array of str."""
+    subject_ids = np.asarray(subject_ids, dtype='S')
+    if not len(subject_ids):
+        return np.zeros(0, dtype=str)
+    return np.char.partition(subject_ids, b'_')[:, 0].astype(str)
+
+
+class PlabaseIndex:
+    """
+    Compact binary index of the PLaBAse pathways and summary tables
+
+    Every PGPT ID is interned as an integer code (its row in the pathways
+    table). Lv1-Lv5, PGPT_ID and LV_SUM are stored as categorical codes per
+    row, and the IDs are kept sorted so DIAMOND subject IDs are resolved with a
+    binary search on their prefix. Arrays are saved as .npy files and loaded
+    memory-mapped.
+    """
+
+    def __init__(self, arrays, meta):
+        self.arrays = arrays
+        self.meta = meta
+        self._labels = {column: _labels(categories) for column, categories in meta['categories'].items()}
+
+    def __len__(self):
+        return len(self.arrays['ids'])
+
+    @classmethod
+    def compile(cls, pathways_file, summary_file):
+        """Compile the PLaBAse tables into an in-memory index."""
+        pathways = pd.read_csv(pathways_file, sep='\t', dtype=str)
+        summary = pd.read_csv(summary_file, sep='\t', dtype=str)
+
+        ids = pathways['ID'].to_numpy(dtype='S')
+        order = np.argsort(ids, kind='stable').astype(np.int32)
+        arrays = {'ids': ids, 'sorted_ids': ids[order], 'sorted_rows': order}
+        categories = {}
+
+        codes = np.empty((len(pathways), len(COLUMNS)), dtype=np.int32)
+        for i, column in enumerate(COLUMNS):
+            codes[:, i], uniques = pd.factorize(pathways[column], sort=True)
+            categories[column] = uniques.tolist()
+        arrays['codes'] = codes
+
+        lv_sum = pathways['ID'].map(summary.drop_duplicates('ID').set_index('ID')['LV_SUM'])
+        lv_sum_codes, uniques = pd.factorize(lv_sum, sort=True)
+        arrays['lv_sum'] = lv_sum_codes.astype(np.int32)
+        categories['LV_SUM'] = uniques.tolist()
+
+        meta = {
+            'version': INDEX_VERSION,
+            'sources': {'pathways': _checksum(pathways_file), 'summary': _checksum(summary_file)},
+            'categories': categories,
+        }
+        return cls(arrays, meta)
+
+    def save(self, index_dir):
+        """Write the arrays (.npy) and the categories (meta.json) to a directory."""
+        os.makedirs(index_dir, exist_ok=True)
+        for name, values in self.arrays.items():
+            np.save(os.path.join(index_dir, name + '.npy'), values)
+        tmp = os.path.join(index_dir, META_FILE + '.tmp')
+        with open(tmp, 'w') as fo:
+            json.dump(self.meta, fo)
+        os.replace(tmp, os.path.join(index_dir, META_FILE))
+
+    @classmethod
+    def load(cls, index_dir):
+        """Load a saved index, memory-mapping its arrays."""
+        with open(os.path.join(index_dir, META_FILE)) as fi:
+            meta = json.load(fi)
+        if meta.get('version') != INDEX_VERSION:
+            raise ValueError(f"{index_dir} was built by another version of plabase_index")
+        arrays = {name: np.load(os.path.join(index_dir, name + '.npy'), mmap_mode='r')
+                  for name in ('ids', 'sorted_ids', 'sorted_rows', 'codes', 'lv_sum')}
+        return cls(arrays, meta)
+
+    def lookup(self, subject_ids):
+        """
+        Resolve DIAMOND subject IDs (<PGPT ID>_<suffix>) to index rows
+
+        Distinct subjects are resolved once and broadcast back to all hits.
+
+        :param subject_ids: sequence of subject IDs
+        :return: (numpy array of PGPT IDs, numpy array of rows, -1 for IDs not in PLaBAse)
+        """
+        codes, uniques = pd.factorize(pd.Series(subject_ids, dtype=object))
+        prefixes = subject_prefixes(uniques)
+        keys = prefixes.astype('S')
+        sorted_ids = self.arrays['sorted_ids']
+        position = np.searchsorted(sorted_ids, keys).clip(max=max(len(sorted_ids) - 1, 0))
+        found = sorted_ids[position] == keys if len(sorted_ids) else np.zeros(len(keys), dtype=bool)
+        rows = np.where(found, self.arrays['sorted_rows'][position], -1)
+        return prefixes.astype(object)[codes], rows[codes]
+
+    def codes(self, name, rows):
+        """Category codes of an annotation column (Lv1-Lv5, PGPT_ID or LV_SUM) for index rows, -1 for row -1."""
+        rows = np.asarray(rows)
+        values = self.arrays['lv_sum'] if name == 'LV_SUM' else self.arrays['codes'][:, COLUMNS.index(name)]
+        return np.where(rows >= 0, np.asarray(values)[rows], -1)
+
+    def column(self, name, rows):
+        """Labels of an annotation column for index rows, NaN for row -1."""
+        return self._labels[name][self.codes(name, rows)]
+
+    def is_current(self, pathways_file, summary_file):
+        sources = self.meta.get('sources', {})
+        return sources.get('pathways') == _checksum(pathways_file) and sources.get('summary') == _checksum(summary_file)
+
+
+def build_index(pathways_file, summary_file, index_dir=None):
+    """
+    Compile the PLaBAse tables into a binary index directory
+
+    :param pathways_file: PLaBAse pathways table
+    :param summary_file: PLaBAse summary table
+    :param index_dir: output directory (default: plabase_index next to the pathways table)
+    :return: PlabaseIndex
+    """
+    index_dir = index_dir or os.path.join(os.path.dirname(os.path.abspath(pathways_file)), INDEX_DIR)
+    logging.info('Compiling PLaBAse index')
+    index = PlabaseIndex.compile(pathways_file, summary_file)
+    index.save(index_dir)
+    return index
+
+
+def load_index(pathways_file, summary_file, index_dir=None):
+    """
+    Load the PLaBAse index, compiling it when it is missing or out of date
+
+    When the index directory cannot be written the index is compiled in memory.
+
+    :param pathways_file: PLaBAse pathways table
+    :param summary_file: PLaBAse summary table
+    :param index_dir: index directory (default: plabase_index next to the pathways table)
+    :return: PlabaseIndex
+    """
+    index_dir = index_dir or os.path.join(os.path.dirname(os.path.abspath(pathways_file)), INDEX_DIR)
+    if os.path.exists(os.path.join(index_dir, META_FILE)):
+        try:
+            index = PlabaseIndex.load(index_dir)
+            if index.is_current(pathways_file, summary_file):
+                return index
+            logging.warning(f"{index_dir} is out of date, rebuilding it")
+        except (OSError, ValueError) as error:
+            logging.warning(f"Could not load {index_dir} ({error}), rebuilding it")
+    try:
+        return build_index(pathways_file, summary_file, index_dir)
+    except OSError as error:
+        logging.warning(f"Could not write {index_dir} ({error}), using an in-memory index")
+        return PlabaseIndex.compile(pathways_file, summary_file)
+
+
+def main(argv=None):
+    """Command line: build the index."""
+    parser = argparse.ArgumentParser(description='Compile the PLaBAse tables into a binary annotation index')
+    parser.add_argument('-p', '--pathways', required=True, help='PLaBAse pathways table')
+    parser.add_argument('-s', '--summary', required=True, help='PLaBAse summary table')
+    parser.add_argument('-o', '--output', help='Index directory (default: plabase_index next to the pathways table)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    index = build_index(args.pathways, args.summary, args.output)
+    print(f"PLaBAse index with {len(index)} IDs written.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import os
+import argparse
+import logging
+
+import pandas as pd
+
+from .abundance import MODES, gene_abundances, read_abundance, write_abundance
+from .annotations import read_hits
+from .compressed_io import strip_compression
+from .count_matrix import CountMatrix
+from .heatmap import write_outputs
+from .merge import join_abundance, write_merged
+from .plabase_index import load_index
+
+MANIFEST_HEADER = 'Sample\tCoverage\tHits\n'
+
+
+def read_manifest(path):
+    """(sample, coverage, hits) of every row of a post-processing manifest (TSV with a header)."""
+    with open(path) as fi:
+        next(fi, None)
+        return [tuple(line.rstrip('\n').split('\t')) for line in fi if line.strip()]
+
+
+def sample_abundances(sample, coverage, mode='cpm'):
+    """
+    Gene abundances of a sample
+
+    :param coverage: BBMap pileup (abundances are computed and written to
+                     <sample>.abundance next to it) or .abundance table
+    :param mode: normalisation mode of pileup files
+    :return: pandas Series of gene abundances indexed by gene ID
+    """
+    if strip_compression(coverage).endswith('.pileup'):
+        abundances = gene_abundances(coverage, mode)
+        write_abundance(abundances.index.to_numpy(), abundances.to_numpy(),
+                        os.path.join(os.path.dirname(coverage), sample + '.abundance'))
+        return abundances
+    return read_abundance(coverage)
+
+
+def postprocess_samples(samples, merged, mode='cpm', index=None, out_dir=None, jobs=1, figures=True):
+    """
+    Post-process all samples of a run in a single process
+
+    For every sample, the gene abundances are computed from its pileup (or
+    read from its .abundance table), joined with its DIAMOND hits and written
+    to the merged table. DIAMOND tables shared by several samples (gene
+    catalog) are read once. The merged table is then turned into the PLaBAse
+    tables and heatmaps without being read back.
+
+    :param samples: (sample, coverage, hits) triples, see sample_abundances
+    :param merged: merged table (Sample, ID, Count), rewritten
+    :param mode: normalisation mode of pileup files (cpm, tpm or rpkm)
+    :param index: PlabaseIndex; without it no PLaBAse tables or heatmaps are written
+    :param out_dir: output directory of the PLaBAse tables and heatmaps
+    :param jobs: number of processes used to render figures
+    :param figures: render the heatmaps (plotting libraries are only imported then)
+    :return: merged DataFrame with Sample, ID and Count columns
+    """
+    if os.path.exists(merged):
+        os.remove(merged)
+    hits_tables, tables = {}, []
+    for sample, coverage, hits in samples:
+        if not os.path.exists(coverage) or not os.path.exists(hits):
+            logging.warning(f"{sample}: {coverage if not os.path.exists(coverage) else hits} not found, skipped")
+            continue
+        if hits not in hits_tables:
+            # Only the last DIAMOND table is kept: the samples of a gene catalog share it
+            hits_tables = {hits: read_hits(hits)}
+        table = join_abundance(sample_abundances(sample, coverage, mode), hits_tables[hits], sample)
+        write_merged(table, merged)
+        tables.append(table)
+        logging.info(f"{sample}: {len(table)} annotated genes")
+    if not os.path.exists(merged):
+        write_merged(pd.DataFrame({'Sample': [], 'ID': [], 'Count': []}), merged)
+    gene_counts = pd.concat(tables, ignore_index=True) if tables else \
+        pd.DataFrame({'Sample': pd.Series(dtype=object), 'ID': pd.Series(dtype=object),
+                      'Count': pd.Series(dtype=float)})
+
+    if index is not None:
+        write_outputs(CountMatrix.from_gene_counts(gene_counts, index), out_dir, jobs, figures)
+    return gene_counts
+
+
+def main(argv=None):
+    """Command line: post-processing of the samples of a manifest."""
+    parser = argparse.ArgumentParser(description='Gene abundances, merged table, PLaBAse tables and heatmaps '
+                                                 'of all samples in one process')
+    parser.add_argument('-m', '--manifest', required=True,
+                        help='TSV with Sample, Coverage (.pileup or .abundance) and Hits (DIAMOND output) columns')
+    parser.add_argument('-o', '--merged', required=True, help='Merged table (Sample, ID, Count) to write')
+    parser.add_argument('-a', '--abund-mode', choices=MODES, default='cpm',
+                        help='Normalisation of pileup files: cpm (default), tpm or rpkm')
+    parser.add_argument('-p', '--pathways', help='PLaBAse pathways table (with --summary: write tables and heatmaps)')
+    parser.add_argument('-S', '--summary', help='PLaBAse summary table')
+    parser.add_argument('--index', help='PLaBAse index directory (default: plabase_index next to the pathways table)')
+    parser.add_argument('-d', '--out-dir', help='Output directory of the tables and heatmaps (default: next to the merged table)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes used to render figures')
+    parser.add_argument('--no-figures', action='store_true', help='Only write the tables, skip rendering the heatmaps')
+    args = parser.parse_args(argv)
+
+    if bool(args.pathways) != bool(args.summary):
+        parser.error('--pathways and --summary go together')
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    index = None
+    if args.pathways:
+        index = load_index(args.pathways, args.summary, args.index)
+    postprocess_samples(read_manifest(args.manifest), args.merged, args.abund_mode, index,
+                        args.out_dir or os.path.dirname(os.path.abspath(args.merged)), args.jobs,
+                        not args.no_figures)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+import os
+import time
+import argparse
+import logging
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from .count_matrix import CountMatrix, combine_counts, count_arrays
+
+REGISTRY = 'samples.tsv'
+MATRIX = 'matrix.npz'
+SHARDS = 'shards'
+TABLE_HEADER = 'Sample\tID\tCount\n'
+
+
+def _read_tables(tables):
+    # Samples without hits may have no (or an empty) table
+    frames = [pd.read_csv(table, sep='\t', dtype={'Sample': str, 'ID': str}) for table in tables
+              if os.path.exists(table) and os.path.getsize(table) > 0]
+    if not frames:
+        return pd.DataFrame({'Sample': pd.Series(dtype=str), 'ID': pd.Series(dtype=str),
+                             'Count': pd.Series(dtype=np.int64)})
+    return pd.concat(frames, ignore_index=True)
+
+
+class ProjectStore:
+    """
+    Persistent store of the samples of a project
+
+    The registry (samples.tsv) lists the samples in the order they were added,
+    the rows of every sample are kept in their own shard (shards/<sample>.tsv,
+    same layout as gene_counts.txt) and the counts of all samples are kept
+    aggregated in a sparse sample x PGPT matrix (matrix.npz). Adding samples
+    only parses their own rows; the stored matrix is extended, not rebuilt.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.shards_dir = os.path.join(path, SHARDS)
+        self.registry_path = os.path.join(path, REGISTRY)
+        self.matrix_path = os.path.join(path, MATRIX)
+        os.makedirs(self.shards_dir, exist_ok=True)
+
+    def samples(self):
+        """Registered samples, in the order they were added, as {sample: (time added, rows)}."""
+        if not os.path.exists(self.registry_path):
+            return {}
+        registry = pd.read_csv(self.registry_path, sep='\t', dtype={'Sample': str, 'Added': str})
+        return {row.Sample: (row.Added, int(row.Rows)) for row in registry.itertuples(index=False)}
+
+    def shard(self, sample):
+        return os.path.join(self.shards_dir, f"{sample}.tsv")
+
+    def _write_registry(self, registry):
+        tmp = self.registry_path + '.tmp'
+        with open(tmp, 'w') as fo:
+            fo.write('Sample\tAdded\tRows\n')
+            fo.writelines(f"{sample}\t{added}\t{rows}\n" for sample, (added, rows) in registry.items())
+        os.replace(tmp, self.registry_path)
+
+    def load_counts(self):
+        """Stored (counts, PGPT IDs, samples), or None for an empty store."""
+        if not os.path.exists(self.matrix_path):
+            return None
+        with np.load(self.matrix_path) as data:
+            counts = sparse.csr_matrix((data['data'], data['indices'], data['indptr']), shape=tuple(data['shape']))
+            return counts, data['ids'].astype(object), data['samples'].astype(object)
+
+    def _save_counts(self, counts, ids, samples):
+        tmp = self.matrix_path + '.tmp.npz'
+        np.savez(tmp, data=counts.data, indices=counts.indices, indptr=counts.indptr, shape=np.array(counts.shape),
+                 ids=np.asarray(ids, dtype=str), samples=np.asarray(samples, dtype=str))
+        os.replace(tmp, self.matrix_path)
+
+    def add(self, tables, samples=None):
+        """
+        Add (or replace) samples from gene counts tables
+
+        :param tables: gene counts tables (Sample, ID, Count); missing or empty tables are skipped
+        :param samples: samples to register; samples without rows are registered with 0 rows.
+                        Default: every sample found in the tables
+        :return: list of the samples added
+        """
+        df = _read_tables(tables)
+        if samples is not None:
+            df = df[df['Sample'].isin(samples)]
+        else:
+            samples = df['Sample'].drop_duplicates().tolist()
+
+        registry = self.samples()
+        added = time.strftime('%Y-%m-%d %H:%M:%S')
+        groups = dict(tuple(df.groupby('Sample', sort=False)))
+        for sample in samples:
+            rows = groups.get(sample, df.iloc[:0])
+            rows.to_csv(self.shard(sample), sep='\t', index=False)
+            registry[sample] = (added, len(rows))
+
+        parts = []
+        stored = self.load_counts()
+        if stored is not None:
+            counts, ids, names = stored
+            kept = ~np.isin(names.astype(str), np.asarray(samples, dtype=str))
+            parts.append((counts[kept], ids, names[kept]))
+        parts.append(count_arrays(df))
+        self._save_counts(*combine_counts(parts))
+        self._write_registry(registry)
+        logging.info(f"Added {len(samples)} samples to {self.path}")
+        return list(samples)
+
+    def export(self, output):
+        """Write the rows of all registered samples, in registry order, as one gene counts table."""
+        with open(output, 'w', buffering=1 << 20) as fo:
+            fo.write(TABLE_HEADER)
+            for sample in self.samples():
+                with open(self.shard(sample)) as fi:
+                    next(fi, None)
+                    fo.writelines(fi)
+        return output
+
+    def load_matrix(self, index):
+        """CountMatrix of all stored samples."""
+        stored = self.load_counts()
+        if stored is None:
+            raise ValueError(f"{self.path} has no samples")
+        counts, ids, samples = stored
+        return CountMatrix.from_counts(counts, ids, samples, index)
+
+
+def main(argv=None):
+    """Command line: add, export and list samples."""
+    parser = argparse.ArgumentParser(description='Persistent store of the samples of a project')
+    parser.add_argument('action', choices=['add', 'export', 'list'],
+                        help='add: add samples from gene counts tables; export: write the merged gene counts table; '
+                             'list: print the registered samples')
+    parser.add_argument('-p', '--store', required=True, help='Project store directory')
+    parser.add_argument('-i', '--tables', nargs='+', default=[], help='Gene counts tables to add')
+    parser.add_argument('-s', '--samples', nargs='+', help='Samples to add (default: all samples of the tables)')
+    parser.add_argument('-o', '--output', help='Merged gene counts table (export)')
+    args = parser.parse_args(argv)
+
+    store = ProjectStore(args.store)
+    if args.action == 'add':
+        if not args.tables:
+            parser.error('add requires --tables')
+        store.add(args.tables, args.samples)
+    elif args.action == 'export':
+        if not args.output:
+            parser.error('export requires --output')
+        store.export(args.output)
+    else:
+        for sample, (added, rows) in store.samples().items():
+            print(f"{sample}\t{added}\t{rows}")
+
+
+if __name__ == "__main__":
+    main()
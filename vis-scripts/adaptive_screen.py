@@ -0,0 +1,247 @@
+import os
+import shutil
+import argparse
+import logging
+import tempfile
+import subprocess
+
+import numpy as np
+
+from compressed_io import open_file
+from count_hits import count_hits, write_counts
+from plabase_index import COLUMNS, load_index
+
+# Reads of the first chunk, and growth of every following chunk
+FIRST_CHUNK = 100000
+GROWTH = 2.0
+REPORT_HEADER = 'Sample\tReads\tReads_used\tChunks\tBray_Curtis\tConverged\n'
+
+
+def read_records(path):
+    """Yield (name, sequence) of the reads of a FASTQ or FASTA file (plain, gzip or zstd)."""
+    with open_file(path, 'rb') as fi:
+        if fi.peek(1)[:1] == b'@':
+            while True:
+                header = fi.readline()
+                if not header:
+                    return
+                sequence = fi.readline().rstrip(b'\r\n')
+                fi.readline()
+                fi.readline()
+                yield header[1:].split(None, 1)[0], sequence
+        else:
+            name, sequence = None, []
+            for line in fi:
+                if line.startswith(b'>'):
+                    if name is not None:
+                        yield name, b''.join(sequence)
+                    name, sequence = line[1:].split(None, 1)[0], []
+                else:
+                    sequence.append(line.strip())
+            if name is not None:
+                yield name, b''.join(sequence)
+
+
+def count_reads(path):
+    """Number of reads of a FASTQ or FASTA file, counted by blocks without parsing the records."""
+    with open_file(path, 'rb') as fi:
+        fastq = fi.peek(1)[:1] == b'@'
+        total = 0
+        for block in iter(lambda: fi.read(1 << 20), b''):
+            total += block.count(b'\n') if fastq else block.count(b'>')
+    # A FASTQ file without a final newline still holds a last record
+    return (total + 3) // 4 if fastq else total
+
+
+def chunk_sizes(total, first=FIRST_CHUNK, growth=GROWTH):
+    """Sizes of chunks growing by a constant factor from the first one, covering all reads."""
+    sizes, size = [], float(first)
+    while total > 0:
+        sizes.append(min(int(size), total))
+        total -= sizes[-1]
+        size *= growth
+    return sizes
+
+
+def split_reads(path, work_dir, sizes, seed=1, compress=False):
+    """
+    Distribute the reads of a file at random into FASTA chunk files of given sizes, in one pass
+
+    Chunk labels are shuffled once (one byte per read), so every chunk is a
+    uniform random sample of the reads and the chunks do not overlap.
+
+    :param compress: write the chunk files gzip-compressed
+    :return: chunk file paths
+    """
+    labels = np.repeat(np.arange(len(sizes), dtype=np.min_scalar_type(len(sizes))), sizes)
+    np.random.default_rng(seed).shuffle(labels)
+    paths = [os.path.join(work_dir, f'chunk_{i:03d}.fa' + ('.gz' if compress else '')) for i in range(len(sizes))]
+    files = [open_file(chunk, 'wb') for chunk in paths]
+    try:
+        for label, (name, sequence) in zip(memoryview(labels), read_records(path)):
+            files[label].write(b'>' + name + b'\n' + sequence + b'\n')
+    finally:
+        for fo in files:
+            fo.close()
+    return paths
+
+
+def level_profile(counts, index, level='Lv3'):
+    """Hit counts aggregated per category of an annotation level, in the category order of the index."""
+    size = len(index.meta['categories'][level])
+    if not counts:
+        return np.zeros(size)
+    _, rows = index.lookup(list(counts))
+    codes = index.codes(level, rows)
+    weights = np.fromiter(counts.values(), dtype=float, count=len(counts))
+    annotated = codes >= 0
+    return np.bincount(codes[annotated], weights[annotated], minlength=size)
+
+
+def bray_curtis(profile_a, profile_b):
+    """Bray–Curtis dissimilarity of the relative abundances of two profiles (0 identical, 1 disjoint)."""
+    total_a, total_b = profile_a.sum(), profile_b.sum()
+    if not total_a or not total_b:
+        return 1.0
+    return 0.5 * np.abs(profile_a / total_a - profile_b / total_b).sum()
+
+
+def _tee(lines, out):
+    for line in lines:
+        out.write(line)
+        yield line
+
+
+def search_chunk(command, chunk, sample, hits=None):
+    """
+    Run DIAMOND on a chunk of reads and count its hits
+
+    :param command: DIAMOND command without query and output (hits are read from stdout)
+    :param hits: open binary file the hits are copied to, or None
+    :return: dict {subject: count}
+    """
+    process = subprocess.Popen(command + ['-q', chunk], stdout=subprocess.PIPE, bufsize=1 << 20)
+    lines = process.stdout if hits is None else _tee(process.stdout, hits)
+    counts = count_hits(lines, sample).get(sample, {})
+    process.stdout.close()
+    if process.wait() != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+    return counts
+
+
+def adaptive_screen(reads, sample, output, command, index, level='Lv3', first=FIRST_CHUNK, growth=GROWTH,
+                    threshold=0.02, patience=2, seed=1, hits=None, report=None, work_dir=None,
+                    compress=False):
+    """
+    Count the hits of growing random chunks of reads until the profile converges
+
+    Reads are assigned at random to chunks growing by `growth` from `first`
+    reads, written in a single pass over the reads (the input is read once
+    more to count them). Chunks are searched with DIAMOND one after the other and their hits
+    added to the counts; after every chunk, the profile of the counts at the
+    given annotation level is compared with the previous one. The search stops
+    once their Bray–Curtis dissimilarity stays below `threshold` for `patience`
+    chunks in a row, or when all reads are searched. Counts are those of the
+    reads used, which are recorded in the report.
+
+    :param reads: FASTQ or FASTA reads (plain, gzip or zstd)
+    :param sample: sample name
+    :param output: gene counts table to append to
+    :param command: DIAMOND command without query and output options
+    :param index: PlabaseIndex
+    :param level: annotation level of the profile (Lv1-Lv5)
+    :param first: reads of the first chunk
+    :param growth: size ratio of consecutive chunks
+    :param threshold: Bray–Curtis dissimilarity under which successive profiles are considered stable
+    :param patience: number of consecutive stable chunks required to stop
+    :param seed: seed of the random split
+    :param hits: file the DIAMOND hits of the searched chunks are written to (.gz/.zst compressed), or None
+    :param report: TSV the numbers of reads are appended to, or None
+    :param work_dir: directory of the temporary chunk files (default: next to the output)
+    :param compress: write the temporary chunk files gzip-compressed
+    :return: dict with the reads, reads used, chunks searched, last dissimilarity (None after one chunk)
+             and convergence
+    """
+    total = count_reads(reads)
+    sizes = chunk_sizes(total, first, growth)
+    logging.info(f"{sample}: {total} reads in {len(sizes)} chunks of {first} reads growing {growth:g}x")
+    temp_dir = tempfile.mkdtemp(prefix=f'{sample}_chunks.', dir=work_dir or os.path.dirname(os.path.abspath(output)))
+    hits_file = open_file(hits, 'wb') if hits else None
+    counts, profile, used, stable, distance = {}, None, 0, 0, None
+    try:
+        chunks = split_reads(reads, temp_dir, sizes, seed, compress)
+        for number, (chunk, size) in enumerate(zip(chunks, sizes), 1):
+            for subject, n in search_chunk(command, chunk, sample, hits_file).items():
+                counts[subject] = counts.get(subject, 0) + n
+            os.remove(chunk)
+            used += size
+            previous, profile = profile, level_profile(counts, index, level)
+            if previous is None:
+                logging.info(f"{sample}: chunk {number}, {used} reads, {int(profile.sum())} annotated hits")
+                continue
+            distance = bray_curtis(previous, profile)
+            stable = stable + 1 if distance < threshold else 0
+            logging.info(f"{sample}: chunk {number}, {used} reads, {int(profile.sum())} annotated hits, "
+                         f"Bray–Curtis {distance:.4f}")
+            if stable >= patience:
+                break
+    finally:
+        if hits_file is not None:
+            hits_file.close()
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    converged = stable >= patience
+    result = {'reads': total, 'reads_used': used, 'chunks': number if sizes else 0,
+              'bray_curtis': distance, 'converged': converged}
+    write_counts({sample: counts}, output)
+    if report:
+        write_header = not os.path.exists(report) or os.path.getsize(report) == 0
+        with open(report, 'a') as fo:
+            if write_header:
+                fo.write(REPORT_HEADER)
+            # No dissimilarity before a second chunk
+            measured = 'NA' if distance is None else f'{distance:.4f}'
+            fo.write(f"{sample}\t{total}\t{used}\t{result['chunks']}\t{measured}\t{converged}\n")
+    logging.info(f"{sample}: {'converged' if converged else 'all reads searched'} after {used} of {total} reads "
+                 f"({used / max(total, 1):.1%})")
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Search growing random chunks of reads with DIAMOND until the PGPT profile converges',
+        usage='%(prog)s -i READS -s SAMPLE -o OUTPUT -p PATHWAYS -S SUMMARY [options] -- diamond blastx ...')
+    parser.add_argument('-i', '--reads', required=True, help='Reads (FASTQ or FASTA, optionally compressed)')
+    parser.add_argument('-s', '--sample', required=True, help='Sample name')
+    parser.add_argument('-o', '--output', required=True, help='Gene counts table to append to')
+    parser.add_argument('-p', '--pathways', required=True, help='PLaBAse pathways table')
+    parser.add_argument('-S', '--summary', required=True, help='PLaBAse summary table')
+    parser.add_argument('--index', help='PLaBAse index directory (default: next to the pathways table)')
+    parser.add_argument('-l', '--level', choices=COLUMNS[:5], default='Lv3',
+                        help='Annotation level of the profile (default: Lv3)')
+    parser.add_argument('-c', '--chunk', type=int, default=FIRST_CHUNK,
+                        help=f'Reads of the first chunk (default: {FIRST_CHUNK})')
+    parser.add_argument('-g', '--growth', type=float, default=GROWTH,
+                        help=f'Size ratio of consecutive chunks (default: {GROWTH:g})')
+    parser.add_argument('-d', '--threshold', type=float, default=0.02,
+                        help='Bray–Curtis dissimilarity of successive profiles to stop at (default: 0.02)')
+    parser.add_argument('--patience', type=int, default=2,
+                        help='Consecutive chunks under the threshold required to stop (default: 2)')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of the random split (default: 1)')
+    parser.add_argument('--hits', help='Write the DIAMOND hits of the searched chunks to this file')
+    parser.add_argument('--report', help='TSV the total and used numbers of reads are appended to')
+    parser.add_argument('--compress', action='store_true', help='Write the temporary chunk files gzip-compressed')
+    parser.add_argument('command', nargs=argparse.REMAINDER,
+                        help='DIAMOND command, after --, without -q and -o')
+    args = parser.parse_args()
+
+    command = args.command[1:] if args.command[:1] == ['--'] else args.command
+    if not command:
+        parser.error('the DIAMOND command is missing')
+    if args.chunk < 1 or args.growth < 1 or args.patience < 1:
+        parser.error('--chunk and --patience must be positive and --growth at least 1')
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    adaptive_screen(args.reads, args.sample, args.output, command, load_index(args.pathways, args.summary, args.index),
+                    args.level, args.chunk, args.growth, args.threshold, args.patience, args.seed, args.hits,
+                    args.report, compress=args.compress)
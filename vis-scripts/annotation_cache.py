@@ -0,0 +1,256 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+import logging
+
+from adaptive_screen import read_records
+
+# DIAMOND options that only change speed or memory, left out of the cache key
+PERFORMANCE_OPTIONS = {'-b', '--block-size', '-c', '--index-chunks', '-p', '--threads', '-t', '--tmpdir'}
+# Proteins looked up per query
+CHUNK = 500
+DEFAULT_SIZE_MB = 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS databases (path TEXT PRIMARY KEY, stamp TEXT NOT NULL, sha256 TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS contexts (id INTEGER PRIMARY KEY, key TEXT UNIQUE NOT NULL, description TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS annotations (
+    context INTEGER NOT NULL,
+    protein BLOB NOT NULL,
+    hits TEXT,
+    used REAL NOT NULL,
+    PRIMARY KEY (context, protein)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS annotations_used ON annotations (used);
+"""
+
+
+def protein_digest(sequence):
+    """sha256 of a protein sequence (bytes), case-insensitive."""
+    return hashlib.sha256(sequence.upper()).digest()
+
+
+def search_params(params):
+    """DIAMOND parameters as they enter the cache key: whitespace-normalised, without performance options."""
+    tokens, kept = params.split(), []
+    skip = False
+    for token in tokens:
+        if skip:
+            skip = False
+        elif token in PERFORMANCE_OPTIONS:
+            skip = True
+        else:
+            kept.append(token)
+    return ' '.join(kept)
+
+
+class AnnotationCache:
+    """
+    Persistent cache of the DIAMOND hits of protein sequences
+
+    Entries are keyed by the sha256 of the protein sequence and by a context
+    made of the checksum of the DIAMOND database and the search parameters,
+    so a protein annotated by any earlier run with the same database and
+    settings is not aligned again. Proteins without a hit are cached too.
+    The cache is a single SQLite file; once its content exceeds max_size
+    bytes, the least recently used entries are evicted.
+    """
+
+    def __init__(self, path, max_size=DEFAULT_SIZE_MB << 20):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.max_size = max_size
+        # Several samples (-j) may share the cache: wait for their writes to finish
+        self.db = sqlite3.connect(path, timeout=600)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def database_checksum(self, path):
+        """Return the sha256 of a database, memoised in the cache by (path, size, mtime)."""
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        stamp = f"{st.st_size}:{st.st_mtime_ns}"
+        row = self.db.execute('SELECT stamp, sha256 FROM databases WHERE path = ?', (path,)).fetchone()
+        if row and row[0] == stamp:
+            return row[1]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as fi:
+            for block in iter(lambda: fi.read(1 << 20), b''):
+                digest.update(block)
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO databases VALUES (?, ?, ?)', (path, stamp, digest.hexdigest()))
+        return digest.hexdigest()
+
+    def context(self, database, params):
+        """Identifier of the (database, DIAMOND parameters) context of the entries."""
+        description = json.dumps({'database': self.database_checksum(database), 'params': search_params(params)},
+                                 sort_keys=True)
+        key = hashlib.sha256(description.encode()).hexdigest()
+        with self.db:
+            self.db.execute('INSERT OR IGNORE INTO contexts (key, description) VALUES (?, ?)', (key, description))
+        return self.db.execute('SELECT id FROM contexts WHERE key = ?', (key,)).fetchone()[0]
+
+    def lookup(self, context, digests):
+        """
+        Cached hits of proteins, marked as recently used
+
+        :param digests: protein digests (protein_digest)
+        :return: dict {digest: hits} of the cached proteins; hits are the DIAMOND
+                 columns after the query ID (one line per hit), or None without a hit
+        """
+        found = {}
+        for start in range(0, len(digests), CHUNK):
+            chunk = list(digests[start:start + CHUNK])
+            found.update(self.db.execute(
+                f"SELECT protein, hits FROM annotations WHERE context = ? AND protein IN ({','.join('?' * len(chunk))})",
+                [context] + chunk))
+        if found:
+            now = time.time()
+            with self.db:
+                self.db.executemany('UPDATE annotations SET used = ? WHERE context = ? AND protein = ?',
+                                    ((now, context, digest) for digest in found))
+        return found
+
+    def store(self, context, entries):
+        """
+        Add proteins to the cache, then evict the least recently used entries if it is too large
+
+        :param entries: iterable of (digest, hits) pairs, hits as returned by lookup
+        :return: number of entries evicted
+        """
+        now = time.time()
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO annotations VALUES (?, ?, ?, ?)',
+                                ((context, digest, hits, now) for digest, hits in entries))
+        return self.evict()
+
+    def size(self):
+        """Bytes used by the cache content (free pages excluded)."""
+        pages = self.db.execute('PRAGMA page_count').fetchone()[0] - self.db.execute('PRAGMA freelist_count').fetchone()[0]
+        return pages * self.db.execute('PRAGMA page_size').fetchone()[0]
+
+    def entries(self):
+        return self.db.execute('SELECT COUNT(*) FROM annotations').fetchone()[0]
+
+    def evict(self):
+        """Delete the least recently used entries until the content is back under 90% of max_size."""
+        size = self.size()
+        if size <= self.max_size:
+            return 0
+        entries = self.entries()
+        remove = entries - int(entries * 0.9 * self.max_size / size)
+        with self.db:
+            self.db.execute('DELETE FROM annotations WHERE (context, protein) IN '
+                            '(SELECT context, protein FROM annotations ORDER BY used LIMIT ?)', (remove,))
+        return remove
+
+
+def _chunks(records, size=CHUNK):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def lookup_proteins(cache, context, query, misses, output):
+    """
+    Write the cached hits of the proteins of a query file and the proteins left to align
+
+    :param query: protein FASTA
+    :param misses: FASTA of the proteins not in the cache
+    :param output: DIAMOND tabular hits of the cached proteins, under their query names
+    :return: dict of statistics (proteins, cached, cached_hits, misses)
+    """
+    stats = {'proteins': 0, 'cached': 0, 'cached_hits': 0, 'misses': 0}
+    with open(misses, 'wb', buffering=1 << 20) as fm, open(output, 'wb', buffering=1 << 20) as fo:
+        for chunk in _chunks(read_records(query)):
+            digests = [protein_digest(sequence) for _, sequence in chunk]
+            found = cache.lookup(context, digests)
+            for (name, sequence), digest in zip(chunk, digests):
+                stats['proteins'] += 1
+                if digest not in found:
+                    stats['misses'] += 1
+                    fm.write(b'>' + name + b'\n' + sequence + b'\n')
+                    continue
+                stats['cached'] += 1
+                hits = found[digest]
+                if hits is not None:
+                    stats['cached_hits'] += 1
+                    fo.writelines(b'%s\t%s\n' % (name, line.encode()) for line in hits.split('\n'))
+    return stats
+
+
+def store_hits(cache, context, misses, hits, output):
+    """
+    Pass the DIAMOND hits of the aligned proteins through and add them to the cache
+
+    :param misses: FASTA of the proteins that were aligned; those without a hit are cached as such
+    :param hits: iterable of DIAMOND tabular lines (bytes) of these proteins
+    :param output: binary stream the hits are copied to
+    :return: dict of statistics (stored, without_hit, evicted)
+    """
+    by_query = {}
+    for line in hits:
+        output.write(line)
+        if not line.strip() or line.startswith(b'#'):
+            continue
+        query, rest = line.rstrip(b'\r\n').split(b'\t', 1)
+        by_query.setdefault(query, []).append(rest.decode())
+    output.flush()
+    stats = {'stored': 0, 'without_hit': 0}
+    entries = []
+    for name, sequence in read_records(misses):
+        found = by_query.get(name)
+        stats['stored'] += 1
+        stats['without_hit'] += found is None
+        entries.append((protein_digest(sequence), '\n'.join(found) if found is not None else None))
+    stats['evicted'] = cache.store(context, entries)
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Persistent cache of the DIAMOND hits of protein sequences')
+    subparsers = parser.add_subparsers(dest='action', required=True)
+    for action, help_text in (('lookup', 'Write the cached hits of a protein file and the proteins left to align'),
+                              ('store', 'Copy DIAMOND hits from stdin to stdout and add them to the cache'),
+                              ('stats', 'Print the number of entries and the size of the cache')):
+        subparser = subparsers.add_parser(action, help=help_text)
+        subparser.add_argument('-c', '--cache', required=True, help='Cache file (SQLite, created if missing)')
+        subparser.add_argument('--max-size', type=float, default=DEFAULT_SIZE_MB,
+                               help=f'Size limit of the cache in MB (default: {DEFAULT_SIZE_MB})')
+        if action == 'stats':
+            continue
+        subparser.add_argument('--db', required=True, help='DIAMOND database')
+        subparser.add_argument('--params', default='', help='DIAMOND parameters of the search')
+        subparser.add_argument('-q', '--query', required=True,
+                               help='Proteins (FASTA)' if action == 'lookup' else 'Proteins that were aligned (FASTA)')
+        subparser.add_argument('-n', '--name', default='', help='Name of the run in the log (sample or batch)')
+        if action == 'lookup':
+            subparser.add_argument('--misses', required=True, help='FASTA of the proteins not in the cache')
+            subparser.add_argument('-o', '--output', required=True, help='DIAMOND hits of the cached proteins')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    cache = AnnotationCache(args.cache, int(args.max_size * (1 << 20)))
+    if args.action == 'stats':
+        print(f"{cache.entries()} proteins, {cache.size() / (1 << 20):.1f} MB")
+    elif args.action == 'lookup':
+        stats = lookup_proteins(cache, cache.context(args.db, args.params), args.query, args.misses, args.output)
+        logging.info(f"{args.name}: annotation cache: {stats['proteins']} proteins, {stats['cached']} cached "
+                     f"({stats['cached_hits']} with a hit, {100 * stats['cached'] / max(stats['proteins'], 1):.1f}%), "
+                     f"{stats['misses']} to align")
+    else:
+        stats = store_hits(cache, cache.context(args.db, args.params), args.query, sys.stdin.buffer, sys.stdout.buffer)
+        logging.info(f"{args.name}: annotation cache: {stats['stored']} proteins added "
+                     f"({stats['without_hit']} without a hit), {stats['evicted']} evicted, "
+                     f"{cache.entries()} in cache ({cache.size() / (1 << 20):.1f} MB)")
+    cache.close()
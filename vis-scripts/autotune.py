@@ -0,0 +1,249 @@
+import os
+import re
+import json
+import math
+import shutil
+import struct
+import argparse
+import subprocess
+
+from compressed_io import compression
+
+GB = 1 << 30
+# Share of the available memory the plan may use
+MEMORY_HEADROOM = 0.8
+# Assumed size ratio of uncompressed to gzip/zstd-compressed inputs
+COMPRESSION_RATIO = 4.0
+# DIAMOND block sizes (-b, billions of letters) and index chunks (-c) tried, fastest first
+BLOCK_SIZES = (12.0, 8.0, 6.0, 4.0, 2.0, 1.0, 0.5)
+INDEX_CHUNKS = (1, 2, 4)
+# Memory of a DIAMOND process besides the blocks, in GB
+DIAMOND_BASE_GB = 1.0
+# Threads from which a sample gains little, so further cores go to other samples
+TARGET_THREADS = {'genome_wf': 4, 'metafast_wf': 8, 'meta_wf': 16}
+# Memory kept for MEGAHIT by every meta_wf sample, in GB
+MEGAHIT_GB = 8.0
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+# Database assignment of the workflow scripts, the one definition of the database each one searches
+DIAMOND_DB = re.compile(r'^diamond_db="\$script_dir/([^"]+)"', re.MULTILINE)
+# Header of a .dmnd file: magic number, build, format version, sequences, letters
+DMND_HEADER = struct.Struct('<QIIQQ')
+DMND_MAGIC = 0x24af8a415ee186d
+
+
+def _read(path):
+    try:
+        with open(path) as fi:
+            return fi.read().strip()
+    except OSError:
+        return None
+
+
+def workflow_database(workflow, root=ROOT):
+    """DIAMOND database searched by a workflow, as assigned to diamond_db in its script."""
+    with open(os.path.join(root, 'workflows', f'{workflow}.sh')) as fi:
+        match = DIAMOND_DB.search(fi.read())
+    if match is None:
+        raise ValueError(f'no diamond_db assignment in workflows/{workflow}.sh')
+    return os.path.join(root, match.group(1))
+
+
+def database_letters(path):
+    """
+    Residues of a DIAMOND database
+
+    Read from the header of the .dmnd file, or from `diamond dbinfo` when the
+    header is not recognised; the file size is the last resort.
+    """
+    if not os.path.exists(path):
+        return 0
+    with open(path, 'rb') as fi:
+        header = fi.read(DMND_HEADER.size)
+    if len(header) == DMND_HEADER.size:
+        magic, _, _, _, letters = DMND_HEADER.unpack(header)
+        if magic == DMND_MAGIC:
+            return letters
+    if shutil.which('diamond'):
+        try:
+            result = subprocess.run(['diamond', 'dbinfo', '-d', path], stdin=subprocess.DEVNULL,
+                                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                    universal_newlines=True, timeout=60)
+            match = re.search(r'^Letters\s*=?\s*(\d+)', result.stdout, re.MULTILINE)
+            if match:
+                return int(match.group(1))
+        except (OSError, subprocess.SubprocessError):
+            pass
+    return os.path.getsize(path)
+
+
+def available_cores():
+    """Cores this process may use: CPU affinity, limited by the cgroup CPU quota."""
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+    quota = _read('/sys/fs/cgroup/cpu.max')
+    if quota and not quota.startswith('max'):
+        limit, period = quota.split()[:2]
+        cores = min(cores, max(1, math.ceil(int(limit) / int(period))))
+    return cores
+
+
+def available_memory():
+    """Memory available to new processes in bytes: MemAvailable, limited by the cgroup memory limit."""
+    memory = None
+    meminfo = _read('/proc/meminfo')
+    if meminfo:
+        for line in meminfo.splitlines():
+            if line.startswith('MemAvailable:'):
+                memory = int(line.split()[1]) * 1024
+    if memory is None:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    limit = _read('/sys/fs/cgroup/memory.max')
+    if limit and limit != 'max':
+        used = int(_read('/sys/fs/cgroup/memory.current') or 0)
+        memory = min(memory, int(limit) - used)
+    return memory
+
+
+def data_size(path):
+    """Uncompressed size of a file in bytes, estimated for .gz and .zst files."""
+    size = os.path.getsize(path)
+    return size * COMPRESSION_RATIO if compression(path) else size
+
+
+def query_letters(workflow, path):
+    """
+    Letters DIAMOND searches for one sample input, estimated from its size
+
+    Genomes are searched as proteins (a third of their bases), reads of
+    metafast_wf as first mates (half of the FASTQ bytes are bases), and
+    meta_wf assemblies as a tenth of the bases of both mates, translated.
+    """
+    size = data_size(path)
+    if workflow == 'genome_wf':
+        return size / 3
+    if workflow == 'metafast_wf':
+        return size / 2
+    mate = os.path.join(os.path.dirname(path), os.path.basename(path).replace('_1.', '_2.'))
+    if mate != path and os.path.exists(mate):
+        size += data_size(mate)
+    return size / 2 / 10 / 3
+
+
+def diamond_memory(block_size, index_chunks, query, database):
+    """
+    Predicted peak memory of a DIAMOND run in GB
+
+    DIAMOND uses about six times the block size (in billions of letters) in
+    GB with the default four index chunks, roughly twice that with one
+    chunk. Blocks larger than both the query and the database are not filled.
+    """
+    filled = min(block_size, max(query, database) / 1e9)
+    return DIAMOND_BASE_GB + filled * (4 + 8 / index_chunks)
+
+
+def job_memory(workflow, block_size, index_chunks, query, database):
+    """Predicted peak memory of one sample of a workflow in GB."""
+    memory = diamond_memory(block_size, index_chunks, query, database)
+    if workflow == 'meta_wf':
+        memory = max(memory, MEGAHIT_GB)
+    return memory
+
+
+def plan(workflow, inputs, database, cores=None, memory=None, max_threads=None, batch=False):
+    """
+    Choose the samples run at once, their threads and the DIAMOND memory settings
+
+    Cores beyond the threads a sample uses well (TARGET_THREADS) go to other
+    samples. The largest block size, then the fewest index chunks, whose
+    predicted peak fits in the memory budget for all concurrent samples are
+    chosen; when nothing fits, fewer samples run at once.
+
+    :param workflow: genome_wf, metafast_wf or meta_wf
+    :param inputs: input file of every sample (genomes, or first read files)
+    :param database: DIAMOND database (.dmnd)
+    :param cores: cores to plan for (default: probed)
+    :param memory: memory to plan for in bytes (default: probed)
+    :param max_threads: upper bound of the threads used by all samples together
+    :param batch: genome_wf --batch, all genomes are searched in one DIAMOND run
+    :return: plan as a dict
+    """
+    cores = cores or available_cores()
+    if max_threads:
+        cores = min(cores, max_threads)
+    memory = memory or available_memory()
+    budget = memory / GB * MEMORY_HEADROOM
+    database_size = database_letters(database)
+    queries = [query_letters(workflow, path) for path in inputs] or [0]
+    query = sum(queries) if batch else max(queries)
+    samples = 1 if batch else max(len(inputs), 1)
+
+    # Blocks beyond the larger of the query and the database bring no speed-up
+    useful = max(query, database_size) / 1e9
+    largest = min((b for b in BLOCK_SIZES if b >= useful), default=BLOCK_SIZES[0])
+    block_sizes = [b for b in BLOCK_SIZES if b <= largest]
+
+    jobs = max(1, min(samples, cores // TARGET_THREADS[workflow]))
+    choice = None
+    while choice is None:
+        choice = next(((b, c) for b in block_sizes for c in INDEX_CHUNKS
+                       if jobs * job_memory(workflow, b, c, query, database_size) <= budget), None)
+        if choice is None and jobs == 1:
+            # Nothing fits: the most frugal settings
+            choice = (BLOCK_SIZES[-1], INDEX_CHUNKS[-1])
+        elif choice is None:
+            jobs -= 1
+    block_size, index_chunks = choice
+    threads = max(1, cores // jobs)
+    per_job = job_memory(workflow, block_size, index_chunks, query, database_size)
+    return {
+        'workflow': workflow,
+        'machine': {'cores': cores, 'memory_gb': round(memory / GB, 1), 'budget_gb': round(budget, 1)},
+        'database': {'path': database, 'gletters': round(database_size / 1e9, 3)},
+        'inputs': {'samples': len(inputs), 'query_gletters': round(query / 1e9, 3), 'batch': batch},
+        'jobs': jobs,
+        'threads': threads,
+        'total_threads': jobs * threads,
+        'diamond': {'block_size': block_size, 'index_chunks': index_chunks,
+                    'options': f'-b {block_size:g} -c {index_chunks}'},
+        'memory': {'per_job_gb': round(per_job, 1), 'peak_gb': round(jobs * per_job, 1),
+                   'fits': jobs * per_job <= budget},
+    }
+
+
+def describe(tuned):
+    """Human-readable summary of a plan, with its predicted memory peak."""
+    machine, memory = tuned['machine'], tuned['memory']
+    lines = [
+        f"Cores: {machine['cores']}, available memory: {machine['memory_gb']} GB (budget {machine['budget_gb']} GB)",
+        f"Database: {os.path.basename(tuned['database']['path'])}, {tuned['database']['gletters']} billion letters",
+        f"Inputs: {tuned['inputs']['samples']} samples, up to {tuned['inputs']['query_gletters']} billion "
+        f"letters searched per DIAMOND run",
+        f"Plan: {tuned['jobs']} samples at a time x {tuned['threads']} threads, "
+        f"DIAMOND {tuned['diamond']['options']}",
+        f"Predicted memory peak: {tuned['jobs']} x {memory['per_job_gb']} GB = {memory['peak_gb']} GB",
+    ]
+    if not memory['fits']:
+        lines.append('Warning: the predicted peak exceeds the memory budget even with the smallest settings')
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Plan threads, concurrent samples and DIAMOND memory settings '
+                                                 'from the cores, memory, database and input sizes')
+    parser.add_argument('-w', '--workflow', choices=TARGET_THREADS, required=True, help='Workflow')
+    parser.add_argument('-i', '--inputs', nargs='*', default=[], help='Input file of every sample')
+    parser.add_argument('-d', '--database', help='DIAMOND database (default: the one of the workflow in database/)')
+    parser.add_argument('-t', '--max-threads', type=int, help='Use at most this many threads')
+    parser.add_argument('--cores', type=int, help='Cores to plan for (default: probed)')
+    parser.add_argument('--memory', type=float, help='Memory to plan for, in GB (default: probed)')
+    parser.add_argument('--batch', action='store_true', help='genome_wf --batch: one DIAMOND run for all genomes')
+    parser.add_argument('-o', '--output', help='Write the plan to this JSON file')
+    parser.add_argument('--dry-run', action='store_true', help='Only print the plan and its predicted memory peak')
+    args = parser.parse_args()
+
+    database = args.database or workflow_database(args.workflow)
+    tuned = plan(args.workflow, args.inputs, database, args.cores, args.memory * GB if args.memory else None,
+                 args.max_threads, args.batch)
+    print(describe(tuned))
+    if args.output and not args.dry_run:
+        with open(args.output, 'w') as fo:
+            json.dump(tuned, fo, indent=2)
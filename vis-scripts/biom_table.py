@@ -0,0 +1,9 @@
+"""BIOM tables of a count matrix; re-exports pgpg_finder.biom_table."""
+import os
+import sys
+
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if _root not in sys.path:
+    sys.path.insert(0, _root)
+
+from pgpg_finder.biom_table import *  # noqa: F401,F403
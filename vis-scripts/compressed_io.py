@@ -0,0 +1,13 @@
+"""Plain, gzip and zstd file I/O; wrapper of pgpg_finder.compressed_io."""
+import os
+import sys
+
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if _root not in sys.path:
+    sys.path.insert(0, _root)
+
+from pgpg_finder.compressed_io import *  # noqa: F401,F403
+from pgpg_finder.compressed_io import main
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+import os
+import sys
+import argparse
+import logging
+from collections import OrderedDict
+
+from compressed_io import open_file
+
+# Number of recent fragments remembered when collapsing mates (mates are
+# normally adjacent in DIAMOND output, the window only covers reordering)
+PAIR_WINDOW = 100000
+MATE_SUFFIXES = (b'/1', b'/2', b'/s')
+
+
+def read_multiplicity(path):
+    """
+    Read the multiplicity table of deduplicated queries (dedup_queries.py)
+
+    :return: dict {query: [(sample, copies), ...]} and the samples in input order (bytes)
+    """
+    table, samples = {}, []
+    with open_file(path, 'rb') as fi:
+        for line in fi:
+            if line.startswith(b'# samples\t'):
+                samples = line.rstrip(b'\r\n').split(b'\t')[1:]
+            if line.startswith(b'#') or line.startswith(b'Query\t'):
+                continue
+            query, sample, copies = line.rstrip(b'\r\n').split(b'\t')
+            table.setdefault(query, []).append((sample, int(copies)))
+    return table, samples
+
+
+def count_hits(hits, sample=None, tag_sep=None, pairs=False, multiplicity=None):
+    """
+    Count DIAMOND hits per sample and subject ID in a single pass
+
+    Only one counter per distinct (sample, subject) pair is kept in memory, so
+    memory does not grow with the number of hits.
+
+    :param hits: iterable of DIAMOND tabular lines (bytes)
+    :param sample: sample name of all hits (ignored when tag_sep is given)
+    :param tag_sep: separator of the "<sample><sep>" tag of the query IDs (batched runs)
+    :param pairs: count each read pair once; queries named <fragment>/1, /2 or /s
+                  (stream_reads.py) are collapsed to the best-scoring hit of the fragment
+    :param multiplicity: (table, samples) of deduplicated queries as returned by read_multiplicity; the hits
+                         of a query in the table count once for every copy of its sequence in every sample
+    :return: dict {sample: {subject: count}}, samples in order of appearance
+    """
+    if pairs and multiplicity is not None:
+        raise ValueError('read pairs cannot be counted from deduplicated queries')
+    counts = {}
+    table = {}
+    if multiplicity is not None:
+        # Samples in input order, as without deduplication, even those whose queries all have copies elsewhere
+        table, samples = multiplicity
+        for key in samples:
+            counts[key] = {}
+    sample_key = sample.encode() if sample is not None else b''
+    sample_counts = counts.setdefault(sample_key, {}) if tag_sep is None else None
+    sep = tag_sep.encode() if tag_sep is not None else None
+    recent = OrderedDict()
+    for line in hits:
+        if not line.strip() or line.startswith(b'#'):
+            continue
+        fields = line.split(b'\t') if pairs else line.split(b'\t', 2)
+        subject = fields[1].strip()
+        copies = table.get(fields[0]) if table else None
+        if copies is not None:
+            for key, n in copies:
+                subjects = counts.setdefault(key, {})
+                subjects[subject] = subjects.get(subject, 0) + n
+            continue
+        if sep is not None:
+            sample_key = fields[0].split(sep, 1)[0]
+            sample_counts = counts.get(sample_key)
+            if sample_counts is None:
+                sample_counts = counts[sample_key] = {}
+        if pairs:
+            query = fields[0]
+            fragment = (sample_key, query[:-2] if query[-2:] in MATE_SUFFIXES else query)
+            score = float(fields[11]) if len(fields) > 11 else 0.0
+            previous = recent.pop(fragment, None)
+            if previous is not None:
+                # Second mate of a fragment already counted: keep only the best hit
+                if score > previous[1]:
+                    sample_counts[previous[0]] -= 1
+                    sample_counts[subject] = sample_counts.get(subject, 0) + 1
+                continue
+            recent[fragment] = (subject, score)
+            if len(recent) > PAIR_WINDOW:
+                recent.popitem(last=False)
+        sample_counts[subject] = sample_counts.get(subject, 0) + 1
+    return {key.decode(): {subject.decode(): n for subject, n in subjects.items() if n > 0}
+            for key, subjects in counts.items()}
+
+
+def write_counts(counts, output):
+    """
+    Append counts to a Sample/ID/Count table with a single bulk write
+
+    :param counts: dict {sample: {subject: count}} as returned by count_hits
+    :param output: gene counts table; the header is written if the file is new or empty
+    :return: number of rows written
+    """
+    rows = []
+    for sample, subjects in counts.items():
+        for subject in sorted(subjects):
+            rows.append(f"{sample}\t{subject}\t{subjects[subject]}\n")
+    write_header = not os.path.exists(output) or os.path.getsize(output) == 0
+    with open(output, 'a', buffering=1 << 20) as fo:
+        if write_header:
+            fo.write("Sample\tID\tCount\n")
+        fo.writelines(rows)
+    return len(rows)
+
+
+def count_hits_to_table(inputs, output, sample=None, tag_sep=None, pairs=False, multiplicity=None):
+    """
+    Count the hits of DIAMOND tabular files (or of stdin, given as '-') into a gene counts table
+
+    :param inputs: list of DIAMOND output files, '-' reads the hits from stdin
+    :param output: gene counts table (Sample, ID, Count)
+    :param sample: sample name of the hits
+    :param tag_sep: derive the sample from the query ID prefix before this separator
+    :param pairs: count each read pair once
+    :param multiplicity: multiplicity table of deduplicated queries, or None
+    :return: None
+    """
+    logging.info('Counting DIAMOND hits')
+    counts = {}
+    if multiplicity is not None:
+        multiplicity = read_multiplicity(multiplicity)
+    for path in inputs:
+        if path == '-':
+            file_counts = count_hits(sys.stdin.buffer, sample, tag_sep, pairs, multiplicity)
+        else:
+            with open_file(path, 'rb') as fi:
+                file_counts = count_hits(fi, sample, tag_sep, pairs, multiplicity)
+        for key, subjects in file_counts.items():
+            merged = counts.setdefault(key, {})
+            for subject, n in subjects.items():
+                merged[subject] = merged.get(subject, 0) + n
+    write_counts(counts, output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Count DIAMOND hits per sample and subject ID')
+    parser.add_argument('-i', '--input', nargs='+', default=['-'],
+                        help="DIAMOND tabular output files ('-' or nothing reads from stdin)")
+    parser.add_argument('-s', '--sample', help='Sample name of the hits')
+    parser.add_argument('--tag-sep', help='Take the sample name from the query ID prefix before this separator')
+    parser.add_argument('--pairs', action='store_true',
+                        help='Count each read pair once (queries named <fragment>/1, /2 or /s)')
+    parser.add_argument('-m', '--multiplicity',
+                        help='Multiplicity table of deduplicated queries (dedup_queries.py): hits count for every copy')
+    parser.add_argument('-o', '--output', required=True, help='Gene counts table to append to')
+    args = parser.parse_args()
+
+    if args.sample is None and args.tag_sep is None:
+        parser.error('one of --sample or --tag-sep is required')
+    if args.pairs and args.multiplicity:
+        parser.error('--pairs cannot be combined with --multiplicity')
+    count_hits_to_table(args.input, args.output, args.sample, args.tag_sep, args.pairs, args.multiplicity)
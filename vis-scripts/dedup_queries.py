@@ -0,0 +1,121 @@
+import os
+import hashlib
+import argparse
+import logging
+
+import numpy as np
+
+from compressed_io import open_file
+from adaptive_screen import read_records
+
+DIGEST_SIZE = 16
+REPORT_HEADER = ('Run\tSequences\tUnique\tDedup_ratio\tLetters\tUnique_letters\tDIAMOND_seconds\t'
+                 'Estimated_seconds_saved\n')
+
+
+def dedup_queries(query, unique, multiplicity, sample=None, tag_sep=None):
+    """
+    Write the distinct sequences of a query file and the copies each one stands for
+
+    Sequences are hashed (128-bit BLAKE2b) in a first pass and grouped with
+    numpy, so memory holds a digest per sequence rather than the sequences.
+    The first sequence of every group is written to the unique FASTA under
+    its own name. The multiplicity table lists, for each written sequence
+    with copies, the number of copies per sample; sequences without copies
+    are left out and count once for their own sample.
+
+    :param query: FASTA or FASTQ file (proteins or reads)
+    :param unique: output FASTA of the distinct sequences
+    :param multiplicity: output table (Query, Sample, Copies)
+    :param sample: sample of all sequences
+    :param tag_sep: take the sample from the name prefix before this separator (batched runs)
+    :return: dict of statistics (sequences, unique, letters, unique_letters)
+    """
+    digests = bytearray()
+    sample_codes, lengths, samples = [], [], {}
+    for name, sequence in read_records(query):
+        digests += hashlib.blake2b(sequence, digest_size=DIGEST_SIZE).digest()
+        lengths.append(len(sequence))
+        key = name.split(tag_sep.encode(), 1)[0] if tag_sep else sample.encode()
+        sample_codes.append(samples.setdefault(key, len(samples)))
+    total = len(sample_codes)
+    keys = np.frombuffer(bytes(digests), dtype=f'V{DIGEST_SIZE}')
+    _, first, group, copies = np.unique(keys, return_index=True, return_inverse=True, return_counts=True)
+    group = group.reshape(-1)
+    representative = np.zeros(total, dtype=bool)
+    representative[first] = True
+    lengths = np.asarray(lengths, dtype=np.int64)
+    stats = {'sequences': total, 'unique': len(first), 'letters': int(lengths.sum()),
+             'unique_letters': int(lengths[first].sum())}
+
+    # Copies of every (group, sample) pair, for the groups with more than one sequence
+    codes = np.asarray(sample_codes, dtype=np.int64)
+    repeated = copies[group] > 1
+    pairs, pair_copies = np.unique(group[repeated] * max(len(samples), 1) + codes[repeated], return_counts=True)
+    by_group = {}
+    for pair, n in zip(pairs.tolist(), pair_copies.tolist()):
+        by_group.setdefault(pair // len(samples), []).append((pair % len(samples), n))
+    sample_names = [key.decode() for key in samples]
+
+    with open(unique, 'wb', buffering=1 << 20) as fo, open(multiplicity, 'w', buffering=1 << 20) as fm:
+        fm.write('# ' + ' '.join(f'{name}={value}' for name, value in stats.items()) + '\n')
+        fm.write('\t'.join(['# samples'] + sample_names) + '\n')
+        fm.write('Query\tSample\tCopies\n')
+        for index, (name, sequence) in enumerate(read_records(query)):
+            if not representative[index]:
+                continue
+            fo.write(b'>' + name + b'\n' + sequence + b'\n')
+            for code, n in by_group.get(group[index], ()):
+                fm.write(f"{name.decode()}\t{sample_names[code]}\t{n}\n")
+    logging.info(f"{total} sequences, {len(first)} unique ({total / max(len(first), 1):.2f}x)")
+    return stats
+
+
+def read_stats(multiplicity):
+    """Statistics of a dedup run, from the first line of its multiplicity table."""
+    with open_file(multiplicity, 'r') as fi:
+        return {name: int(value) for name, value in (field.split('=') for field in fi.readline()[1:].split())}
+
+
+def write_report(multiplicity, run, seconds, output):
+    """
+    Append the dedup ratio and the estimated DIAMOND time saved of a run to a report
+
+    DIAMOND time grows with the query letters, so the time saved is estimated
+    as the time of the unique search scaled by the letters left out.
+    """
+    stats = read_stats(multiplicity)
+    saved = seconds * (stats['letters'] / max(stats['unique_letters'], 1) - 1)
+    write_header = not os.path.exists(output) or os.path.getsize(output) == 0
+    with open(output, 'a') as fo:
+        if write_header:
+            fo.write(REPORT_HEADER)
+        fo.write(f"{run}\t{stats['sequences']}\t{stats['unique']}\t{stats['sequences'] / max(stats['unique'], 1):.3f}\t"
+                 f"{stats['letters']}\t{stats['unique_letters']}\t{seconds:.1f}\t{saved:.1f}\n")
+    logging.info(f"{run}: {stats['sequences']} queries, {stats['unique']} unique "
+                 f"({stats['sequences'] / max(stats['unique'], 1):.2f}x), about {saved:.0f} s of DIAMOND saved")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Search only distinct query sequences with DIAMOND')
+    subparsers = parser.add_subparsers(dest='action', required=True)
+    dedup_parser = subparsers.add_parser('dedup', help='Write the distinct sequences and their multiplicity table')
+    dedup_parser.add_argument('-i', '--input', required=True, help='Proteins or reads (FASTA or FASTQ)')
+    dedup_parser.add_argument('-o', '--output', required=True, help='FASTA of the distinct sequences')
+    dedup_parser.add_argument('-m', '--multiplicity', required=True, help='Multiplicity table (TSV)')
+    dedup_parser.add_argument('-s', '--sample', help='Sample name of the sequences')
+    dedup_parser.add_argument('--tag-sep', help='Take the sample name from the name prefix before this separator')
+    report_parser = subparsers.add_parser('report', help='Append the dedup ratio and time saved to a report')
+    report_parser.add_argument('-m', '--multiplicity', required=True, help='Multiplicity table of the run')
+    report_parser.add_argument('-n', '--name', required=True, help='Name of the run (sample or batch)')
+    report_parser.add_argument('--seconds', type=float, required=True, help='Wall time of the DIAMOND search')
+    report_parser.add_argument('-o', '--output', required=True, help='Report (TSV) to append to')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    if args.action == 'dedup':
+        if args.sample is None and args.tag_sep is None:
+            parser.error('one of --sample or --tag-sep is required')
+        dedup_queries(args.input, args.output, args.multiplicity, args.sample, args.tag_sep)
+    else:
+        write_report(args.multiplicity, args.name, args.seconds, args.output)
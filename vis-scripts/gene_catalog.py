@@ -0,0 +1,224 @@
+import os
+import csv
+import shutil
+import hashlib
+import argparse
+import logging
+import subprocess
+
+import pandas as pd
+
+from compressed_io import open_file
+
+CATALOG_GENES = 'catalog.ffn'
+CATALOG_PROTEINS = 'catalog.faa'
+CLUSTERS = 'clusters.tsv'
+# Separator of the "<sample><sep><gene>" names of pooled genes
+TAG_SEP = '|'
+
+
+def read_fasta(path):
+    """Yield (header line, sequence) of a FASTA file; the header keeps its '>' and comment."""
+    header, sequence = None, []
+    with open_file(path, 'rb') as fi:
+        for line in fi:
+            if line.startswith(b'>'):
+                if header is not None:
+                    yield header, b''.join(sequence)
+                header, sequence = line.rstrip(b'\r\n'), []
+            else:
+                sequence.append(line.strip())
+    if header is not None:
+        yield header, b''.join(sequence)
+
+
+def _name(header):
+    return header[1:].split(None, 1)[0]
+
+
+def pool_genes(genes, samples, output):
+    """
+    Write the genes of all samples to one FASTA, named <sample>|<gene>
+
+    :return: number of genes written
+    """
+    pooled = 0
+    with open(output, 'wb', buffering=1 << 20) as fo:
+        for path, sample in zip(genes, samples):
+            tag = sample.encode() + TAG_SEP.encode()
+            for header, sequence in read_fasta(path):
+                fo.write(b'>' + tag + header[1:] + b'\n' + sequence + b'\n')
+                pooled += 1
+    return pooled
+
+
+def dereplicate_exact(pooled, catalog, clusters):
+    """
+    Keep the first gene of every distinct nucleotide sequence
+
+    :return: set of the names of the representative genes
+    """
+    first = {}
+    representatives = set()
+    with open(catalog, 'wb', buffering=1 << 20) as fo, open(clusters, 'w', buffering=1 << 20) as fc:
+        fc.write('Gene\tRepresentative\n')
+        for header, sequence in read_fasta(pooled):
+            name = _name(header)
+            digest = hashlib.sha1(sequence.upper()).digest()
+            representative = first.get(digest)
+            if representative is None:
+                representative = first[digest] = name
+                representatives.add(name)
+                fo.write(header + b'\n' + sequence + b'\n')
+            fc.write(f"{name.decode()}\t{representative.decode()}\n")
+    return representatives
+
+
+def _word_size(identity):
+    # Word sizes recommended by CD-HIT-EST for each identity threshold
+    for threshold, word in ((0.95, 10), (0.90, 8), (0.88, 7), (0.85, 6), (0.80, 5)):
+        if identity >= threshold:
+            return word
+    return 4
+
+
+def dereplicate_cdhit(pooled, catalog, clusters, identity=0.95, coverage=0.9, threads=1):
+    """
+    Cluster the genes with CD-HIT-EST and keep the representative of every cluster
+
+    :return: set of the names of the representative genes
+    """
+    command = ['cd-hit-est', '-i', pooled, '-o', catalog, '-c', str(identity), '-aS', str(coverage),
+               '-n', str(_word_size(identity)), '-T', str(threads), '-M', '0', '-d', '0']
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+
+    representatives = set()
+    with open(catalog + '.clstr', 'rb') as fi, open(clusters, 'w', buffering=1 << 20) as fc:
+        fc.write('Gene\tRepresentative\n')
+        members, representative = [], None
+
+        def flush():
+            fc.writelines(f"{member.decode()}\t{representative.decode()}\n" for member in members)
+
+        for line in fi:
+            if line.startswith(b'>Cluster'):
+                if members:
+                    flush()
+                members, representative = [], None
+                continue
+            name = line.split(b'>', 1)[1].split(b'...', 1)[0]
+            members.append(name)
+            if line.rstrip().endswith(b'*'):
+                representative = name
+                representatives.add(name)
+        if members:
+            flush()
+    return representatives
+
+
+def write_proteins(proteins, samples, representatives, output):
+    """Write the proteins of the representative genes, named like the catalog genes."""
+    with open(output, 'wb', buffering=1 << 20) as fo:
+        for path, sample in zip(proteins, samples):
+            tag = sample.encode() + TAG_SEP.encode()
+            for header, sequence in read_fasta(path):
+                if tag + _name(header) in representatives:
+                    fo.write(b'>' + tag + header[1:] + b'\n' + sequence + b'\n')
+
+
+def build_catalog(genes, proteins, samples, out_dir, identity=0.95, coverage=0.9, threads=1):
+    """
+    Build a non-redundant gene catalog from the genes predicted in several samples
+
+    Genes of all samples are pooled as <sample>|<gene> and dereplicated: with
+    CD-HIT-EST when it is installed and identity < 1, otherwise by exact
+    nucleotide sequence. The catalog holds the nucleotide (catalog.ffn) and
+    protein (catalog.faa) sequences of the representatives, and clusters.tsv
+    maps every pooled gene to its representative.
+
+    :param genes: nucleotide gene files (.ffn), one per sample
+    :param proteins: protein files (.faa), one per sample, with the same gene names
+    :param samples: sample names
+    :param out_dir: catalog directory
+    :param identity: minimum nucleotide identity of a gene to its representative
+    :param coverage: minimum fraction of the shorter gene covered by the alignment (CD-HIT-EST)
+    :param threads: CD-HIT-EST threads
+    :return: (number of pooled genes, number of catalog genes)
+    """
+    tagged = [sample for sample in samples if TAG_SEP in sample]
+    if tagged:
+        # The separator splits pooled names back into sample and gene
+        raise ValueError(f"sample names must not contain '{TAG_SEP}': {', '.join(tagged)}")
+    os.makedirs(out_dir, exist_ok=True)
+    pooled = os.path.join(out_dir, 'pooled.ffn')
+    catalog = os.path.join(out_dir, CATALOG_GENES)
+    clusters = os.path.join(out_dir, CLUSTERS)
+    try:
+        total = pool_genes(genes, samples, pooled)
+        if identity < 1.0 and shutil.which('cd-hit-est'):
+            logging.info(f"Clustering {total} genes with CD-HIT-EST at {identity:.0%} identity")
+            representatives = dereplicate_cdhit(pooled, catalog, clusters, identity, coverage, threads)
+        else:
+            if identity < 1.0:
+                logging.warning('cd-hit-est is not installed, dereplicating identical genes only')
+            representatives = dereplicate_exact(pooled, catalog, clusters)
+    finally:
+        if os.path.exists(pooled):
+            os.remove(pooled)
+    write_proteins(proteins, samples, representatives, os.path.join(out_dir, CATALOG_PROTEINS))
+    logging.info(f"Gene catalog: {len(representatives)} genes from {total} "
+                 f"({total / max(len(representatives), 1):.2f}x redundancy)")
+    return total, len(representatives)
+
+
+def abundance_matrix(abundance_files, samples, output):
+    """
+    Write the catalog gene x sample abundance matrix
+
+    Samples are mapped against the same catalog, so their abundances are
+    comparable gene by gene. Genes without abundance in any sample are left out.
+    """
+    columns = []
+    for path, sample in zip(abundance_files, samples):
+        with open_file(path, 'rb') as fi:
+            column = pd.read_csv(fi, sep='\t', index_col=0, dtype={'#ID': str}, quoting=csv.QUOTE_NONE)
+        columns.append(column.iloc[:, 0].rename(sample))
+    matrix = pd.concat(columns, axis=1).fillna(0.0)
+    matrix = matrix[(matrix > 0).any(axis=1)]
+    matrix.index.name = 'Gene'
+    matrix.to_csv(output, sep='\t')
+    return matrix.shape
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Non-redundant gene catalog of several samples')
+    subparsers = parser.add_subparsers(dest='action', required=True)
+    build_parser = subparsers.add_parser('build', help='Pool and dereplicate the genes of several samples')
+    build_parser.add_argument('-g', '--genes', nargs='+', required=True, help='Nucleotide gene files (.ffn)')
+    build_parser.add_argument('-p', '--proteins', nargs='+', required=True, help='Protein files (.faa), same order')
+    build_parser.add_argument('-s', '--samples', nargs='+', required=True, help='Sample names, same order')
+    build_parser.add_argument('-o', '--output', required=True, help='Catalog directory')
+    build_parser.add_argument('-c', '--identity', type=float, default=0.95,
+                              help='Minimum identity to a representative (default: 0.95). Without cd-hit-est, '
+                                   'only identical genes are merged')
+    build_parser.add_argument('--coverage', type=float, default=0.9,
+                              help='Minimum alignment coverage of the shorter gene (default: 0.9)')
+    build_parser.add_argument('-t', '--threads', type=int, default=1, help='Number of threads')
+    matrix_parser = subparsers.add_parser('matrix', help='Gene x sample abundance matrix of the catalog')
+    matrix_parser.add_argument('-a', '--abundance', nargs='+', required=True, help='.abundance files')
+    matrix_parser.add_argument('-s', '--samples', nargs='+', required=True, help='Sample names, same order')
+    matrix_parser.add_argument('-o', '--output', required=True, help='Output matrix (TSV)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    if args.action == 'build':
+        if not len(args.genes) == len(args.proteins) == len(args.samples):
+            parser.error('--genes, --proteins and --samples must have the same length')
+        if any(TAG_SEP in sample for sample in args.samples):
+            parser.error(f"sample names must not contain '{TAG_SEP}'")
+        build_catalog(args.genes, args.proteins, args.samples, args.output, args.identity, args.coverage,
+                      args.threads)
+    else:
+        if len(args.abundance) != len(args.samples):
+            parser.error('--abundance and --samples must have the same length')
+        abundance_matrix(args.abundance, args.samples, args.output)
@@ -0,0 +1,304 @@
+import os
+import argparse
+import logging
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from compressed_io import open_file
+from gene_relative_abundance import MODES, normalise, write_abundance
+
+# 2-bit code of every byte: A/C/G/T (any case) are 0-3, anything else (N, separators) is 4
+BASE_CODE = np.full(256, 4, dtype=np.uint8)
+for _base, _code in zip(b'ACGT', range(4)):
+    BASE_CODE[_base] = BASE_CODE[_base + 32] = _code
+# Reads parsed per batch; a batch is one unit of work for a thread
+BATCH_READS = 20000
+# Gene value of k-mers that are absent from the index or shared by several genes
+ABSENT = -2
+SHARED = -1
+HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+
+def encode_kmers(sequence, k):
+    """
+    Canonical k-mers of every position of a sequence as 2-bit packed integers
+
+    Windows are built by doubling (k = 1, 2, 4 ... bases) and joining the
+    blocks of the binary decomposition of k, in O(log k) array passes.
+
+    :param sequence: bytes; k-mers overlapping non-ACGT bytes are invalid, so
+                     several sequences can be joined with b'N'
+    :param k: k-mer size (up to 31)
+    :return: (uint64 array of canonical k-mers, bool array of valid positions)
+    """
+    codes = BASE_CODE[np.frombuffer(sequence, dtype=np.uint8)]
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=bool)
+    invalid = np.concatenate(([0], np.cumsum(codes > 3)))
+    valid = invalid[k:] == invalid[:n]
+
+    # Forward and reverse complement values of the windows of `size` bases at every position
+    block = (codes & 3).astype(np.uint64)
+    block_rc = 3 - block
+    size = 1
+    forward = reverse = None
+    done = 0
+    while True:
+        if k & size:
+            if forward is None:
+                forward, reverse = block, block_rc
+            else:
+                m = len(block) - done
+                forward = (forward[:m] << (2 * size)) | block[done:]
+                reverse = (block_rc[done:] << (2 * done)) | reverse[:m]
+            done += size
+        if 2 * size > k:
+            break
+        m = len(block) - size
+        block, block_rc = (block[:m] << (2 * size)) | block[size:], (block_rc[size:] << (2 * size)) | block_rc[:m]
+        size *= 2
+    return np.minimum(forward[:n], reverse[:n]), valid
+
+
+def _segments(lengths, positions):
+    # Index of the sequence of every position of sequences joined with one separator byte
+    starts = np.cumsum(lengths + 1) - (lengths + 1)
+    return np.searchsorted(starts, positions, side='right') - 1
+
+
+class KmerIndex:
+    """
+    Hash table of the canonical k-mers of a set of genes, backed by numpy arrays
+
+    Every k-mer is stored once with the gene it belongs to, or SHARED when it
+    occurs in several genes. K-mers are grouped by hash bucket in one uint64
+    array, with the start of every bucket in an offsets array (about one
+    bucket per k-mer), so the index takes about 20 bytes per distinct k-mer
+    and lookups are vectorised over whole batches of reads.
+    """
+
+    def __init__(self, ids, sequences, k=31):
+        self.k = k
+        self.ids = ids
+        self.length = np.array([len(sequence) for sequence in sequences], dtype=np.float64)
+        kmers, valid = encode_kmers(b'N'.join(sequences), k)
+        positions = np.flatnonzero(valid)
+        genes = _segments(self.length.astype(np.int64), positions).astype(np.int32)
+        kmers = kmers[positions]
+
+        order = np.argsort(kmers, kind='stable')
+        kmers, genes = kmers[order], genes[order]
+        first = np.flatnonzero(np.concatenate(([True], kmers[1:] != kmers[:-1]))) if len(kmers) else positions
+        lowest = np.minimum.reduceat(genes, first) if len(first) else genes
+        highest = np.maximum.reduceat(genes, first) if len(first) else genes
+        kmers = kmers[first]
+        genes = np.where(lowest == highest, lowest, SHARED).astype(np.int32)
+
+        self.shift = np.uint64(64 - max(1, int(len(kmers)).bit_length()))
+        bucket = self._bucket(kmers)
+        order = np.argsort(bucket, kind='stable')
+        self.kmers, self.genes = kmers[order], genes[order]
+        buckets = 1 << (64 - int(self.shift))
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(bucket, minlength=buckets))))
+
+    def _bucket(self, kmers):
+        # Multiplicative (Fibonacci) hashing: the top bits of kmer * 2^64 / golden ratio
+        return ((kmers * HASH_MULTIPLIER) >> self.shift).astype(np.int64)
+
+    def lookup(self, kmers):
+        """Gene of every k-mer: its index in ids, SHARED or ABSENT."""
+        bucket = self._bucket(kmers)
+        start, end = self.offsets[bucket], self.offsets[bucket + 1]
+        result = np.full(len(kmers), ABSENT, dtype=np.int32)
+        # Probe the entries of the buckets, all k-mers at once, until found or bucket exhausted
+        active = np.flatnonzero(start < end)
+        slot = start[active]
+        while len(active):
+            found = self.kmers[slot] == kmers[active]
+            result[active[found]] = self.genes[slot[found]]
+            slot += 1
+            remaining = ~found & (slot < end[active])
+            active, slot = active[remaining], slot[remaining]
+        return result
+
+
+def read_fasta(path, selected=None):
+    """(ID, sequence) pairs of a FASTA file, only the IDs in selected when given."""
+    name, sequence = None, []
+    with open_file(path, 'rb') as fi:
+        for line in fi:
+            if line.startswith(b'>'):
+                if name is not None and (selected is None or name in selected):
+                    yield name.decode(), b''.join(sequence)
+                name, sequence = line[1:].split(None, 1)[0], []
+            else:
+                sequence.append(line.strip())
+    if name is not None and (selected is None or name in selected):
+        yield name.decode(), b''.join(sequence)
+
+
+def hit_genes(diamond_file):
+    """IDs of the genes with a DIAMOND hit (first column of the tabular output)."""
+    genes = set()
+    with open_file(diamond_file, 'rb') as fi:
+        for line in fi:
+            if line[:1] != b'#' and line.strip():
+                genes.add(line.split(b'\t', 1)[0])
+    return genes
+
+
+def read_batches(path, size=BATCH_READS):
+    """Yield lists of the read sequences of a FASTQ or FASTA file (plain, gzip or zstd)."""
+    with open_file(path, 'rb') as fi:
+        if fi.peek(1)[:1] == b'@':
+            while True:
+                lines = list(islice(fi, 4 * size))
+                if not lines:
+                    return
+                yield [line.rstrip() for line in lines[1::4]]
+        else:
+            batch, sequence = [], []
+            for line in fi:
+                if line.startswith(b'>'):
+                    if sequence:
+                        batch.append(b''.join(sequence))
+                        sequence = []
+                        if len(batch) == size:
+                            yield batch
+                            batch = []
+                else:
+                    sequence.append(line.strip())
+            if sequence:
+                batch.append(b''.join(sequence))
+            if batch:
+                yield batch
+
+
+def assign_reads(index, batch, paired=False, min_fraction=0.5):
+    """
+    Assign the fragments of a batch of reads to genes
+
+    A fragment (read or read pair) is assigned to a gene when all its k-mers
+    found in the index point to that gene only and they make up at least
+    min_fraction of its valid k-mers. Fragments that hit several genes,
+    or too few k-mers, are left out.
+
+    :param batch: read sequences; for pairs, mates are interleaved (r1, r2, r1, r2 ...)
+    :return: (fragments per gene, bases of the assigned fragments per gene)
+    """
+    genes = len(index.ids)
+    lengths = np.fromiter(map(len, batch), dtype=np.int64, count=len(batch))
+    kmers, valid = encode_kmers(b'N'.join(batch), index.k)
+    positions = np.flatnonzero(valid)
+    fragment = _segments(lengths, positions)
+    if paired:
+        fragment //= 2
+        lengths = lengths[0::2] + lengths[1::2]
+    total = np.bincount(fragment, minlength=len(lengths))
+
+    gene = index.lookup(kmers[positions])
+    hit = gene >= 0
+    fragment, gene = fragment[hit], gene[hit]
+    if not len(gene):
+        return np.zeros(genes), np.zeros(genes)
+    # Positions are in read order, so the hits of a fragment are contiguous
+    fragments, first, hits = np.unique(fragment, return_index=True, return_counts=True)
+    lowest = np.minimum.reduceat(gene, first)
+    highest = np.maximum.reduceat(gene, first)
+    assigned = (lowest == highest) & (hits >= min_fraction * total[fragments])
+    reads = np.bincount(lowest[assigned], minlength=genes).astype(np.float64)
+    bases = np.bincount(lowest[assigned], weights=lengths[fragments[assigned]], minlength=genes)
+    return reads, bases
+
+
+def _fragment_batches(reads_1, reads_2=None):
+    if reads_2 is None:
+        yield from read_batches(reads_1)
+        return
+    for batch_1, batch_2 in zip(read_batches(reads_1), read_batches(reads_2)):
+        if len(batch_1) != len(batch_2):
+            raise ValueError(f"{reads_1} and {reads_2} do not have the same number of reads")
+        batch = [None] * (2 * len(batch_1))
+        batch[0::2], batch[1::2] = batch_1, batch_2
+        yield batch
+
+
+def kmer_quant(genes_file, reads_1, basename, output_dir, reads_2=None, diamond_file=None, mode='cpm', k=31,
+               threads=1, min_fraction=0.5):
+    """
+    Estimate gene abundances by k-mer matching of reads, without read alignment
+
+    Only the genes with a DIAMOND hit are indexed, so abundances are
+    normalised over the annotated genes. Reads are processed in batches by
+    `threads` threads; the .abundance table has the same format as the one
+    of gene_relative_abundance.py.
+
+    :param genes_file: nucleotide sequences of the genes (.ffn)
+    :param reads_1: reads (FASTQ or FASTA), first mates for paired-end reads
+    :param basename: basename of the sample
+    :param output_dir: directory to output the <basename>.abundance table
+    :param reads_2: second mates, for paired-end reads
+    :param diamond_file: DIAMOND hits of the genes; None indexes all genes
+    :param mode: normalisation mode (cpm, tpm or rpkm)
+    :param k: k-mer size (up to 31)
+    :param threads: number of threads
+    :param min_fraction: minimum fraction of the k-mers of a fragment that hit its gene
+    :return: number of fragments assigned to genes
+    """
+    selected = hit_genes(diamond_file) if diamond_file else None
+    ids, sequences = [], []
+    for gene_id, sequence in read_fasta(genes_file, selected):
+        ids.append(gene_id)
+        sequences.append(sequence)
+    index = KmerIndex(ids, sequences, k)
+    del sequences
+    logging.info(f"Indexed {len(index.kmers)} {k}-mers of {len(ids)} genes")
+
+    reads = np.zeros(len(ids))
+    bases = np.zeros(len(ids))
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        pending = []
+        for batch in _fragment_batches(reads_1, reads_2):
+            pending.append(pool.submit(assign_reads, index, batch, reads_2 is not None, min_fraction))
+            # Bounded number of batches in memory
+            if len(pending) >= 2 * threads:
+                batch_reads, batch_bases = pending.pop(0).result()
+                reads += batch_reads
+                bases += batch_bases
+        for future in pending:
+            batch_reads, batch_bases = future.result()
+            reads += batch_reads
+            bases += batch_bases
+    logging.info(f"Assigned {int(reads.sum())} fragments to genes")
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fold = np.where(index.length > 0, bases / index.length, 0.0)
+    data = {'fold': fold, 'length': index.length, 'reads': reads}
+    write_abundance(ids, normalise(data, mode), os.path.join(output_dir, basename + '.abundance'))
+    return int(reads.sum())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Estimate gene abundances by k-mer matching of reads')
+    parser.add_argument('-g', '--genes', required=True, help='Nucleotide sequences of the genes (.ffn)')
+    parser.add_argument('-d', '--diamond', help='DIAMOND output; only the genes with a hit are quantified')
+    parser.add_argument('-1', '--reads1', required=True, help='Reads (FASTQ/FASTA), first mates if paired')
+    parser.add_argument('-2', '--reads2', help='Second mates of paired-end reads')
+    parser.add_argument('-b', '--basename', required=True, help='Basename of the sample to be calculated')
+    parser.add_argument('-o', '--output', required=True, help='Output directory')
+    parser.add_argument('-m', '--mode', choices=MODES, default='cpm',
+                        help='Normalisation: cpm (average fold per million, default), tpm or rpkm')
+    parser.add_argument('-k', '--kmer', type=int, default=31, help='k-mer size, up to 31 (default: 31)')
+    parser.add_argument('-t', '--threads', type=int, default=1, help='Number of threads')
+    parser.add_argument('--min-fraction', type=float, default=0.5,
+                        help='Minimum fraction of the k-mers of a read (pair) matching its gene (default: 0.5)')
+    args = parser.parse_args()
+    if not 1 <= args.kmer <= 31:
+        parser.error('--kmer must be between 1 and 31')
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    kmer_quant(args.genes, args.reads1, args.basename, args.output, args.reads2, args.diamond, args.mode,
+               args.kmer, args.threads, args.min_fraction)
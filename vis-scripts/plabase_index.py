@@ -0,0 +1,13 @@
+"""Compile the binary PLaBAse annotation index; wrapper of pgpg_finder.plabase_index."""
+import os
+import sys
+
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if _root not in sys.path:
+    sys.path.insert(0, _root)
+
+from pgpg_finder.plabase_index import *  # noqa: F401,F403
+from pgpg_finder.plabase_index import main
+
+if __name__ == "__main__":
+    main()
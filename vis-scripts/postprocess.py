@@ -0,0 +1,13 @@
+"""Post-process all samples of a meta_wf run in one process; wrapper of pgpg_finder.postprocess."""
+import os
+import sys
+
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if _root not in sys.path:
+    sys.path.insert(0, _root)
+
+from pgpg_finder.postprocess import *  # noqa: F401,F403
+from pgpg_finder.postprocess import main
+
+if __name__ == "__main__":
+    main()
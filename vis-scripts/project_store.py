@@ -0,0 +1,13 @@
+"""Project store of the samples of an output directory; wrapper of pgpg_finder.project_store."""
+import os
+import sys
+
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if _root not in sys.path:
+    sys.path.insert(0, _root)
+
+from pgpg_finder.project_store import *  # noqa: F401,F403
+from pgpg_finder.project_store import main
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+import os
+import re
+import sys
+import argparse
+import logging
+from array import array
+
+import numpy as np
+
+from compressed_io import open_file
+from gene_relative_abundance import MODES, normalise, write_abundance
+
+CIGAR_OP = re.compile(rb'(\d+)([MIDNSHP=X])')
+# Operations that count as reference coverage (as BBMap pileup with default settings)
+COVERING_OPS = frozenset(b'MD=X')
+
+FLAG_UNMAPPED = 0x4
+FLAG_REVERSE = 0x10
+FLAG_SECONDARY = 0x100
+FLAG_SUPPLEMENTARY = 0x800
+
+
+class GeneCoverage:
+    """
+    Per-gene coverage accumulators filled from a stream of SAM alignments
+
+    Counters are kept in compact arrays indexed by the position of the gene in
+    the SAM header, so memory depends on the number of genes and not on the
+    number of reads or on gene lengths.
+    """
+
+    def __init__(self):
+        self.ids = []
+        self.index = {}
+        self.length = array('q')
+        self.bases = array('q')
+        self.plus = array('q')
+        self.minus = array('q')
+        self._cigar_bases = {}
+
+    def add_reference(self, name, length):
+        self.index[name] = len(self.ids)
+        self.ids.append(name.decode())
+        self.length.append(length)
+        self.bases.append(0)
+        self.plus.append(0)
+        self.minus.append(0)
+
+    def covered_bases(self, cigar):
+        """Number of reference bases covered by an alignment (memoised, CIGAR strings repeat a lot)."""
+        bases = self._cigar_bases.get(cigar)
+        if bases is None:
+            bases = sum(int(n) for n, op in CIGAR_OP.findall(cigar) if op[0] in COVERING_OPS)
+            if len(self._cigar_bases) < 100000:
+                self._cigar_bases[cigar] = bases
+        return bases
+
+    def read_sam(self, stream):
+        """
+        Accumulate the primary alignments of a SAM stream
+
+        :param stream: binary SAM stream (e.g. bowtie2 stdout)
+        :return: number of alignments used
+        """
+        used = 0
+        index, bases, plus, minus = self.index, self.bases, self.plus, self.minus
+        for line in stream:
+            if line[:1] == b'@':
+                if line.startswith(b'@SQ'):
+                    fields = dict(field.split(b':', 1) for field in line.rstrip(b'\r\n').split(b'\t')[1:] if b':' in field)
+                    self.add_reference(fields[b'SN'], int(fields[b'LN']))
+                continue
+            fields = line.split(b'\t', 6)
+            flag = int(fields[1])
+            if flag & (FLAG_UNMAPPED | FLAG_SECONDARY | FLAG_SUPPLEMENTARY):
+                continue
+            ref = index.get(fields[2])
+            if ref is None:
+                continue
+            bases[ref] += self.covered_bases(fields[5])
+            if flag & FLAG_REVERSE:
+                minus[ref] += 1
+            else:
+                plus[ref] += 1
+            used += 1
+        return used
+
+    def arrays(self):
+        """Return the accumulators as numpy arrays in the layout used by gene_relative_abundance."""
+        length = np.frombuffer(self.length, dtype=np.int64).astype(np.float64)
+        bases = np.frombuffer(self.bases, dtype=np.int64).astype(np.float64)
+        plus = np.frombuffer(self.plus, dtype=np.int64)
+        minus = np.frombuffer(self.minus, dtype=np.int64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fold = np.where(length > 0, bases / length, 0.0)
+        return {'fold': fold, 'length': length, 'reads': (plus + minus).astype(np.float64),
+                'plus': plus, 'minus': minus}
+
+    def write_pileup(self, file_out):
+        """Write a pileup-like table (#ID, Avg_fold, Length, Plus_reads, Minus_reads)."""
+        data = self.arrays()
+        with open_file(file_out, 'w') as fo:
+            fo.write('#ID\tAvg_fold\tLength\tPlus_reads\tMinus_reads\n')
+            fo.writelines(f"{gene_id}\t{fold:.4f}\t{length}\t{plus}\t{minus}\n" for gene_id, fold, length, plus, minus in
+                          zip(self.ids, data['fold'].tolist(), self.length, self.plus, self.minus))
+
+
+def sam_coverage(sam_file, basename, output_dir, mode='cpm', pileup=None):
+    """
+    Compute gene abundances directly from SAM alignments
+
+    :param sam_file: SAM file, '-' reads the alignments from stdin
+    :param basename: basename of the sample
+    :param output_dir: directory to output the <basename>.abundance table
+    :param mode: normalisation mode (cpm, tpm or rpkm)
+    :param pileup: optional path of a pileup-like coverage table
+    :return: None
+    """
+    logging.info('Gene coverage calculation from SAM stream')
+    coverage = GeneCoverage()
+    if sam_file == '-':
+        coverage.read_sam(sys.stdin.buffer)
+    else:
+        with open_file(sam_file, 'rb') as fi:
+            coverage.read_sam(fi)
+
+    write_abundance(coverage.ids, normalise(coverage.arrays(), mode),
+                    os.path.join(output_dir, basename + '.abundance'))
+    if pileup:
+        coverage.write_pileup(pileup)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Calculate relative abundance of genes from a SAM stream')
+    parser.add_argument('-i', '--input', default='-', help="SAM file (default: '-', read from stdin)")
+    parser.add_argument('-b', '--basename', required=True, help='Basename of the sample to be calculated')
+    parser.add_argument('-o', '--output', required=True, help='Output directory')
+    parser.add_argument('-m', '--mode', choices=MODES, default='cpm',
+                        help='Normalisation: cpm (average fold per million, default), tpm or rpkm')
+    parser.add_argument('--pileup', help='Also write per-gene coverage to this file')
+    args = parser.parse_args()
+
+    sam_coverage(args.input, args.basename, args.output, args.mode, args.pileup)
@@ -0,0 +1,223 @@
+import os
+import re
+import sys
+import heapq
+import shutil
+import argparse
+import logging
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from compressed_io import compression, file_compression, open_file
+
+# Smallest amount of sequence worth a shard of its own
+MIN_SHARD_BASES = 1000000
+GENE_ID = re.compile(rb'ID=(\d+)_')
+SEQNUM = re.compile(rb'seqnum=(\d+);')
+
+
+def contig_lengths(assembly):
+    """Lengths of the contigs of a FASTA file, in file order."""
+    lengths = []
+    with open_file(assembly, 'rb') as fi:
+        for line in fi:
+            if line.startswith(b'>'):
+                lengths.append(0)
+            elif lengths:
+                lengths[-1] += len(line.rstrip(b'\r\n'))
+    return lengths
+
+
+def balance_shards(lengths, shards):
+    """
+    Assign contigs to shards of similar total length (longest contigs first, to the lightest shard)
+
+    :param lengths: contig lengths, in file order
+    :param shards: number of shards
+    :return: list with the shard of every contig
+    """
+    heap = [(0, shard) for shard in range(shards)]
+    assignment = [0] * len(lengths)
+    for contig in sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True):
+        load, shard = heapq.heappop(heap)
+        assignment[contig] = shard
+        heapq.heappush(heap, (load + lengths[contig], shard))
+    return assignment
+
+
+def write_shards(assembly, assignment, shard_paths):
+    """Write every contig to its shard; contigs keep their relative order within a shard."""
+    outputs = [open(path, 'wb', buffering=1 << 20) for path in shard_paths]
+    try:
+        with open_file(assembly, 'rb') as fi:
+            contig, out = -1, None
+            for line in fi:
+                if line.startswith(b'>'):
+                    contig += 1
+                    out = outputs[assignment[contig]]
+                if out is not None:
+                    out.write(line)
+    finally:
+        for out in outputs:
+            out.close()
+
+
+def _groups(path, key):
+    """Yield (sequence number, lines) of the consecutive records of a Prodigal output with the same sequence."""
+    current, lines = None, []
+    with open(path, 'rb', buffering=1 << 20) as fi:
+        for line in fi:
+            number = key(line)
+            if number is not None and number != current:
+                if lines:
+                    yield current, lines
+                current, lines = number, []
+            lines.append(line)
+    if lines:
+        yield current, lines
+
+
+def _fasta_key(line):
+    if line.startswith(b'>'):
+        match = GENE_ID.search(line)
+        return int(match.group(1)) if match else None
+    return None
+
+
+def _gbk_key(line):
+    if line.startswith(b'DEFINITION'):
+        match = SEQNUM.search(line)
+        return int(match.group(1)) if match else None
+    return None
+
+
+def _renumber(line, number):
+    # Sequence numbers of the shard become those of the whole assembly
+    if line.startswith(b'>') or b'/note="ID=' in line:
+        return GENE_ID.sub(b'ID=%d_' % number, line, count=1)
+    if line.startswith(b'DEFINITION'):
+        return SEQNUM.sub(b'seqnum=%d;' % number, line, count=1)
+    return line
+
+
+def merge_outputs(paths, assignment, output, key):
+    """
+    Merge the outputs of the shards in the contig order of the assembly
+
+    Every shard lists its contigs in assembly order, so the shards are merged
+    as sorted streams and gene IDs (ID=<seqnum>_<gene>) are renumbered with the
+    position of the contig in the assembly: the result is the same as a single
+    Prodigal run on the whole assembly.
+    """
+    streams = [_groups(path, key) for path in paths]
+    heads = [next(stream, None) for stream in streams]
+    local = [0] * len(paths)
+    out = sys.stdout.buffer if output == '-' else open_file(output, 'wb')
+    try:
+        for number, shard in enumerate(assignment, 1):
+            local[shard] += 1
+            head = heads[shard]
+            if head is not None and head[0] == local[shard]:
+                out.writelines(_renumber(line, number) for line in head[1])
+                heads[shard] = next(streams[shard], None)
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+
+
+def _prodigal(contigs, mode, proteins=None, genes=None, gbk=None, training=None):
+    # gbk '-' leaves the GenBank output on stdout, None discards it
+    command = ['prodigal', '-q', '-i', contigs, '-p', mode]
+    if gbk != '-':
+        command += ['-o', gbk or os.devnull]
+    if proteins:
+        command += ['-a', proteins]
+    if genes:
+        command += ['-d', genes]
+    if training:
+        command += ['-t', training]
+    return subprocess.call(command)
+
+
+def shard_prodigal(assembly, proteins=None, genes=None, gbk=None, mode='meta', threads=1):
+    """
+    Predict genes with Prodigal on balanced contig shards in parallel
+
+    Contigs are split into up to `threads` shards of similar total length and
+    Prodigal runs on all of them at once. In single mode the model is trained
+    once on the whole assembly and used by every shard, so genes are the same
+    as with a single run. Outputs (.faa, .ffn, .gbk) are merged in contig
+    order with stable gene IDs. Compressed assemblies are read and outputs
+    named .gz or .zst are written compressed.
+
+    :param assembly: contigs (FASTA)
+    :param proteins: output protein FASTA (-a)
+    :param genes: output nucleotide FASTA (-d)
+    :param gbk: output GenBank file (-o), '-' writes it to stdout
+    :param mode: Prodigal procedure, meta or single
+    :param threads: number of Prodigal processes
+    :return: exit code
+    """
+    lengths = contig_lengths(assembly)
+    shards = max(1, min(threads, len(lengths), sum(lengths) // MIN_SHARD_BASES))
+    # Prodigal reads and writes plain files only: compressed data goes through a shard
+    compressed = file_compression(assembly) or any(compression(path) for path in (proteins, genes, gbk) if path)
+    if shards == 1 and not compressed:
+        return _prodigal(assembly, mode, proteins, genes, gbk)
+
+    out_dir = os.path.dirname(os.path.abspath(proteins or genes or assembly))
+    work_dir = tempfile.mkdtemp(prefix='prodigal_shards_', dir=out_dir)
+    try:
+        assignment = balance_shards(lengths, shards)
+        shard_paths = [os.path.join(work_dir, f'shard_{shard}.fna') for shard in range(shards)]
+        write_shards(assembly, assignment, shard_paths)
+        training = None
+        if mode == 'single':
+            training_input = assembly
+            if file_compression(assembly):
+                # Training needs the whole assembly in a plain file: a single shard is one
+                training_input = shard_paths[0]
+                if shards > 1:
+                    training_input = os.path.join(work_dir, 'assembly.fna')
+                    with open_file(assembly, 'rb') as fi, open(training_input, 'wb') as fo:
+                        shutil.copyfileobj(fi, fo, 1 << 20)
+            training = os.path.join(work_dir, 'training.trn')
+            if _prodigal(training_input, mode, training=training) != 0:
+                return 1
+        logging.info(f"Running Prodigal on {shards} shards of {os.path.basename(assembly)}")
+
+        outputs = {kind: [path + '.' + kind for path in shard_paths] for kind in ('faa', 'ffn', 'gbk')}
+        with ThreadPoolExecutor(max_workers=shards) as pool:
+            codes = list(pool.map(lambda shard: _prodigal(shard_paths[shard], mode,
+                                                          outputs['faa'][shard] if proteins else None,
+                                                          outputs['ffn'][shard] if genes else None,
+                                                          outputs['gbk'][shard] if gbk else None, training),
+                                  range(shards)))
+        if any(codes):
+            logging.error(f"Prodigal failed on {sum(1 for code in codes if code)} of {shards} shards")
+            return 1
+
+        if proteins:
+            merge_outputs(outputs['faa'], assignment, proteins, _fasta_key)
+        if genes:
+            merge_outputs(outputs['ffn'], assignment, genes, _fasta_key)
+        if gbk:
+            merge_outputs(outputs['gbk'], assignment, gbk, _gbk_key)
+        return 0
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run Prodigal on balanced contig shards in parallel and merge the outputs')
+    parser.add_argument('-i', '--input', required=True, help='Contigs or genome (FASTA)')
+    parser.add_argument('-a', '--proteins', help='Protein translations (.faa)')
+    parser.add_argument('-d', '--genes', help='Nucleotide sequences of the genes (.ffn)')
+    parser.add_argument('-o', '--gbk', default='-', help="GenBank output (default: '-', stdout)")
+    parser.add_argument('-p', '--mode', choices=['meta', 'single'], default='meta', help='Prodigal procedure')
+    parser.add_argument('-t', '--threads', type=int, default=1, help='Number of Prodigal processes')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    sys.exit(shard_prodigal(args.input, args.proteins, args.genes, args.gbk, args.mode, args.threads))
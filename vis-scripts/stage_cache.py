@@ -0,0 +1,188 @@
+import os
+import sys
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import argparse
+import tempfile
+import subprocess
+
+# Arguments that print the version of each tool
+VERSION_ARGS = {
+    'prodigal': ['-v'],
+    'diamond': ['version'],
+    'trimmomatic': ['-version'],
+    'megahit': ['--version'],
+    'bowtie2': ['--version'],
+    'bowtie2-build': ['--version'],
+    'pileup.sh': ['--version'],
+}
+
+
+def _load_json(path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as fi:
+            return json.load(fi)
+    except ValueError:
+        return {}
+
+
+def _save_json(path, data):
+    # A temp file of its own per writer: several samples may update the cache at once
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'w') as fo:
+            json.dump(data, fo, indent=1, sort_keys=True)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def _update_json(path, name, value):
+    """Set one entry of a JSON memo, merged with the entries written meanwhile by other processes."""
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        data = _load_json(path)
+        data[name] = value
+        _save_json(path, data)
+    return data
+
+
+class StageCache:
+    """
+    Content-addressed cache of workflow stages
+
+    A stage is identified by a key built from the checksums of its input files,
+    the versions of the tools it runs, the database checksum and its parameters.
+    Checksums of files are memoised by (path, size, mtime), so large inputs and
+    databases are only read again when they change.
+    """
+
+    def __init__(self, cache_dir, manifest=None):
+        self.cache_dir = cache_dir
+        self.manifest = manifest
+        os.makedirs(os.path.join(cache_dir, 'stages'), exist_ok=True)
+        self._hashes_path = os.path.join(cache_dir, 'file_hashes.json')
+        self._tools_path = os.path.join(cache_dir, 'tool_versions.json')
+        self._hashes = _load_json(self._hashes_path)
+        self._tools = _load_json(self._tools_path)
+
+    def file_checksum(self, path):
+        """Return the sha256 of a file, reusing the memoised value when the file is unchanged."""
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        stamp = f"{st.st_size}:{st.st_mtime_ns}"
+        cached = self._hashes.get(path)
+        if cached and cached['stamp'] == stamp:
+            return cached['sha256']
+        digest = hashlib.sha256()
+        with open(path, 'rb') as fi:
+            for block in iter(lambda: fi.read(1 << 20), b''):
+                digest.update(block)
+        self._hashes = _update_json(self._hashes_path, path, {'stamp': stamp, 'sha256': digest.hexdigest()})
+        return digest.hexdigest()
+
+    def tool_version(self, tool):
+        """Return the first line printed by the version option of a tool ('missing' if not installed)."""
+        executable = shutil.which(tool)
+        if executable is None:
+            return 'missing'
+        stamp = f"{executable}:{os.stat(executable).st_mtime_ns}"
+        cached = self._tools.get(tool)
+        if cached and cached['stamp'] == stamp:
+            return cached['version']
+        try:
+            result = subprocess.run([executable] + VERSION_ARGS.get(tool, ['--version']),
+                                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                    universal_newlines=True, timeout=60)
+            lines = [line.strip() for line in result.stdout.splitlines() if line.strip()]
+            version = lines[0] if lines else 'unknown'
+        except (OSError, subprocess.SubprocessError):
+            version = 'unknown'
+        self._tools = _update_json(self._tools_path, tool, {'stamp': stamp, 'version': version})
+        return version
+
+    def stage_key(self, stage, inputs, tools=(), params='', database=None):
+        """Build the content-addressed key of a stage."""
+        description = {
+            'stage': stage,
+            'inputs': [self.file_checksum(path) for path in inputs],
+            'tools': {tool: self.tool_version(tool) for tool in tools},
+            'database': self.file_checksum(database) if database else None,
+            'params': params,
+        }
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def _entry_path(self, stage, sample):
+        return os.path.join(self.cache_dir, 'stages', f"{sample}__{stage}.json")
+
+    def is_valid(self, stage, sample, key):
+        """Check that the recorded outputs of a stage exist, are unchanged and were built with this key."""
+        entry = _load_json(self._entry_path(stage, sample))
+        if entry.get('key') != key:
+            return False
+        for path, checksum in entry.get('outputs', {}).items():
+            if not os.path.exists(path) or self.file_checksum(path) != checksum:
+                return False
+        return True
+
+    def record(self, stage, sample, key, outputs):
+        """Record the outputs of a stage that finished successfully."""
+        entry = {
+            'key': key,
+            'outputs': {os.path.abspath(path): self.file_checksum(path) for path in outputs},
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        _save_json(self._entry_path(stage, sample), entry)
+
+    def log(self, stage, sample, status, key):
+        """Append a line to the manifest of reused and recomputed stages."""
+        if self.manifest is None:
+            return
+        write_header = not os.path.exists(self.manifest)
+        with open(self.manifest, 'a') as fo:
+            if write_header:
+                fo.write('Time\tSample\tStage\tStatus\tKey\n')
+            fo.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')}\t{sample}\t{stage}\t{status}\t{key[:16]}\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Content-addressed cache of workflow stages.')
+    parser.add_argument('action', choices=['check', 'record'],
+                        help='check: exit 0 if the stage outputs can be reused; record: store the outputs of a finished stage')
+    parser.add_argument('--cache-dir', required=True, help='Cache directory')
+    parser.add_argument('--manifest', help='Manifest of reused and recomputed stages')
+    parser.add_argument('--stage', required=True, help='Stage name')
+    parser.add_argument('--sample', required=True, help='Sample name')
+    parser.add_argument('--inputs', nargs='*', default=[], help='Input files of the stage')
+    parser.add_argument('--outputs', nargs='*', default=[], help='Output files of the stage')
+    parser.add_argument('--tools', nargs='*', default=[], help='Tools run by the stage')
+    parser.add_argument('--db', help='Database used by the stage')
+    parser.add_argument('--params', default='', help='Parameters of the stage')
+    args = parser.parse_args()
+
+    cache = StageCache(args.cache_dir, args.manifest)
+    missing = [path for path in args.inputs if not os.path.exists(path)]
+    if missing:
+        if args.action == 'check':
+            sys.exit(1)
+        parser.error(f"missing input files: {' '.join(missing)}")
+    key = cache.stage_key(args.stage, args.inputs, args.tools, args.params, args.db)
+
+    if args.action == 'check':
+        if cache.is_valid(args.stage, args.sample, key):
+            cache.log(args.stage, args.sample, 'reused', key)
+            sys.exit(0)
+        sys.exit(1)
+    cache.record(args.stage, args.sample, key, args.outputs)
+    cache.log(args.stage, args.sample, 'recomputed', key)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+import sys
+import queue
+import argparse
+import threading
+
+from compressed_io import open_file
+
+_END = None
+# Records buffered per mate file; mates are consumed in lockstep, so the
+# readers only ever run ahead by the output buffering of the writer
+MATE_QUEUE_SIZE = 65536
+
+
+def fragment_name(header):
+    """Read name without the leading '@', the comment and a trailing /1 or /2 mate suffix."""
+    name = header[1:].split(None, 1)[0] if len(header) > 1 else b'read'
+    if name[-2:] in (b'/1', b'/2'):
+        name = name[:-2]
+    return name
+
+
+def read_fastq(path, records):
+    """Put (name, sequence) tuples of a FASTQ file (or FIFO) in a queue, followed by _END."""
+    try:
+        with open_file(path, 'rb') as fi:
+            while True:
+                header = fi.readline()
+                if not header:
+                    break
+                sequence = fi.readline().rstrip(b'\r\n')
+                fi.readline()
+                fi.readline()
+                records.put((fragment_name(header.rstrip(b'\r\n')), sequence))
+    finally:
+        records.put(_END)
+
+
+def start_reader(path, maxsize=0):
+    # Singleton queues are unbounded on purpose: the writer of a FIFO (e.g.
+    # Trimmomatic) must never block on one output while we wait for a record
+    # of another. Mate queues are bounded so reads are not all held in memory
+    # while DIAMOND, the slower consumer, catches up.
+    records = queue.Queue(maxsize)
+    thread = threading.Thread(target=read_fastq, args=(path, records), daemon=True)
+    thread.start()
+    return records
+
+
+def drain(records, out, block=False):
+    """Write the records available in a singleton queue; return False once the queue is finished."""
+    while True:
+        try:
+            record = records.get(block=block)
+        except queue.Empty:
+            return True
+        if record is _END:
+            return False
+        out.write(b'>' + record[0] + b'/s\n' + record[1] + b'\n')
+
+
+def stream_reads(read_1=None, read_2=None, singles=(), out=None):
+    """
+    Stream paired and single reads from several FASTQ files or FIFOs as one FASTA stream
+
+    All inputs are read concurrently. Mates are written next to each other as
+    <fragment>/1 and <fragment>/2 and singletons as <fragment>/s, so hits can
+    be collapsed per fragment downstream (count_hits.py --pairs).
+
+    :param read_1: FASTQ with the first mates (or single-end reads without read_2)
+    :param read_2: FASTQ with the second mates
+    :param singles: FASTQ files with unpaired reads
+    :param out: binary output stream (default: stdout)
+    :return: number of read pairs written
+    """
+    out = out or sys.stdout.buffer
+    single_queues = [start_reader(path) for path in singles]
+    if read_1 and not read_2:
+        single_queues.append(start_reader(read_1))
+        read_1 = None
+
+    fragments = 0
+    if read_1:
+        mates_1, mates_2 = start_reader(read_1, MATE_QUEUE_SIZE), start_reader(read_2, MATE_QUEUE_SIZE)
+        while True:
+            mate_1, mate_2 = mates_1.get(), mates_2.get()
+            if mate_1 is _END or mate_2 is _END:
+                if mate_1 is not mate_2:
+                    raise ValueError(f"{read_1} and {read_2} have a different number of reads")
+                break
+            out.write(b'>' + mate_1[0] + b'/1\n' + mate_1[1] + b'\n>' + mate_1[0] + b'/2\n' + mate_2[1] + b'\n')
+            fragments += 1
+            if fragments % 4096 == 0:
+                single_queues = [records for records in single_queues if drain(records, out)]
+
+    for records in single_queues:
+        drain(records, out, block=True)
+    out.flush()
+    return fragments
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Stream paired and single FASTQ reads (files or FIFOs) as one FASTA stream')
+    parser.add_argument('-1', '--read1', help='First mates (or single-end reads)')
+    parser.add_argument('-2', '--read2', help='Second mates')
+    parser.add_argument('-s', '--singles', nargs='*', default=[], help='Unpaired reads')
+    args = parser.parse_args()
+
+    if not args.read1 and not args.singles:
+        parser.error('no input reads given')
+    stream_reads(args.read1, args.read2, args.singles)
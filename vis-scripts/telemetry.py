@@ -0,0 +1,196 @@
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+from collections import defaultdict
+
+# Fields of /proc/<pid>/io recorded for every stage
+PROC_IO_FIELDS = {'rchar': 'read_chars', 'wchar': 'write_chars', 'read_bytes': 'read_bytes',
+                  'write_bytes': 'write_bytes'}
+# Environment variable naming the run of the records (set by PGPg_finder.py)
+RUN_VARIABLE = 'PGPG_RUN'
+
+
+def _proc_io(pid):
+    """I/O counters of a process (and its reaped children) from /proc, empty when not available."""
+    try:
+        with open(f"/proc/{pid}/io") as fi:
+            counters = dict(line.split(':', 1) for line in fi if ':' in line)
+    except OSError:
+        return {}
+    return {name: int(counters[field]) for field, name in PROC_IO_FIELDS.items() if field in counters}
+
+
+def _exit_code(status):
+    # Same convention as the shell: 128 + signal for commands killed by a signal
+    if os.WIFSIGNALED(status):
+        return 128 + os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def run_stage(command, stage, sample, threads, telemetry_file):
+    """
+    Run a command and append its resource usage to a JSONL telemetry file
+
+    The command inherits stdin, stdout and stderr, so it can be used inside
+    pipelines. CPU time and peak RSS cover the command and every child it
+    waited for; I/O counters are read before the process is reaped.
+
+    :param command: command and arguments
+    :param stage: stage name
+    :param sample: sample name
+    :param threads: threads granted to the stage
+    :param telemetry_file: JSONL file the record is appended to
+    :return: exit code of the command
+    """
+    started = time.time()
+    start = time.perf_counter()
+    try:
+        pid = os.posix_spawnp(command[0], command, os.environ)
+    except OSError as error:
+        print(f"{command[0]}: {error}", file=sys.stderr)
+        status, usage, io = 127 << 8, None, {}
+    else:
+        # Termination requests are passed on, the command decides when to exit
+        signal.signal(signal.SIGTERM, lambda signum, frame: os.kill(pid, signum))
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        io = {}
+        if hasattr(os, 'waitid'):
+            os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT)
+            io = _proc_io(pid)
+        _, status, usage = os.wait4(pid, 0)
+    wall = time.perf_counter() - start
+    exit_code = _exit_code(status)
+
+    record = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(started)),
+        'run': os.environ.get(RUN_VARIABLE),
+        'sample': sample,
+        'stage': stage,
+        'tool': os.path.basename(command[0]),
+        'threads': threads,
+        'wall': round(wall, 3),
+        'user': round(usage.ru_utime, 3) if usage else 0.0,
+        'system': round(usage.ru_stime, 3) if usage else 0.0,
+        # ru_maxrss is in KB on Linux
+        'max_rss_mb': round(usage.ru_maxrss / 1024, 1) if usage else 0.0,
+        **io,
+        'exit': exit_code,
+    }
+    # One write on an O_APPEND descriptor, so concurrent stages do not interleave lines
+    fd = os.open(telemetry_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps(record) + '\n').encode())
+    finally:
+        os.close(fd)
+    return exit_code
+
+
+def load_records(telemetry_file, run=None):
+    """
+    Records of a telemetry file
+
+    :param run: run to keep; None keeps the last run of the file
+    :return: list of dicts
+    """
+    with open(telemetry_file) as fi:
+        records = [json.loads(line) for line in fi if line.strip()]
+    if run is None and records:
+        run = records[-1].get('run')
+    return [record for record in records if record.get('run') == run]
+
+
+def _efficiency(cpu, wall, threads):
+    granted = wall * threads
+    return cpu / granted * 100 if granted else 0.0
+
+
+def summarize(records, top=10):
+    """
+    Rank stages and samples by the time spent in them
+
+    CPU efficiency is the CPU time of a stage over its wall time multiplied by
+    the threads it was granted. Stages that run concurrently (pipelines) each
+    count their own wall time.
+
+    :return: summary as text
+    """
+    if not records:
+        return 'No telemetry records.'
+    by_stage = defaultdict(lambda: {'runs': 0, 'wall': 0.0, 'cpu': 0.0, 'granted': 0.0, 'max_rss_mb': 0.0,
+                                    'read_bytes': 0, 'write_bytes': 0})
+    by_sample = defaultdict(lambda: {'stages': 0, 'wall': 0.0, 'cpu': 0.0, 'granted': 0.0})
+    for record in records:
+        cpu = record['user'] + record['system']
+        threads = record.get('threads') or 1
+        stage = by_stage[record['stage']]
+        stage['runs'] += 1
+        stage['wall'] += record['wall']
+        stage['cpu'] += cpu
+        stage['granted'] += record['wall'] * threads
+        stage['max_rss_mb'] = max(stage['max_rss_mb'], record['max_rss_mb'])
+        stage['read_bytes'] += record.get('read_bytes', 0)
+        stage['write_bytes'] += record.get('write_bytes', 0)
+        sample = by_sample[record['sample']]
+        sample['stages'] += 1
+        sample['wall'] += record['wall']
+        sample['cpu'] += cpu
+        sample['granted'] += record['wall'] * threads
+
+    total_wall = sum(stage['wall'] for stage in by_stage.values())
+    total_cpu = sum(stage['cpu'] for stage in by_stage.values())
+    total_granted = sum(stage['granted'] for stage in by_stage.values())
+    lines = [f"Run {records[0].get('run')}: {len(records)} stage runs, {len(by_sample)} samples, "
+             f"{total_wall:.1f} s in stages, {total_cpu:.1f} s CPU, "
+             f"CPU efficiency {total_cpu / total_granted * 100 if total_granted else 0:.0f}%", '',
+             f"{'Stage':<20}{'Runs':>6}{'Wall (s)':>11}{'Share':>7}{'CPU (s)':>10}{'CPU eff.':>10}"
+             f"{'Max RSS (MB)':>14}{'Read (MB)':>11}{'Written (MB)':>14}"]
+    for name, stage in sorted(by_stage.items(), key=lambda item: item[1]['wall'], reverse=True):
+        lines.append(f"{name:<20}{stage['runs']:>6}{stage['wall']:>11.1f}"
+                     f"{stage['wall'] / total_wall * 100 if total_wall else 0:>6.0f}%{stage['cpu']:>10.1f}"
+                     f"{stage['cpu'] / stage['granted'] * 100 if stage['granted'] else 0:>9.0f}%"
+                     f"{stage['max_rss_mb']:>14.1f}{stage['read_bytes'] / 1e6:>11.1f}{stage['write_bytes'] / 1e6:>14.1f}")
+
+    lines += ['', f"{'Sample':<20}{'Stages':>7}{'Wall (s)':>11}{'CPU (s)':>10}{'CPU eff.':>10}"]
+    samples = sorted(by_sample.items(), key=lambda item: item[1]['wall'], reverse=True)
+    for name, sample in samples[:top]:
+        lines.append(f"{name:<20}{sample['stages']:>7}{sample['wall']:>11.1f}{sample['cpu']:>10.1f}"
+                     f"{sample['cpu'] / sample['granted'] * 100 if sample['granted'] else 0:>9.0f}%")
+
+    lines += ['', 'Slowest stage runs:']
+    for record in sorted(records, key=lambda record: record['wall'], reverse=True)[:top]:
+        cpu = record['user'] + record['system']
+        lines.append(f"  {record['sample']:<20}{record['stage']:<20}{record['wall']:>9.1f} s"
+                     f"{_efficiency(cpu, record['wall'], record.get('threads') or 1):>6.0f}% of "
+                     f"{record.get('threads') or 1} threads{record['max_rss_mb']:>10.1f} MB")
+
+    failed = [record for record in records if record['exit'] != 0]
+    if failed:
+        lines += ['', 'Failed stages:']
+        lines += [f"  {record['sample']:<20}{record['stage']:<20}exit {record['exit']}" for record in failed]
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Record and summarise the resource usage of workflow stages')
+    subparsers = parser.add_subparsers(dest='action', required=True)
+    run_parser = subparsers.add_parser('run', help='Run a command and append its resource usage to the telemetry file')
+    run_parser.add_argument('-f', '--file', required=True, help='Telemetry file (JSONL)')
+    run_parser.add_argument('--stage', required=True, help='Stage name')
+    run_parser.add_argument('--sample', default='all', help='Sample name')
+    run_parser.add_argument('--threads', type=int, default=1, help='Threads granted to the stage')
+    run_parser.add_argument('command', nargs=argparse.REMAINDER, help='Command to run, after --')
+    summary_parser = subparsers.add_parser('summary', help='Rank the slowest stages and samples of a run')
+    summary_parser.add_argument('-f', '--file', required=True, help='Telemetry file (JSONL)')
+    summary_parser.add_argument('--run', help='Run to summarise (default: the last run of the file)')
+    summary_parser.add_argument('-n', '--top', type=int, default=10, help='Number of samples and stage runs listed')
+    args = parser.parse_args()
+
+    if args.action == 'run':
+        command = args.command[1:] if args.command[:1] == ['--'] else args.command
+        if not command:
+            parser.error('run requires a command')
+        sys.exit(run_stage(command, args.stage, args.sample, args.threads, args.file))
+    print(summarize(load_records(args.file, args.run), args.top))
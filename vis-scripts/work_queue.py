@@ -0,0 +1,294 @@
+import os
+import json
+import uuid
+import socket
+import argparse
+
+# Seconds a claim stays valid without a heartbeat
+LEASE_SECONDS = 300.0
+MAX_ATTEMPTS = 3
+# Claim name of the final merge of the per-sample results
+REDUCE = '_reduce'
+
+
+def worker_name():
+    """Name of this worker process: <host>:<pid>."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _write_new(path, content):
+    """
+    Create a file with the given content only if it does not exist yet
+
+    The content is written to a unique temporary file that is then hard
+    linked to its final name: link() fails when the name exists, also on NFS,
+    so exactly one of several concurrent writers succeeds.
+
+    :return: True when the file was created by this call
+    """
+    tmp = f"{os.path.join(os.path.dirname(path), '.' + os.path.basename(path))}.{uuid.uuid4().hex}"
+    with open(tmp, 'w') as fo:
+        fo.write(content)
+    try:
+        os.link(tmp, path)
+        return True
+    except FileExistsError:
+        return False
+    finally:
+        os.remove(tmp)
+
+
+def _read_json(path):
+    try:
+        with open(path) as fi:
+            return json.load(fi)
+    except (OSError, ValueError):
+        return None
+
+
+class Lease:
+    """Claim of a sample by a worker, kept alive by heartbeats."""
+
+    def __init__(self, queue, sample, token, attempt, worker):
+        self.queue = queue
+        self.sample = sample
+        self.token = token
+        self.attempt = attempt
+        self.worker = worker
+        self.path = queue.claim_path(sample)
+
+    def owned(self):
+        claim = _read_json(self.path)
+        return claim is not None and claim.get('token') == self.token
+
+    def heartbeat(self):
+        """Renew the lease; returns False when it expired and was taken over by another worker."""
+        if not self.owned():
+            return False
+        try:
+            os.utime(self.path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def release(self):
+        if self.owned():
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+class WorkQueue:
+    """
+    Queue of samples in a directory of a shared file system
+
+    Any number of workers, on any node that mounts the directory, pull samples
+    from it. A sample is claimed by creating claims/<sample> atomically; the
+    owner renews the claim (its modification time) with heartbeats. Claims not
+    renewed for `lease` seconds, e.g. of crashed workers or nodes, are taken
+    over by the next worker looking for work, up to `max_attempts` times per
+    sample. Modification times are compared with a file touched by the worker
+    itself, so the clocks of the nodes do not need to agree.
+
+    Layout: tasks/<sample>.json (order and input of every sample), claims/,
+    attempts/<sample>.<token>, done/<sample>.json and failed/<sample>.json.
+    """
+
+    def __init__(self, path, lease=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        for name in ('tasks', 'claims', 'attempts', 'done', 'failed', 'work', 'clock'):
+            os.makedirs(os.path.join(path, name), exist_ok=True)
+
+    def _file(self, kind, sample, suffix=''):
+        return os.path.join(self.path, kind, sample + suffix)
+
+    def claim_path(self, sample):
+        return self._file('claims', sample)
+
+    def work_dir(self, lease):
+        """Private output directory of a claim: concurrent attempts of a sample never share files."""
+        return self._file('work', lease.sample, '.' + lease.token)
+
+    def add(self, samples):
+        """
+        Add (sample, input) pairs; samples already in the queue are left as they are
+
+        :return: number of samples added
+        """
+        existing = len(os.listdir(os.path.join(self.path, 'tasks')))
+        added = 0
+        for order, (sample, path) in enumerate(samples, existing):
+            task = {'sample': sample, 'input': os.path.abspath(path), 'order': order}
+            added += _write_new(self._file('tasks', sample, '.json'), json.dumps(task))
+        if added:
+            # New samples: the results are merged again once they are finished
+            try:
+                os.remove(self._file('done', REDUCE, '.json'))
+            except FileNotFoundError:
+                pass
+        return added
+
+    def samples(self):
+        """Samples of the queue, in the order they were added."""
+        tasks = [_read_json(os.path.join(self.path, 'tasks', name))
+                 for name in os.listdir(os.path.join(self.path, 'tasks')) if name.endswith('.json')]
+        return [task['sample'] for task in sorted(filter(None, tasks), key=lambda task: task['order'])]
+
+    def now(self):
+        """Current time of the file system, read from a file touched by this worker."""
+        clock = self._file('clock', worker_name().replace(os.sep, '_'))
+        with open(clock, 'a'):
+            os.utime(clock)
+        return os.stat(clock).st_mtime
+
+    def _expired(self, path, now):
+        try:
+            return now - os.stat(path).st_mtime > self.lease
+        except FileNotFoundError:
+            return False
+
+    def attempts(self, sample):
+        """Number of times a sample was claimed."""
+        return sum(name.rsplit('.', 1)[0] == sample for name in os.listdir(os.path.join(self.path, 'attempts')))
+
+    def result(self, sample):
+        """Record of a finished sample ({'state': 'done' or 'failed', ...}), or None."""
+        for state in ('done', 'failed'):
+            record = _read_json(self._file(state, sample, '.json'))
+            if record is not None:
+                return dict(record, state=state)
+        return None
+
+    def state(self, sample, now=None):
+        """'done', 'failed', 'running', 'expired' (claim not renewed) or 'pending'."""
+        result = self.result(sample)
+        if result is not None:
+            return result['state']
+        claim = self.claim_path(sample)
+        if not os.path.exists(claim):
+            return 'pending'
+        return 'expired' if self._expired(claim, now or self.now()) else 'running'
+
+    def status(self):
+        """Number of samples in every state."""
+        now = self.now()
+        counts = dict.fromkeys(('pending', 'running', 'expired', 'done', 'failed'), 0)
+        for sample in self.samples():
+            counts[self.state(sample, now)] += 1
+        return counts
+
+    def finished(self):
+        """True when every sample is done or failed."""
+        now = self.now()
+        return all(self.state(sample, now) in ('done', 'failed') for sample in self.samples())
+
+    def _acquire(self, name, worker, now):
+        """Claim a name, taking over an expired claim; returns the claim token or None."""
+        claim = self.claim_path(name)
+        if self._expired(claim, now):
+            # rename() is atomic: only one of the workers finding the claim expired removes it
+            stale = f"{claim}.stale.{uuid.uuid4().hex}"
+            try:
+                os.rename(claim, stale)
+                os.remove(stale)
+            except FileNotFoundError:
+                return None
+        token = uuid.uuid4().hex
+        record = {'token': token, 'worker': worker, 'claimed': now}
+        return token if _write_new(claim, json.dumps(record)) else None
+
+    def claim(self, worker=None):
+        """
+        Claim the next sample that is neither finished nor claimed by a live worker
+
+        Samples whose attempts are used up are marked as failed instead.
+
+        :return: Lease, or None when no sample can be claimed now
+        """
+        worker = worker or worker_name()
+        now = self.now()
+        for sample in self.samples():
+            if self.state(sample, now) not in ('pending', 'expired'):
+                continue
+            token = self._acquire(sample, worker, now)
+            if token is None:
+                continue
+            lease = Lease(self, sample, token, self.attempts(sample) + 1, worker)
+            if self.result(sample) is not None:
+                # Finished by another worker since the state was read
+                lease.release()
+                continue
+            if lease.attempt > self.max_attempts:
+                self._finish('failed', sample, {'worker': worker, 'exit_code': None, 'seconds': 0.0,
+                                                'attempt': lease.attempt - 1})
+                lease.release()
+                continue
+            _write_new(self._file('attempts', sample, '.' + token), json.dumps({'worker': worker, 'started': now}))
+            return lease
+        return None
+
+    def _finish(self, state, sample, record):
+        _write_new(self._file(state, sample, '.json'), json.dumps(record))
+
+    def complete(self, lease, seconds):
+        """Mark the sample of a lease as done and release it; False if the lease was lost meanwhile."""
+        if not lease.owned():
+            return False
+        self._finish('done', lease.sample, {'worker': lease.worker, 'exit_code': 0, 'seconds': seconds,
+                                            'attempt': lease.attempt})
+        lease.release()
+        return True
+
+    def fail(self, lease, exit_code, seconds):
+        """
+        Give a failed sample back to the queue, or mark it as failed after its last attempt
+
+        :return: True when the sample is marked as failed
+        """
+        if not lease.owned():
+            return False
+        final = lease.attempt >= self.max_attempts
+        if final:
+            self._finish('failed', lease.sample, {'worker': lease.worker, 'exit_code': exit_code,
+                                                  'seconds': seconds, 'attempt': lease.attempt})
+        lease.release()
+        return final
+
+    def claim_reduce(self, worker=None):
+        """
+        Claim the final merge once every sample is finished
+
+        :return: Lease, or None when samples are unfinished, or the merge is done or claimed by another worker
+        """
+        if not self.finished() or os.path.exists(self._file('done', REDUCE, '.json')):
+            return None
+        worker = worker or worker_name()
+        token = self._acquire(REDUCE, worker, self.now())
+        return Lease(self, REDUCE, token, 1, worker) if token else None
+
+    def complete_reduce(self, lease):
+        self._finish('done', REDUCE, {'worker': lease.worker})
+        lease.release()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Shared file system queue of samples (PGPg_finder --worker)')
+    subparsers = parser.add_subparsers(dest='action', required=True)
+    status_parser = subparsers.add_parser('status', help='Print the state of every sample')
+    status_parser.add_argument('-q', '--queue', required=True, help='Queue directory (<output_dir>/queue)')
+    status_parser.add_argument('--lease', type=float, default=LEASE_SECONDS,
+                               help=f'Seconds after which a claim without heartbeat expires (default: {LEASE_SECONDS:g})')
+    args = parser.parse_args()
+
+    if not os.path.isdir(os.path.join(args.queue, 'tasks')):
+        parser.error(f'{args.queue} is not a queue directory')
+    queue = WorkQueue(args.queue, args.lease)
+    now = queue.now()
+    print('Sample\tState\tAttempts\tSeconds')
+    for sample in queue.samples():
+        result = queue.result(sample) or {}
+        print(f"{sample}\t{queue.state(sample, now)}\t{queue.attempts(sample)}\t{result.get('seconds', '')}")
+    print('\t'.join(f"{state}: {n}" for state, n in queue.status().items()))
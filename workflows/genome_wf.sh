@@ -11,7 +11,8 @@ display_help() {
     echo "Results are saved to the output directory."
     echo
     echo "Arguments:"
-    echo "  -i        Path to the directory containing genome files (.fasta, .fna, .fa)."
+    echo "  -i        Path to the directory containing genome files (.fasta, .fna, .fa),"
+    echo "            optionally compressed (.gz, .zst)."
     echo "  -o        Path to the directory where results will be saved."
     echo "  -t        Number of CPU threads to be used in the pipeline."
     echo
@@ -22,6 +23,18 @@ display_help() {
     echo "  --bitscore  Minimum bit score to report alignments."
     echo "  --evalue    Maximum e-value to report alignments (default: 1e-5)."
     echo "  --dmode      DIAMOND mode for sequence search (e.g., fast, sensitive, very-sensitive)."
+    echo "  --batch      Search the proteins of all genomes with a single DIAMOND run."
+    echo "  --stream     Count DIAMOND hits straight from its output stream (no _diamond.txt files)."
+    echo "  --dedup      Search identical proteins once and count their hits for every copy."
+    echo "  --cache      Reuse Prodigal and DIAMOND outputs of a previous run when inputs and settings are unchanged."
+    echo "  --annotation-cache      Persistent cache of protein annotations (SQLite file) shared across runs;"
+    echo "                          proteins already annotated with the same database and settings are not aligned again."
+    echo "  --annotation-cache-size Size limit of the annotation cache in MB (default: 1024)."
+    echo "  --sample     Process only the genome with this sample name."
+    echo "  --genes      Directory with predicted proteins (<sample>.faa); gene prediction is skipped."
+    echo "  --no-heatmap Skip the heatmap generation step."
+    echo "  --telemetry  Append the wall/CPU time, memory and I/O of every stage to this JSONL file."
+    echo "  --compress   Write proteins and DIAMOND tables gzip-compressed (pigz when installed)."
     echo "  -h          Display this help message."
 }
 
@@ -31,8 +44,168 @@ log() {
     echo "[${timestamp}] $1" | tee -a "$log_file"
 }
 
+# Stage cache (--cache). stage_cached succeeds when the outputs recorded for a
+# stage can be reused; stage_store records them after a successful run.
+stage_cached() {
+    [ "$use_cache" = true ] && python "$cache_script" check \
+        --cache-dir "${out_dir}/.pgpg_cache" --manifest "${out_dir}/cache_manifest.tsv" "$@"
+}
+
+stage_store() {
+    if [ "$use_cache" = true ]; then
+        python "$cache_script" record \
+            --cache-dir "${out_dir}/.pgpg_cache" --manifest "${out_dir}/cache_manifest.tsv" "$@"
+    fi
+}
+
+# Run a command as stage $1 of sample $2. With --telemetry, its wall and CPU
+# time, peak memory, bytes read/written and exit status are appended to the
+# telemetry file.
+run_stage() {
+    local stage=$1 sample=$2
+    shift 2
+    if [ -n "$telemetry_file" ]; then
+        python "$telemetry_script" run -f "$telemetry_file" --stage "$stage" --sample "$sample" \
+            --threads "$threads" -- "$@"
+    else
+        "$@"
+    fi
+}
+
+# Sample name of a genome file: file name without the compression and FASTA suffixes
+sample_name() {
+    local name
+    name=$(basename "$1")
+    name=${name%.gz}
+    name=${name%.zst}
+    echo "${name%.*}"
+}
+
+# Write a protein file ($1) to stdout, decompressed
+read_proteins() {
+    case "$1" in
+        *.gz|*.zst) python "$compress_script" cat "$1" ;;
+        *) cat "$1" ;;
+    esac
+}
+
+# Use the proteins of sample $1 predicted beforehand (--genes <dir>/<sample>.faa)
+link_proteins() {
+    local proteins="${genes_dir}/$1.faa"
+    if [ ! -f "$proteins" ]; then
+        log "Error: ${proteins} not found."
+        return 1
+    fi
+    ln -sf "$(readlink -f "$proteins")" "${out_dir}/$1_proteins.fa"
+}
+
+# Run DIAMOND blastp on a protein file ($1) and count the hits into the gene
+# counts table; $3 names the run in the stage cache. Remaining arguments are
+# passed to count_hits.py. With --stream the hits are read from DIAMOND's
+# stdout and $2 is never written. With --dedup only distinct proteins are
+# searched and their hits are counted for every copy.
+search_and_count() {
+    local query=$1 hits=$2 label=$3
+    shift 3
+    local count_args=("$@") unique multiplicity started status=0
+    if [ "$dedup" = true ]; then
+        unique="${out_dir}/${label}_unique.fa"
+        multiplicity="${out_dir}/${label}_multiplicity.tsv"
+        run_stage dedup "$label" python "$dedup_script" dedup -i "$query" -o "$unique" -m "$multiplicity" "$@" \
+            || return 1
+        query=$unique
+        count_args+=(--multiplicity "$multiplicity")
+        started=$(date +%s.%N)
+    fi
+    if [ "$stream_hits" = true ]; then
+        ( set -o pipefail
+          annotate "$query" /dev/stdout "$label" \
+              | run_stage count_hits "$label" python "$count_script" -o "$gene_counts_file" "${count_args[@]}" ) \
+            || status=1
+    else
+        local stage=(--stage diamond --sample "$label" --inputs "$query" --outputs "$hits"
+                     --tools diamond --db "$diamond_db" --params "$diamond_params")
+        if stage_cached "${stage[@]}"; then
+            log "Reusing cached DIAMOND hits in ${hits}"
+        elif annotate "$query" "$hits" "$label"; then
+            stage_store "${stage[@]}"
+        else
+            status=1
+        fi
+        [ "$status" -eq 0 ] && { run_stage count_hits "$label" python "$count_script" -i "$hits" \
+            -o "$gene_counts_file" "${count_args[@]}" || status=1; }
+    fi
+    if [ "$dedup" = true ]; then
+        [ "$status" -eq 0 ] && python "$dedup_script" report -m "$multiplicity" -n "$label" \
+            --seconds "$(awk -v start="$started" -v end="$(date +%s.%N)" 'BEGIN { print end - start }')" -o "${out_dir}/dedup_report.tsv" 2>&1 \
+            | tee -a "$log_file"
+        rm -f "$unique"
+    fi
+    return $status
+}
+
+# Annotate the proteins of $1 into $2 like run_diamond. With --annotation-cache,
+# proteins annotated by earlier runs with the same database and settings are
+# resolved from the cache and only the others are aligned; their hits are then
+# added to the cache.
+annotate() {
+    if [ -z "$annotation_cache" ]; then
+        run_diamond "$@"
+        return
+    fi
+    case "$2" in
+        /dev/stdout) ;;
+        *.gz|*.zst)
+            ( set -o pipefail
+              annotate "$1" /dev/stdout "$3" | python "$compress_script" compress -o "$2" -t "$threads" )
+            return ;;
+        *)
+            annotate "$1" /dev/stdout "$3" > "$2"
+            return ;;
+    esac
+    local misses="${out_dir}/$3_cache_misses.fa" cached="${out_dir}/$3_cached_hits.txt" status=0
+    local cache_args=(-c "$annotation_cache" --max-size "$annotation_cache_size" --db "$diamond_db"
+                      --params "$diamond_params" -n "$3")
+    run_stage cache_lookup "$3" python "$annotation_cache_script" lookup "${cache_args[@]}" -q "$1" \
+        --misses "$misses" -o "$cached" 2> >(tee -a "$log_file" >&2) || status=1
+    if [ "$status" -eq 0 ]; then
+        cat "$cached"
+        # DIAMOND only runs when some proteins are not cached
+        if [ -s "$misses" ]; then
+            ( set -o pipefail
+              run_diamond "$misses" /dev/stdout "$3" \
+                  | run_stage cache_store "$3" python "$annotation_cache_script" store "${cache_args[@]}" \
+                        -q "$misses" 2> >(tee -a "$log_file" >&2) ) || status=1
+        fi
+    fi
+    rm -f "$misses" "$cached"
+    return $status
+}
+
+# Run DIAMOND blastp on $1 into $2; $3 names the sample in the telemetry.
+# Outputs named .gz or .zst are compressed as DIAMOND writes them.
+run_diamond() {
+    case "$2" in
+        *.gz|*.zst)
+            ( set -o pipefail
+              run_diamond "$1" /dev/stdout "$3" | python "$compress_script" compress -o "$2" -t "$threads" )
+            return ;;
+    esac
+    run_stage diamond "$3" diamond blastp -d "$diamond_db" \
+        -q "$1" \
+        -o "$2" \
+        -p "$threads" \
+        -k 1 \
+        -e "$evalue" \
+        --id "$min_identity" \
+        --query-cover "$min_query_cover" \
+        $( [ -n "$min_score" ] && echo "--min-score $min_score" ) \
+        $( [ -n "$diamond_mode" ] && echo "--mode $diamond_mode" ) \
+        $diamond_extra
+}
+
 # Parse long and short options using `getopt`
-ARGS=$(getopt -o i:o:t:h --long piden:,qcov:,extra:,bitscore:,evalue:,dmode:,help -n "$0" -- "$@")
+ARGS=$(getopt -o i:o:t:h --long piden:,qcov:,extra:,bitscore:,evalue:,dmode:,sample:,genes:,telemetry:,annotation-cache:,annotation-cache-size:,no-heatmap,batch,stream,cache,compress,dedup,help -n "$0" -- "$@")
 if [ $? -ne 0 ]; then
     display_help
     exit 1
@@ -46,6 +219,17 @@ diamond_extra=""
 min_score=""
 evalue="1e-5"
 diamond_mode=""
+only_sample=""
+genes_dir=""
+telemetry_file=""
+annotation_cache=""
+annotation_cache_size=1024
+skip_heatmap=false
+batch_mode=false
+stream_hits=false
+use_cache=false
+compress=false
+dedup=false
 
 # Parse options
 while true; do
@@ -59,6 +243,17 @@ while true; do
         --bitscore) min_score=$2; shift 2 ;;
         --evalue) evalue=$2; shift 2 ;;
         --dmode) diamond_mode=$2; shift 2 ;;
+        --sample) only_sample=$2; shift 2 ;;
+        --genes) genes_dir=$2; shift 2 ;;
+        --telemetry) telemetry_file=$2; shift 2 ;;
+        --annotation-cache) annotation_cache=$2; shift 2 ;;
+        --annotation-cache-size) annotation_cache_size=$2; shift 2 ;;
+        --no-heatmap) skip_heatmap=true; shift ;;
+        --batch) batch_mode=true; shift ;;
+        --stream) stream_hits=true; shift ;;
+        --cache) use_cache=true; shift ;;
+        --compress) compress=true; shift ;;
+        --dedup) dedup=true; shift ;;
         -h|--help) display_help; exit 0 ;;
         --) shift; break ;;
         *) display_help; exit 1 ;;
@@ -86,8 +281,10 @@ mkdir -p "$out_dir"
 log_file="${out_dir}/log.txt"
 touch "$log_file"
 
-# Find genome files
-genome_files=($(find "$genomes_dir" -type f \( -name "*.fasta" -o -name "*.fna" -o -name "*.fa" \)))
+# Find genome files, sorted by path as PGPg_finder.py orders the samples of -j runs
+genome_files=($(find "$genomes_dir" -type f \( -name "*.fasta" -o -name "*.fna" -o -name "*.fa" \
+                    -o -name "*.fasta.gz" -o -name "*.fna.gz" -o -name "*.fa.gz" \
+                    -o -name "*.fasta.zst" -o -name "*.fna.zst" -o -name "*.fa.zst" \) | LC_ALL=C sort))
 
 if [ ${#genome_files[@]} -eq 0 ]; then
     log "Error: No genome files found in $genomes_dir."
@@ -96,50 +293,136 @@ fi
 
 # Process each genome file
 gene_counts_file="${out_dir}/gene_counts.txt"
+count_script="$script_dir/vis-scripts/count_hits.py"
+cache_script="$script_dir/vis-scripts/stage_cache.py"
+telemetry_script="$script_dir/vis-scripts/telemetry.py"
+shard_prodigal_script="$script_dir/vis-scripts/shard_prodigal.py"
+compress_script="$script_dir/vis-scripts/compressed_io.py"
+dedup_script="$script_dir/vis-scripts/dedup_queries.py"
+annotation_cache_script="$script_dir/vis-scripts/annotation_cache.py"
+diamond_params="blastp -k 1 -e $evalue --id $min_identity --query-cover $min_query_cover --min-score $min_score --mode $diamond_mode $diamond_extra"
 echo -e "Sample\tID\tCount" > "$gene_counts_file"
 
-for genome in "${genome_files[@]}"; do
-    sample=$(basename "${genome%.*}")
-    log "Processing sample ${sample}..."
+# Suffix of the proteins and DIAMOND tables (--compress); proteins from
+# --genes are linked as they are
+ext=""
+if [ "$compress" = true ]; then
+    ext=".gz"
+fi
+protein_ext=$ext
+if [ -n "$genes_dir" ]; then
+    protein_ext=""
+fi
+
+if [ "$batch_mode" = true ]; then
+    # Batched mode: gene calling runs concurrently (Prodigal is single-threaded),
+    # then the proteins of every genome are searched in one DIAMOND run, so the
+    # database is loaded and indexed only once. Protein headers are tagged with
+    # "<sample>|" and the tag is used to split the hits back into samples.
+    batch_proteins="${out_dir}/batch_proteins.fa"
+    batch_diamond="${out_dir}/batch_diamond.txt${ext}"
+    batch_samples=()
+
+    for genome in "${genome_files[@]}"; do
+        if [[ "$(sample_name "$genome")" == *"|"* ]]; then
+            log "Error: ${genome}: sample names cannot contain '|' in --batch mode, rename the file"
+            exit 1
+        fi
+    done
+
+    for genome in "${genome_files[@]}"; do
+        sample=$(sample_name "$genome")
+        if [ -n "$only_sample" ] && [ "$sample" != "$only_sample" ]; then
+            continue
+        fi
+        batch_samples+=("$sample")
+        rm -f "${out_dir}/${sample}.prodigal_failed"
+        if [ -n "$genes_dir" ]; then
+            link_proteins "$sample" || exit 1
+            continue
+        fi
+        prodigal_stage=(--stage prodigal --sample "$sample" --inputs "$genome"
+                        --outputs "${out_dir}/${sample}_proteins.fa${protein_ext}" --tools prodigal --params "-p single")
+        # Each concurrent Prodigal run is granted one thread
+        ( threads=1
+          stage_cached "${prodigal_stage[@]}" \
+            || { run_stage prodigal "$sample" python "$shard_prodigal_script" -i "${genome}" \
+                     -a "${out_dir}/${sample}_proteins.fa${protein_ext}" -p single -t 1 > /dev/null \
+                 && stage_store "${prodigal_stage[@]}"; } \
+            || touch "${out_dir}/${sample}.prodigal_failed" ) &
+        while [ "$(jobs -rp | wc -l)" -ge "$threads" ]; do
+            wait -n
+        done
+    done
+    wait
 
-    # Run prodigal
-    prodigal -i "${genome}" -a "${out_dir}/${sample}_proteins.fa" -p single
+    : > "$batch_proteins"
+    for sample in "${batch_samples[@]}"; do
+        if [ -f "${out_dir}/${sample}.prodigal_failed" ]; then
+            log "Error: Prodigal failed for ${sample}."
+            exit 1
+        fi
+        read_proteins "${out_dir}/${sample}_proteins.fa${protein_ext}" \
+            | awk -v tag="${sample}|" '/^>/ { $0 = ">" tag substr($0, 2) } { print }' >> "$batch_proteins"
+    done
+    log "Generated protein sequences for ${#batch_samples[@]} samples"
+
+    # Hits are split back into samples using the header tag
+    search_and_count "$batch_proteins" "$batch_diamond" batch --tag-sep "|"
     if [ $? -ne 0 ]; then
-        log "Error: Prodigal failed for ${sample}."
+        log "Error: batched DIAMOND search failed."
         exit 1
     else
-        log "Generated protein sequences for sample ${sample}"
+        log "Completed batched DIAMOND search for ${#batch_samples[@]} samples"
     fi
-    
-    # Run DIAMOND
-    diamond blastp -d "$diamond_db" \
-        -q "${out_dir}/${sample}_proteins.fa" \
-        -o "${out_dir}/${sample}_diamond.txt" \
-        -p "$threads" \
-        -k 1 \
-        -e "$evalue" \
-        --id "$min_identity" \
-        --query-cover "$min_query_cover" \
-        $( [ -n "$min_score" ] && echo "--min-score $min_score" ) \
-        $( [ -n "$diamond_mode" ] && echo "--mode $diamond_mode" ) \
-        $diamond_extra
+    rm -f "$batch_proteins"
+    log "Completed processing for ${#batch_samples[@]} samples."
+else
+    for genome in "${genome_files[@]}"; do
+        sample=$(sample_name "$genome")
+        if [ -n "$only_sample" ] && [ "$sample" != "$only_sample" ]; then
+            continue
+        fi
+        log "Processing sample ${sample}..."
 
-    if [ $? -ne 0 ]; then
-        log "Error: DIAMOND failed for ${sample}."
-        exit 1    
-    else
-        log "Completed DIAMOND search for sample ${sample}"
-    fi
+        # Run prodigal
+        prodigal_stage=(--stage prodigal --sample "$sample" --inputs "$genome"
+                        --outputs "${out_dir}/${sample}_proteins.fa${protein_ext}" --tools prodigal --params "-p single")
+        if [ -n "$genes_dir" ]; then
+            link_proteins "$sample" || exit 1
+            log "Using provided protein sequences for sample ${sample}"
+        elif stage_cached "${prodigal_stage[@]}"; then
+            log "Reusing cached protein sequences for sample ${sample}"
+        else
+            # The model is trained once, then contig shards are predicted on all threads
+            run_stage prodigal "$sample" python "$shard_prodigal_script" -i "${genome}" \
+                -a "${out_dir}/${sample}_proteins.fa${protein_ext}" -p single -t "$threads"
+            if [ $? -ne 0 ]; then
+                log "Error: Prodigal failed for ${sample}."
+                exit 1
+            else
+                log "Generated protein sequences for sample ${sample}"
+            fi
+            stage_store "${prodigal_stage[@]}"
+        fi
 
-    # Process results
-    awk '{print $2}' "${out_dir}/${sample}_diamond.txt" | sort | uniq -c | while read count gene; do
-        echo -e "${sample}\t${gene}\t${count}" >> "$gene_counts_file"
+        # Run DIAMOND and count the hits
+        search_and_count "${out_dir}/${sample}_proteins.fa${protein_ext}" "${out_dir}/${sample}_diamond.txt${ext}" \
+            "$sample" -s "$sample"
+        if [ $? -ne 0 ]; then
+            log "Error: DIAMOND failed for ${sample}."
+            exit 1    
+        else
+            log "Completed DIAMOND search for sample ${sample}"
+        fi
+        log "Completed processing for ${sample}."
     done
-    log "Completed processing for ${sample}."
-done
+fi
 
 # Python script to generate the heatmaps
-heatmap_script="$script_dir/vis-scripts/heatmap_plabase.py"
-python "$heatmap_script" "${gene_counts_file}" "${out_dir}" "$script_dir/database/pathways_plabase.txt" "$script_dir/database/summary.txt"
-log "Generated heatmaps"
+if [ "$skip_heatmap" != true ]; then
+    heatmap_script="$script_dir/vis-scripts/heatmap_plabase.py"
+    run_stage heatmap all python "$heatmap_script" "${gene_counts_file}" "${out_dir}" "$script_dir/database/pathways_plabase.txt" "$script_dir/database/summary.txt" -j "$threads"
+    log "Generated heatmaps"
+fi
 log "Pipeline completed. Results are saved in ${out_dir}."
@@ -11,9 +11,10 @@ display_help() {
     echo "Check https://github.com/tpellegrinetti/PGPg_finder for updates"
     echo
     echo "Usage:"
-    echo "  $0 -i <reads_directory> -o <output_directory> -t <threads> [-a <assembly_directory>]"
+    echo "  $0 -i <reads_directory> -o <output_directory> -t <threads> [-a <assembly_directory>] [--genes <genes_directory>]"
     echo "     [--piden <min_identity>] [--qcov <min_query_cover>] [--extra <extra_args>]"
-    echo "     [--bitscore <min_score>] [--evalue <evalue>] [--dmode <mode>] [-h]"
+    echo "     [--bitscore <min_score>] [--evalue <evalue>] [--dmode <mode>]"
+    echo "     [--catalog] [--catalog-id <identity>] [--sample <name>] [--no-heatmap] [--cache] [--compress] [-h]"
     echo
     echo "Assembly-based metagenomic workflow for detection and quantification of"
     echo "plant growth–promoting genes using PLaBAse."
@@ -31,6 +32,9 @@ display_help() {
     echo "Optional arguments:"
     echo "  -a        Directory containing pre-assembled contigs."
     echo "            If provided, the assembly step is skipped."
+    echo "  --genes   Directory containing predicted genes, <sample>.faa (proteins)"
+    echo "            and <sample>.ffn (nucleotides). If provided, assembly and gene"
+    echo "            prediction are skipped."
     echo
     echo "DIAMOND parameters:"
     echo "  --piden     Minimum identity percentage (default: 30)."
@@ -40,7 +44,29 @@ display_help() {
     echo "  --dmode     DIAMOND search mode (fast, sensitive, very-sensitive)."
     echo "  --extra     Additional DIAMOND arguments."
     echo
+    echo "Abundance:"
+    echo "  --abund-mode Gene abundance normalisation: cpm (default), tpm or rpkm."
+    echo "  --coverage  Coverage engine: 'stream' reads bowtie2 output directly, without"
+    echo "              writing SAM/pileup files; 'pileup' uses BBMap pileup.sh."
+    echo "              Default: pileup when pileup.sh is installed, stream otherwise."
+    echo "              'kmer' skips read alignment: reads are matched by k-mers to the"
+    echo "              genes with a DIAMOND hit only (approximate, faster)."
+    echo "  --catalog   Pool the genes of all samples into a non-redundant catalog,"
+    echo "              annotate it with DIAMOND once and map every sample to it"
+    echo "              (catalog/catalog_abundance.tsv: gene x sample matrix)."
+    echo "  --catalog-id Minimum identity of a gene to its catalog representative"
+    echo "              (default: 0.95; needs cd-hit-est, otherwise only identical"
+    echo "              genes are merged)."
+    echo
     echo "Other options:"
+    echo "  --compress  Write trimmed reads, genes and DIAMOND tables gzip-compressed"
+    echo "              (multi-threaded with pigz when installed)."
+    echo "  --cache     Reuse the outputs of stages whose inputs, tools and settings"
+    echo "              are unchanged since a previous run (see cache_manifest.tsv)."
+    echo "  --sample    Process only the sample with this name."
+    echo "  --no-heatmap Skip the heatmap generation step."
+    echo "  --telemetry Append the wall/CPU time, memory and I/O of every stage to this"
+    echo "              JSONL file."
     echo "  -h, --help  Display this help message."
 }
 
@@ -51,11 +77,104 @@ log() {
     echo "[${timestamp}] $1" | tee -a "$log_file"
 }
 
+# Stage cache (--cache). stage_cached succeeds when the outputs recorded for a
+# stage can be reused; stage_store records them after a successful run.
+stage_cached() {
+    [ "$use_cache" = true ] && python "$cache_script" check \
+        --cache-dir "${out_dir}/.pgpg_cache" --manifest "${out_dir}/cache_manifest.tsv" "$@"
+}
+
+stage_store() {
+    if [ "$use_cache" = true ]; then
+        python "$cache_script" record \
+            --cache-dir "${out_dir}/.pgpg_cache" --manifest "${out_dir}/cache_manifest.tsv" "$@"
+    fi
+}
+
+# Run a command as stage $1 of sample $2. With --telemetry, its wall and CPU
+# time, peak memory, bytes read/written and exit status are appended to the
+# telemetry file.
+run_stage() {
+    local stage=$1 sample=$2
+    shift 2
+    if [ -n "$telemetry_file" ]; then
+        python "$telemetry_script" run -f "$telemetry_file" --stage "$stage" --sample "$sample" \
+            --threads "$threads" -- "$@"
+    else
+        "$@"
+    fi
+}
+
+# Run DIAMOND blastp on $1 into $2; $3 names the sample in the telemetry.
+# Outputs named .gz or .zst are compressed as DIAMOND writes them.
+run_diamond() {
+    case "$2" in
+        *.gz|*.zst)
+            ( set -o pipefail
+              run_diamond "$1" /dev/stdout "$3" | python "$compress_script" compress -o "$2" -t "$threads" )
+            return ;;
+    esac
+    run_stage diamond "$3" diamond blastp -d "$diamond_db" \
+        -q "$1" \
+        -o "$2" \
+        -p "$threads" -k 1 -e "$evalue" \
+        --id "$min_identity" \
+        --query-cover "$min_query_cover" \
+        $( [ -n "$min_score" ] && echo "--min-score $min_score" ) \
+        $( [ -n "$diamond_mode" ] && echo "--mode $diamond_mode" ) \
+        $diamond_extra
+}
+
+# Set the read files of the sample whose first read file is $1
+set_reads() {
+    read_file_1="$1"
+    read_file_2="${1/_1./_2.}"
+    if [ -f "$read_file_2" ]; then
+        read_files=("$read_file_1" "$read_file_2")
+        bowtie2_reads=(-1 "$read_file_1" -2 "$read_file_2")
+        kmer_reads=(-1 "$read_file_1" -2 "$read_file_2")
+    else
+        read_files=("$read_file_1")
+        bowtie2_reads=(-U "$read_file_1")
+        kmer_reads=(-1 "$read_file_1")
+    fi
+}
+
+# Map the reads of sample $1 (set_reads) to the Bowtie2 index $2 and write
+# ${out_dir}/$1.abundance, or ${out_dir}/$1.pileup with BBMap (its abundances
+# are computed by the post-processing). With --coverage kmer, reads are matched
+# by k-mers to the genes of $3 that have a DIAMOND hit in $4 instead. Returns
+# non-zero if a step failed.
+gene_coverage() {
+    local sample=$1 index=$2 genes=$3 hits=$4
+    if [ "$coverage_mode" = "kmer" ]; then
+        log "Matching reads to annotated genes by k-mers"
+        run_stage kmer_quant "$sample" python "$script_dir/vis-scripts/kmer_quant.py" \
+            -g "$genes" -d "$hits" "${kmer_reads[@]}" \
+            -b "$sample" -o "$out_dir" -m "$abund_mode" -t "$threads"
+    elif [ "$coverage_mode" = "stream" ]; then
+        # Alignments are consumed as bowtie2 writes them: no SAM or pileup on disk
+        log "Mapping reads back to genes and calculating coverage"
+        ( set -o pipefail
+          run_stage bowtie2 "$sample" bowtie2 -x "$index" "${bowtie2_reads[@]}" -p "$threads" --no-unal \
+              | run_stage coverage "$sample" python "$script_dir/vis-scripts/sam_coverage.py" \
+                  -b "$sample" -o "$out_dir" -m "$abund_mode" )
+    else
+        log "Mapping reads back to genes"
+        run_stage bowtie2 "$sample" bowtie2 -x "$index" \
+            "${bowtie2_reads[@]}" \
+            -S "${out_dir}/${sample}.sam" -p "$threads"
+
+        log "Calculating coverage"
+        run_stage pileup "$sample" pileup.sh usejni=t in="${out_dir}/${sample}.sam" out="${out_dir}/${sample}.pileup"
+    fi
+}
+
 ###############################################################################
 # Argument parsing
 ###############################################################################
 
-ARGS=$(getopt -o i:o:t:a:h --long piden:,qcov:,extra:,bitscore:,evalue:,dmode:,help -n "$0" -- "$@")
+ARGS=$(getopt -o i:o:t:a:h --long piden:,qcov:,extra:,bitscore:,evalue:,dmode:,sample:,genes:,telemetry:,catalog,catalog-id:,no-heatmap,cache,compress,abund-mode:,coverage:,help -n "$0" -- "$@")
 if [ $? -ne 0 ]; then
     display_help
     exit 1
@@ -69,6 +188,16 @@ diamond_extra=""
 min_score=""
 evalue="1e-5"
 diamond_mode=""
+only_sample=""
+genes_dir=""
+telemetry_file=""
+catalog=false
+catalog_identity=0.95
+skip_heatmap=false
+use_cache=false
+compress=false
+abund_mode="cpm"
+coverage_mode=""
 
 # Parse arguments
 while true; do
@@ -77,12 +206,22 @@ while true; do
         -o) out_dir=$2; shift 2 ;;
         -t) threads=$2; shift 2 ;;
         -a) assembly_dir=$2; shift 2 ;;
+        --genes) genes_dir=$2; shift 2 ;;
         --piden) min_identity=$2; shift 2 ;;
         --qcov) min_query_cover=$2; shift 2 ;;
         --extra) diamond_extra=$2; shift 2 ;;
         --bitscore) min_score=$2; shift 2 ;;
         --evalue) evalue=$2; shift 2 ;;
         --dmode) diamond_mode=$2; shift 2 ;;
+        --sample) only_sample=$2; shift 2 ;;
+        --telemetry) telemetry_file=$2; shift 2 ;;
+        --catalog) catalog=true; shift ;;
+        --catalog-id) catalog_identity=$2; shift 2 ;;
+        --no-heatmap) skip_heatmap=true; shift ;;
+        --cache) use_cache=true; shift ;;
+        --compress) compress=true; shift ;;
+        --abund-mode) abund_mode=$2; shift 2 ;;
+        --coverage) coverage_mode=$2; shift 2 ;;
         -h|--help) display_help; exit 0 ;;
         --) shift; break ;;
         *) display_help; exit 1 ;;
@@ -111,92 +250,296 @@ if [ ! -f "$diamond_db" ]; then
     exit 1
 fi
 
+cache_script="$script_dir/vis-scripts/stage_cache.py"
+telemetry_script="$script_dir/vis-scripts/telemetry.py"
+shard_prodigal_script="$script_dir/vis-scripts/shard_prodigal.py"
+catalog_script="$script_dir/vis-scripts/gene_catalog.py"
+compress_script="$script_dir/vis-scripts/compressed_io.py"
+postprocess_script="$script_dir/vis-scripts/postprocess.py"
+diamond_params="blastp -k 1 -e $evalue --id $min_identity --query-cover $min_query_cover --min-score $min_score --mode $diamond_mode $diamond_extra"
+
+if [ -z "$coverage_mode" ]; then
+    if command -v pileup.sh > /dev/null 2>&1; then
+        coverage_mode="pileup"
+    else
+        coverage_mode="stream"
+    fi
+fi
+# Per-sample output of the coverage stage: pileups are turned into abundances
+# by the post-processing
+coverage_suffix="abundance"
+if [ "$coverage_mode" = "pileup" ]; then
+    coverage_suffix="pileup"
+    coverage_tools=(bowtie2 bowtie2-build pileup.sh)
+elif [ "$coverage_mode" = "kmer" ]; then
+    coverage_tools=()
+else
+    coverage_tools=(bowtie2 bowtie2-build)
+fi
+
+# Suffix of the trimmed reads, genes and DIAMOND tables (--compress). Trimmomatic,
+# MEGAHIT, DIAMOND and Bowtie2 read gzip files directly; genes from --genes are
+# linked as they are.
+ext=""
+if [ "$compress" = true ]; then
+    ext=".gz"
+fi
+gene_ext=$ext
+if [ -n "$genes_dir" ]; then
+    gene_ext=""
+fi
+
+# Merged table is rebuilt on every run, by the post-processing of the samples
+# listed in the manifest (coverage and DIAMOND hits of every sample)
+rm -f "${out_dir}/diamond_merged.txt"
+postprocess_manifest="${out_dir}/postprocess_samples.tsv"
+printf 'Sample\tCoverage\tHits\n' > "$postprocess_manifest"
+
 ###############################################################################
 # Main loop
 ###############################################################################
 
+# Samples and first read files collected for the gene catalog (--catalog)
+catalog_samples=()
+catalog_reads=()
+
 for reads_1 in "$reads_dir"/*_*1.*; do
     sample=$(basename "$reads_1")
     sample=${sample%_1.*}
+    if [ "$sample" = "$(basename "$reads_1")" ]; then
+        log "Warning: skipping ${reads_1}: first read files must be named <sample>_1.<extension>"
+        continue
+    fi
+    if [ -n "$only_sample" ] && [ "$sample" != "$only_sample" ]; then
+        continue
+    fi
+    if [ "$catalog" = true ] && [[ "$sample" == *"|"* ]]; then
+        # gene_catalog.py tags the pooled genes with "<sample>|"
+        log "Error: ${reads_1}: sample names cannot contain '|' with --catalog, rename the file"
+        exit 1
+    fi
     log "Processing sample ${sample}"
 
-    read_file_1="$reads_1"
-    read_file_2="${reads_1/_1./_2.}"
+    set_reads "$reads_1"
+    trimmed_1="${out_dir}/${sample}_trimmed_1.fq${ext}"
+    trimmed_2="${out_dir}/${sample}_trimmed_2.fq${ext}"
+    trimmed_se="${out_dir}/${sample}_trimmed_se.fq${ext}"
+    proteins_file="${out_dir}/${sample}_proteins.faa${gene_ext}"
+    genes_file="${out_dir}/${sample}_nucleotide.ffn${gene_ext}"
+    hits_file="${out_dir}/${sample}_diamond.txt${ext}"
 
-    trimmed_1="${out_dir}/${sample}_trimmed_1.fq"
-    trimmed_2="${out_dir}/${sample}_trimmed_2.fq"
-    trimmed_se="${out_dir}/${sample}_trimmed_se.fq"
-
-    log "Running Trimmomatic"
     if [ -f "$read_file_2" ]; then
-        trimmomatic PE -threads "$threads" \
-            "$read_file_1" "$read_file_2" \
-            "$trimmed_1" "$trimmed_se" \
-            "$trimmed_2" "$trimmed_se" \
-            SLIDINGWINDOW:4:20 MINLEN:36
+        trim_outputs=("$trimmed_1" "$trimmed_2")
+    else
+        trim_outputs=("$trimmed_1")
+    fi
+
+    trim_stage=(--stage trimmomatic --sample "$sample" --inputs "${read_files[@]}"
+                --outputs "${trim_outputs[@]}" --tools trimmomatic --params "SLIDINGWINDOW:4:20 MINLEN:36")
+    if stage_cached "${trim_stage[@]}"; then
+        log "Reusing cached trimmed reads"
     else
-        trimmomatic SE -threads "$threads" \
-            "$read_file_1" "$trimmed_1" \
-            SLIDINGWINDOW:4:20 MINLEN:36
+        log "Running Trimmomatic"
+        if [ -f "$read_file_2" ]; then
+            run_stage trimmomatic "$sample" trimmomatic PE -threads "$threads" \
+                "$read_file_1" "$read_file_2" \
+                "$trimmed_1" "$trimmed_se" \
+                "$trimmed_2" "$trimmed_se" \
+                SLIDINGWINDOW:4:20 MINLEN:36
+        else
+            run_stage trimmomatic "$sample" trimmomatic SE -threads "$threads" \
+                "$read_file_1" "$trimmed_1" \
+                SLIDINGWINDOW:4:20 MINLEN:36
+        fi
+        [ $? -eq 0 ] && stage_store "${trim_stage[@]}"
     fi
 
-    if [ -z "$assembly_dir" ]; then
-        log "Assembling metagenome with MEGAHIT"
-        megahit -1 "$trimmed_1" -2 "$trimmed_2" -t "$threads" -o "${out_dir}/${sample}_assembly"
+    if [ -n "$genes_dir" ]; then
+        # Genes are provided: the assembly is not needed
+        assembly=""
+    elif [ -z "$assembly_dir" ]; then
         assembly="${out_dir}/${sample}_assembly/final.contigs.fa"
+        megahit_stage=(--stage megahit --sample "$sample" --inputs "${trim_outputs[@]}"
+                       --outputs "$assembly" --tools megahit)
+        if stage_cached "${megahit_stage[@]}"; then
+            log "Reusing cached MEGAHIT assembly"
+        else
+            log "Assembling metagenome with MEGAHIT"
+            rm -rf "${out_dir}/${sample}_assembly"
+            run_stage megahit "$sample" megahit -1 "$trimmed_1" -2 "$trimmed_2" -t "$threads" -o "${out_dir}/${sample}_assembly"
+            [ $? -eq 0 ] && stage_store "${megahit_stage[@]}"
+        fi
     else
         log "Using provided assembly"
         assembly=$(ls "${assembly_dir}/${sample}".*)
     fi
 
-    log "Running Prodigal"
-    prodigal -i "$assembly" -q -a "${out_dir}/${sample}_proteins.faa" \
-             -o "${out_dir}/${sample}_genes.gbk" \
-             -d "${out_dir}/${sample}_nucleotide.ffn" -p meta
+    prodigal_stage=(--stage prodigal --sample "$sample" --inputs "$assembly"
+                    --outputs "$proteins_file" "${out_dir}/${sample}_genes.gbk${ext}" "$genes_file"
+                    --tools prodigal --params "-p meta")
+    if [ -n "$genes_dir" ]; then
+        log "Using provided genes"
+        for suffix in faa ffn; do
+            if [ ! -f "${genes_dir}/${sample}.${suffix}" ]; then
+                log "Error: ${genes_dir}/${sample}.${suffix} not found."
+                exit 1
+            fi
+        done
+        ln -sf "$(readlink -f "${genes_dir}/${sample}.faa")" "$proteins_file"
+        ln -sf "$(readlink -f "${genes_dir}/${sample}.ffn")" "$genes_file"
+    elif stage_cached "${prodigal_stage[@]}"; then
+        log "Reusing cached Prodigal genes"
+    else
+        # Contigs are split into shards and Prodigal runs on all threads
+        log "Running Prodigal"
+        run_stage prodigal "$sample" python "$shard_prodigal_script" -i "$assembly" \
+                 -a "$proteins_file" \
+                 -o "${out_dir}/${sample}_genes.gbk${ext}" \
+                 -d "$genes_file" -p meta -t "$threads"
+        [ $? -eq 0 ] && stage_store "${prodigal_stage[@]}"
+    fi
 
-    log "Running DIAMOND"
-    diamond blastp -d "$diamond_db" \
-        -q "${out_dir}/${sample}_proteins.faa" \
-        -o "${out_dir}/${sample}_diamond.txt" \
-        -p "$threads" -k 1 -e "$evalue" \
-        --id "$min_identity" \
-        --query-cover "$min_query_cover" \
-        $( [ -n "$min_score" ] && echo "--min-score $min_score" ) \
-        $( [ -n "$diamond_mode" ] && echo "--mode $diamond_mode" ) \
-        $diamond_extra
+    if [ "$catalog" = true ]; then
+        # Annotation and mapping run once on the catalog of all samples
+        catalog_samples+=("$sample")
+        catalog_reads+=("$reads_1")
+        continue
+    fi
 
-    log "Building Bowtie2 index"
-    bowtie2-build "${out_dir}/${sample}_nucleotide.ffn" "${out_dir}/${sample}_bt2"
+    diamond_stage=(--stage diamond --sample "$sample" --inputs "$proteins_file" --outputs "$hits_file"
+                   --tools diamond --db "$diamond_db" --params "$diamond_params")
+    if stage_cached "${diamond_stage[@]}"; then
+        log "Reusing cached DIAMOND hits"
+    else
+        log "Running DIAMOND"
+        run_diamond "$proteins_file" "$hits_file" "$sample" && stage_store "${diamond_stage[@]}"
+    fi
 
-    log "Mapping reads back to genes"
-    bowtie2 -x "${out_dir}/${sample}_bt2" \
-        -1 "$read_file_1" -2 "$read_file_2" \
-        -S "${out_dir}/${sample}.sam" -p "$threads"
+    coverage_inputs=("$genes_file" "${read_files[@]}")
+    [ "$coverage_mode" = "kmer" ] && coverage_inputs+=("$hits_file")
+    coverage_stage=(--stage coverage --sample "$sample"
+                    --inputs "${coverage_inputs[@]}"
+                    --outputs "${out_dir}/${sample}.${coverage_suffix}"
+                    --tools "${coverage_tools[@]}" --params "$coverage_mode $abund_mode")
+    if stage_cached "${coverage_stage[@]}"; then
+        log "Reusing cached gene abundances"
+    else
+        if [ "$coverage_mode" != "kmer" ]; then
+            log "Building Bowtie2 index"
+            run_stage bowtie2_build "$sample" bowtie2-build "$genes_file" "${out_dir}/${sample}_bt2"
+        fi
+        gene_coverage "$sample" "${out_dir}/${sample}_bt2" \
+            "$genes_file" "$hits_file" \
+            && stage_store "${coverage_stage[@]}"
+    fi
 
-    log "Calculating coverage"
-    pileup.sh usejni=t in="${out_dir}/${sample}.sam" out="${out_dir}/${sample}.pileup"
+    printf '%s\t%s\t%s\n' "$sample" "${out_dir}/${sample}.${coverage_suffix}" "$hits_file" >> "$postprocess_manifest"
 
-    python "$script_dir/vis-scripts/gene_relative_abundance.py" \
-        -p "${out_dir}/${sample}.pileup" -b "$sample" -o "$out_dir"
+    log "Cleaning temporary files"
+    rm -f "${out_dir}/${sample}.sam"
+done
 
-    python "$script_dir/vis-scripts/merge_blastp.py" \
-        -b "${out_dir}/${sample}_diamond.txt" \
-        -o "${out_dir}/${sample}_diamond_table.txt"
+###############################################################################
+# Gene catalog (--catalog)
+###############################################################################
 
-    python "$script_dir/vis-scripts/merge_abund_blastp.py" \
-        -a "${out_dir}/${sample}.abundance" \
-        -b "${out_dir}/${sample}_diamond_table.txt" \
-        -o "${out_dir}/diamond_merged.txt"
+if [ "$catalog" = true ] && [ ${#catalog_samples[@]} -gt 0 ]; then
+    catalog_dir="${out_dir}/catalog"
+    catalog_genes=()
+    catalog_proteins=()
+    for sample in "${catalog_samples[@]}"; do
+        catalog_genes+=("${out_dir}/${sample}_nucleotide.ffn${gene_ext}")
+        catalog_proteins+=("${out_dir}/${sample}_proteins.faa${gene_ext}")
+    done
 
-    log "Cleaning temporary files"
-    rm -f "${out_dir}/${sample}.sam" "${out_dir}/${sample}.pileup" \
-          "${out_dir}/${sample}_diamond_table.txt"
-done
+    catalog_stage=(--stage catalog --sample all --inputs "${catalog_genes[@]}" "${catalog_proteins[@]}"
+                   --outputs "${catalog_dir}/catalog.ffn" "${catalog_dir}/catalog.faa" "${catalog_dir}/clusters.tsv"
+                   --tools cd-hit-est --params "${catalog_samples[*]} $catalog_identity")
+    if stage_cached "${catalog_stage[@]}"; then
+        log "Reusing cached gene catalog"
+    else
+        log "Building the gene catalog of ${#catalog_samples[@]} samples"
+        run_stage catalog all python "$catalog_script" build \
+            -g "${catalog_genes[@]}" -p "${catalog_proteins[@]}" -s "${catalog_samples[@]}" \
+            -o "$catalog_dir" -c "$catalog_identity" -t "$threads" 2>&1 | tee -a "$log_file"
+        if [ "${PIPESTATUS[0]}" -ne 0 ]; then
+            log "Error: gene catalog construction failed."
+            exit 1
+        fi
+        stage_store "${catalog_stage[@]}"
+    fi
+
+    catalog_hits="${catalog_dir}/catalog_diamond.txt${ext}"
+    diamond_stage=(--stage diamond --sample catalog --inputs "${catalog_dir}/catalog.faa" --outputs "$catalog_hits"
+                   --tools diamond --db "$diamond_db" --params "$diamond_params")
+    if stage_cached "${diamond_stage[@]}"; then
+        log "Reusing cached DIAMOND hits of the catalog"
+    else
+        log "Running DIAMOND on the gene catalog"
+        run_diamond "${catalog_dir}/catalog.faa" "$catalog_hits" catalog && stage_store "${diamond_stage[@]}"
+    fi
 
-log "Generating heatmaps"
-python "$script_dir/vis-scripts/heatmap_plabase.py" \
-    "${out_dir}/diamond_merged.txt" "$out_dir" \
-    "$script_dir/database/pathways_plabase.txt" \
-    "$script_dir/database/summary.txt"
+    if [ "$coverage_mode" != "kmer" ]; then
+        log "Building Bowtie2 index of the gene catalog"
+        run_stage bowtie2_build catalog bowtie2-build "${catalog_dir}/catalog.ffn" "${catalog_dir}/catalog_bt2"
+    fi
+
+    catalog_abundances=()
+    for i in "${!catalog_samples[@]}"; do
+        sample=${catalog_samples[$i]}
+        set_reads "${catalog_reads[$i]}"
+        log "Processing sample ${sample} against the gene catalog"
+
+        coverage_inputs=("${catalog_dir}/catalog.ffn" "${read_files[@]}")
+        [ "$coverage_mode" = "kmer" ] && coverage_inputs+=("$catalog_hits")
+        coverage_stage=(--stage coverage --sample "$sample"
+                        --inputs "${coverage_inputs[@]}"
+                        --outputs "${out_dir}/${sample}.${coverage_suffix}"
+                        --tools "${coverage_tools[@]}" --params "catalog $coverage_mode $abund_mode")
+        if stage_cached "${coverage_stage[@]}"; then
+            log "Reusing cached gene abundances"
+        else
+            gene_coverage "$sample" "${catalog_dir}/catalog_bt2" \
+                "${catalog_dir}/catalog.ffn" "$catalog_hits" \
+                && stage_store "${coverage_stage[@]}"
+        fi
+        catalog_abundances+=("${out_dir}/${sample}.abundance")
+
+        printf '%s\t%s\t%s\n' "$sample" "${out_dir}/${sample}.${coverage_suffix}" "$catalog_hits" \
+            >> "$postprocess_manifest"
+        rm -f "${out_dir}/${sample}.sam"
+    done
+fi
+
+###############################################################################
+# Post-processing: abundances, merged table, tables and heatmaps of all samples
+# in one Python process
+###############################################################################
+
+plabase_tables=()
+if [ "$skip_heatmap" != true ]; then
+    log "Merging abundances with DIAMOND hits and generating heatmaps"
+    plabase_tables=(-p "$script_dir/database/pathways_plabase.txt" -S "$script_dir/database/summary.txt"
+                    -d "$out_dir" -j "$threads")
+else
+    log "Merging abundances with DIAMOND hits"
+fi
+run_stage postprocess all python "$postprocess_script" -m "$postprocess_manifest" \
+    -o "${out_dir}/diamond_merged.txt" -a "$abund_mode" "${plabase_tables[@]}" 2>&1 | tee -a "$log_file"
+if [ "${PIPESTATUS[0]}" -ne 0 ]; then
+    log "Error: post-processing failed."
+    exit 1
+fi
+# Pileups are only kept for the stage cache
+if [ "$coverage_mode" = "pileup" ] && [ "$use_cache" != true ]; then
+    cut -f 2 "$postprocess_manifest" | tail -n +2 | while read -r pileup; do rm -f "$pileup"; done
+fi
+
+if [ "$catalog" = true ] && [ ${#catalog_samples[@]} -gt 0 ]; then
+    log "Writing the gene x sample abundance matrix"
+    run_stage catalog_matrix all python "$catalog_script" matrix \
+        -a "${catalog_abundances[@]}" -s "${catalog_samples[@]}" \
+        -o "${catalog_dir}/catalog_abundance.tsv"
+fi
 
 log "meta_wf completed successfully"
@@ -21,6 +21,19 @@ display_help() {
     echo "  --bitscore  Minimum bit score to report alignments."
     echo "  --evalue    Maximum e-value to report alignments (default: 1e-5)."
     echo "  --dmode     DIAMOND mode for sequence search (e.g., fast, sensitive, very-sensitive)."
+    echo "  --stream    Count DIAMOND hits straight from its output stream (no _diamond.txt files)."
+    echo "  --pe-stream Trim into FIFOs and stream both mates and singletons into one DIAMOND"
+    echo "              run (no trimmed FASTQ on disk); each read pair is counted once."
+    echo "  --cache     Reuse Trimmomatic and DIAMOND outputs of a previous run when inputs and settings are unchanged."
+    echo "  --sample    Process only the metagenome with this sample name."
+    echo "  --no-heatmap Skip the heatmap generation step."
+    echo "  --telemetry Append the wall/CPU time, memory and I/O of every stage to this JSONL file."
+    echo "  --compress  Write trimmed reads and DIAMOND tables gzip-compressed (pigz when installed)."
+    echo "  --dedup     Search identical reads once and count their hits for every copy."
+    echo "  --adaptive  Search growing random chunks of reads and stop once the Lv3 profile converges;"
+    echo "              the reads used are recorded in adaptive_screen.tsv."
+    echo "  --adaptive-chunk     Reads of the first chunk (default: 100000)."
+    echo "  --adaptive-threshold Bray-Curtis dissimilarity of successive profiles to stop at (default: 0.02)."
     echo "  -h          Display this help message."
 }
 
@@ -30,8 +43,159 @@ log() {
     echo "[${timestamp}] $1" | tee -a "$log_file"
 }
 
+# Stage cache (--cache). stage_cached succeeds when the outputs recorded for a
+# stage can be reused; stage_store records them after a successful run.
+stage_cached() {
+    [ "$use_cache" = true ] && python "$cache_script" check \
+        --cache-dir "${out_dir}/.pgpg_cache" --manifest "${out_dir}/cache_manifest.tsv" "$@"
+}
+
+stage_store() {
+    if [ "$use_cache" = true ]; then
+        python "$cache_script" record \
+            --cache-dir "${out_dir}/.pgpg_cache" --manifest "${out_dir}/cache_manifest.tsv" "$@"
+    fi
+}
+
+# Run a command as stage $1 of sample $2. With --telemetry, its wall and CPU
+# time, peak memory, bytes read/written and exit status are appended to the
+# telemetry file.
+run_stage() {
+    local stage=$1 sample=$2
+    shift 2
+    if [ -n "$telemetry_file" ]; then
+        python "$telemetry_script" run -f "$telemetry_file" --stage "$stage" --sample "$sample" \
+            --threads "$threads" -- "$@"
+    else
+        "$@"
+    fi
+}
+
+# Run DIAMOND blastx on a read file ($1) and count the hits of sample $3 into
+# the gene counts table. With --stream the hits are read from DIAMOND's stdout
+# and $2 is never written. With --dedup only distinct reads are searched and
+# their hits are counted for every copy.
+search_and_count() {
+    local query=$1 hits=$2 sample=$3
+    local count_args=(-s "$sample") unique multiplicity started status=0
+    if [ "$dedup" = true ]; then
+        unique="${out_dir}/${sample}_unique.fa"
+        multiplicity="${out_dir}/${sample}_multiplicity.tsv"
+        run_stage dedup "$sample" python "$dedup_script" dedup -i "$query" -o "$unique" -m "$multiplicity" \
+            -s "$sample" || return 1
+        query=$unique
+        count_args+=(--multiplicity "$multiplicity")
+        started=$(date +%s.%N)
+    fi
+    if [ "$stream_hits" = true ]; then
+        ( set -o pipefail
+          run_diamond "$query" /dev/stdout "$sample" \
+              | run_stage count_hits "$sample" python "$count_script" "${count_args[@]}" -o "$gene_counts_file" ) \
+            || status=1
+    else
+        local stage=(--stage diamond --sample "$sample" --inputs "$query" --outputs "$hits"
+                     --tools diamond --db "$diamond_db" --params "$diamond_params")
+        if stage_cached "${stage[@]}"; then
+            log "Reusing cached DIAMOND hits in ${hits}"
+        elif run_diamond "$query" "$hits" "$sample"; then
+            stage_store "${stage[@]}"
+        else
+            status=1
+        fi
+        [ "$status" -eq 0 ] && { run_stage count_hits "$sample" python "$count_script" -i "$hits" \
+            "${count_args[@]}" -o "$gene_counts_file" || status=1; }
+    fi
+    if [ "$dedup" = true ]; then
+        [ "$status" -eq 0 ] && python "$dedup_script" report -m "$multiplicity" -n "$sample" \
+            --seconds "$(awk -v start="$started" -v end="$(date +%s.%N)" 'BEGIN { print end - start }')" \
+            -o "${out_dir}/dedup_report.tsv" 2>&1 | tee -a "$log_file"
+        rm -f "$unique"
+    fi
+    return $status
+}
+
+# Trim the reads of sample $1 into FIFOs and stream both mates and the
+# singletons into a single DIAMOND process. Hits are collapsed so that each
+# read pair counts once. No trimmed FASTQ file is written to disk.
+search_fragments() {
+    local sample=$1 read_1=$2 read_2=$3
+    local fifo_dir hits_out=/dev/null reads trim_pid hits_pid="" status
+    fifo_dir=$(mktemp -d "${out_dir}/${sample}_fifo.XXXXXX")
+    if [ "$stream_hits" != true ] && [ "$compress" = true ]; then
+        # The hits are compressed from a FIFO while DIAMOND runs
+        mkfifo "$fifo_dir/hits"
+        python "$compress_script" compress -o "${out_dir}/${sample}_diamond.txt.gz" -t "$threads" < "$fifo_dir/hits" &
+        hits_pid=$!
+        hits_out="$fifo_dir/hits"
+    elif [ "$stream_hits" != true ]; then
+        hits_out="${out_dir}/${sample}_diamond.txt"
+    fi
+
+    if [ -f "$read_2" ]; then
+        mkfifo "$fifo_dir/paired_1" "$fifo_dir/single_1" "$fifo_dir/paired_2" "$fifo_dir/single_2"
+        run_stage trimmomatic "$sample" trimmomatic PE -threads "$threads" "$read_1" "$read_2" \
+            "$fifo_dir/paired_1" "$fifo_dir/single_1" "$fifo_dir/paired_2" "$fifo_dir/single_2" \
+            SLIDINGWINDOW:4:20 MINLEN:36 &
+        reads=(-1 "$fifo_dir/paired_1" -2 "$fifo_dir/paired_2" -s "$fifo_dir/single_1" "$fifo_dir/single_2")
+    else
+        mkfifo "$fifo_dir/single_1"
+        run_stage trimmomatic "$sample" trimmomatic SE -threads "$threads" "$read_1" "$fifo_dir/single_1" \
+            SLIDINGWINDOW:4:20 MINLEN:36 &
+        reads=(-s "$fifo_dir/single_1")
+    fi
+    trim_pid=$!
+
+    ( set -o pipefail
+      run_stage stream_reads "$sample" python "$stream_script" "${reads[@]}" \
+          | run_diamond - /dev/stdout "$sample" \
+          | tee "$hits_out" \
+          | run_stage count_hits "$sample" python "$count_script" -s "$sample" --pairs -o "$gene_counts_file" )
+    status=$?
+    wait "$trim_pid" || status=1
+    if [ -n "$hits_pid" ]; then
+        wait "$hits_pid" || status=1
+    fi
+    rm -rf "$fifo_dir"
+    return $status
+}
+
+# Run DIAMOND blastx on $1 into $2; a query of '-' reads the sequences from
+# stdin. $3 names the sample in the telemetry. Outputs named .gz or .zst are
+# compressed as DIAMOND writes them.
+run_diamond() {
+    case "$2" in
+        *.gz|*.zst)
+            ( set -o pipefail
+              run_diamond "$1" /dev/stdout "$3" | python "$compress_script" compress -o "$2" -t "$threads" )
+            return ;;
+    esac
+    local query=()
+    if [ "$1" != "-" ]; then
+        query=(-q "$1")
+    fi
+    run_stage diamond "$3" "${diamond_command[@]}" "${query[@]}" -o "$2"
+}
+
+# Search growing random chunks of the reads of sample $2 ($1) until the PGPT
+# profile converges (--adaptive) and count the hits of the reads used.
+adaptive_search() {
+    local query=$1 sample=$2 screen_args=()
+    if [ "$stream_hits" != true ]; then
+        screen_args=(--hits "${out_dir}/${sample}_diamond.txt${ext}")
+    fi
+    if [ "$compress" = true ]; then
+        # The chunks of reads are written compressed too
+        screen_args+=(--compress)
+    fi
+    run_stage adaptive_screen "$sample" python "$adaptive_script" -i "$query" -s "$sample" -o "$gene_counts_file" \
+        -p "$script_dir/database/pathways_plabase.txt" -S "$script_dir/database/summary.txt" \
+        -c "$adaptive_chunk" -d "$adaptive_threshold" --report "${out_dir}/adaptive_screen.tsv" "${screen_args[@]}" \
+        -- "${diamond_command[@]}" 2>&1 | tee -a "$log_file"
+    return "${PIPESTATUS[0]}"
+}
+
 # Parse long and short options using `getopt`
-ARGS=$(getopt -o i:o:t:h --long piden:,qcov:,extra:,bitscore:,evalue:,dmode:,help -n "$0" -- "$@")
+ARGS=$(getopt -o i:o:t:h --long piden:,qcov:,extra:,bitscore:,evalue:,dmode:,sample:,telemetry:,no-heatmap,stream,cache,pe-stream,compress,dedup,adaptive,adaptive-chunk:,adaptive-threshold:,help -n "$0" -- "$@")
 if [ $? -ne 0 ]; then
     display_help
     exit 1
@@ -45,6 +209,17 @@ diamond_extra=""
 min_score=""
 evalue="1e-5"
 diamond_mode=""
+only_sample=""
+telemetry_file=""
+skip_heatmap=false
+stream_hits=false
+use_cache=false
+pe_stream=false
+compress=false
+dedup=false
+adaptive=false
+adaptive_chunk=100000
+adaptive_threshold=0.02
 
 # Parse options
 while true; do
@@ -58,22 +233,42 @@ while true; do
         --bitscore) min_score=$2; shift 2 ;;
         --evalue) evalue=$2; shift 2 ;;
         --dmode) diamond_mode=$2; shift 2 ;;
+        --sample) only_sample=$2; shift 2 ;;
+        --telemetry) telemetry_file=$2; shift 2 ;;
+        --no-heatmap) skip_heatmap=true; shift ;;
+        --stream) stream_hits=true; shift ;;
+        --cache) use_cache=true; shift ;;
+        --pe-stream) pe_stream=true; shift ;;
+        --compress) compress=true; shift ;;
+        --dedup) dedup=true; shift ;;
+        --adaptive) adaptive=true; shift ;;
+        --adaptive-chunk) adaptive_chunk=$2; shift 2 ;;
+        --adaptive-threshold) adaptive_threshold=$2; shift 2 ;;
         -h|--help) display_help; exit 0 ;;
         --) shift; break ;;
         *) display_help; exit 1 ;;
     esac
 done
 
-# Create log file
-log_file="${out_dir}/log.txt"
-touch "$log_file"
-
 # Validation of required arguments
 if [ -z "$genomes_dir" ] || [ -z "$out_dir" ] || [ -z "$threads" ]; then
-    log "Error: Missing required arguments."
+    echo "Error: Missing required arguments."
     display_help
     exit 1
 fi
+if [ "$adaptive" = true ] && [ "$pe_stream" = true ]; then
+    echo "Error: --adaptive cannot be combined with --pe-stream."
+    exit 1
+fi
+if [ "$dedup" = true ] && { [ "$pe_stream" = true ] || [ "$adaptive" = true ]; }; then
+    echo "Error: --dedup cannot be combined with --pe-stream or --adaptive."
+    exit 1
+fi
+
+# Create output directory and log file
+mkdir -p "$out_dir"
+log_file="${out_dir}/log.txt"
+touch "$log_file"
 
 # Check if DIAMOND database exists
 script_dir=$(dirname "$(dirname "$(readlink -f "$0")")")
@@ -86,52 +281,101 @@ else
     log "DIAMOND database found at $diamond_db"
 fi
 
-# Create output directory if it doesn't exist
-if [ ! -d "$out_dir" ]; then
-    mkdir -p "$out_dir"
-    log "Created output directory: $out_dir"
-fi
-
 # Create a file to store gene counts
 gene_counts_file="${out_dir}/gene_counts.txt"
+count_script="$script_dir/vis-scripts/count_hits.py"
+cache_script="$script_dir/vis-scripts/stage_cache.py"
+telemetry_script="$script_dir/vis-scripts/telemetry.py"
+stream_script="$script_dir/vis-scripts/stream_reads.py"
+compress_script="$script_dir/vis-scripts/compressed_io.py"
+adaptive_script="$script_dir/vis-scripts/adaptive_screen.py"
+dedup_script="$script_dir/vis-scripts/dedup_queries.py"
+diamond_command=(diamond blastx -d "$diamond_db" -k 1 -p "$threads" -e "$evalue"
+                 --id "$min_identity" --query-cover "$min_query_cover")
+if [ -n "$min_score" ]; then
+    diamond_command+=(--min-score "$min_score")
+fi
+diamond_command+=($diamond_mode $diamond_extra)
+diamond_params="blastx -k 1 -e $evalue --id $min_identity --query-cover $min_query_cover --min-score $min_score $diamond_mode $diamond_extra"
 echo -e "Sample\tID\tCount" > "$gene_counts_file"
 log "Created gene counts file: $gene_counts_file"
 
+# Trimmomatic compresses outputs named .gz and DIAMOND reads them as they are
+ext=""
+if [ "$compress" = true ]; then
+    ext=".gz"
+fi
+
 # Loop to iterate over each pair of read files
 for reads_1 in "$genomes_dir"/*_*1.*; do
     sample=$(basename "$reads_1")
     sample=${sample%_1.*}
+    if [ "$sample" = "$(basename "$reads_1")" ]; then
+        log "Warning: skipping ${reads_1}: first read files must be named <sample>_1.<extension>"
+        continue
+    fi
+    if [ -n "$only_sample" ] && [ "$sample" != "$only_sample" ]; then
+        continue
+    fi
     log "Processing sample $sample..."
     
     read_file_1="$reads_1"
     read_file_2="${reads_1/_1./_2.}"
-    trimmed_file_1="${out_dir}/${sample}_trimmed_1.fq"
-    trimmed_file_2="${out_dir}/${sample}_trimmed_2.fq"
-    trimmed_se="${out_dir}/${sample}_trimmed_se.fq"
+    trimmed_file_1="${out_dir}/${sample}_trimmed_1.fq${ext}"
+    trimmed_file_2="${out_dir}/${sample}_trimmed_2.fq${ext}"
+    trimmed_se="${out_dir}/${sample}_trimmed_se.fq${ext}"
+
+    if [ "$pe_stream" = true ]; then
+        log "Running Trimmomatic and DIAMOND on streamed reads for ${sample}"
+        search_fragments "$sample" "$read_file_1" "$read_file_2"
+        if [ $? -ne 0 ]; then
+            log "Error: DIAMOND failed for ${sample}."
+            exit 1
+        fi
+        log "Generated gene counts for sample $sample"
+        continue
+    fi
 
     # Quality trimming with Trimmomatic
-    log "Running Trimmomatic for quality trimming"
     if [ -f "$read_file_2" ]; then
-        # Paired-end reads
-        trimmomatic PE -threads "$threads" "$read_file_1" "$read_file_2" "$trimmed_file_1" "$trimmed_se" "$trimmed_file_2" "$trimmed_se" SLIDINGWINDOW:4:20 MINLEN:36
+        trim_stage=(--stage trimmomatic --sample "$sample" --inputs "$read_file_1" "$read_file_2"
+                    --outputs "$trimmed_file_1" "$trimmed_file_2" --tools trimmomatic --params "PE SLIDINGWINDOW:4:20 MINLEN:36")
+    else
+        trim_stage=(--stage trimmomatic --sample "$sample" --inputs "$read_file_1"
+                    --outputs "$trimmed_file_1" --tools trimmomatic --params "SE SLIDINGWINDOW:4:20 MINLEN:36")
+    fi
+    if stage_cached "${trim_stage[@]}"; then
+        log "Reusing cached trimmed reads for ${sample}"
     else
-        # Single-end reads
-        trimmomatic SE -threads "$threads" "$read_file_1" "$trimmed_file_1" SLIDINGWINDOW:4:20 MINLEN:36
+        log "Running Trimmomatic for quality trimming"
+        if [ -f "$read_file_2" ]; then
+            # Paired-end reads
+            run_stage trimmomatic "$sample" trimmomatic PE -threads "$threads" "$read_file_1" "$read_file_2" "$trimmed_file_1" "$trimmed_se" "$trimmed_file_2" "$trimmed_se" SLIDINGWINDOW:4:20 MINLEN:36
+        else
+            # Single-end reads
+            run_stage trimmomatic "$sample" trimmomatic SE -threads "$threads" "$read_file_1" "$trimmed_file_1" SLIDINGWINDOW:4:20 MINLEN:36
+        fi
+        if [ $? -ne 0 ]; then
+            log "Error: Trimmomatic failed for ${sample}."
+            exit 1
+        fi
+        stage_store "${trim_stage[@]}"
     fi
 
-    # Run DIAMOND
+    if [ "$adaptive" = true ]; then
+        log "Running DIAMOND on growing chunks of reads for ${sample}"
+        adaptive_search "$trimmed_file_1" "$sample"
+        if [ $? -ne 0 ]; then
+            log "Error: DIAMOND failed for ${sample}."
+            exit 1
+        fi
+        log "Generated gene counts for sample $sample"
+        continue
+    fi
+
+    # Run DIAMOND and count the hits
     log "Running DIAMOND for PLaBAse alignment for ${sample}"
-    diamond blastx -d "$diamond_db" \
-        -q "$trimmed_file_1" \
-        -o "${out_dir}/${sample}_diamond.txt" \
-        -k 1 \
-        -p "$threads" \
-        -e "$evalue" \
-        --id "$min_identity" \
-        --query-cover "$min_query_cover" \
-        $( [ -n "$min_score" ] && echo "--min-score $min_score" ) \
-        $diamond_mode \
-        $diamond_extra
+    search_and_count "$trimmed_file_1" "${out_dir}/${sample}_diamond.txt${ext}" "$sample"
 
     if [ $? -ne 0 ]; then
         log "Error: DIAMOND failed for ${sample}."
@@ -139,17 +383,14 @@ for reads_1 in "$genomes_dir"/*_*1.*; do
     else
         log "Completed DIAMOND search for sample $sample"
     fi
-
-    # Parse DIAMOND output and get gene counts
-    awk '{print $2}' "${out_dir}/${sample}_diamond.txt" | sort | uniq -c | while read count id; do
-        echo -e "${sample}\t${id}\t${count}" >> "$gene_counts_file"
-    done
     log "Generated gene counts for sample $sample"
 done
 
 log "Gene search is completed. Check ${gene_counts_file} for the results."
 
 # Python script to generate the heatmaps
-heatmap_script="$script_dir/vis-scripts/heatmap_plabase.py"
-python "$heatmap_script" "$gene_counts_file" "$out_dir" "$script_dir/database/pathways_plabase.txt" "$script_dir/database/summary.txt"
-log "Generated heatmaps"
+if [ "$skip_heatmap" != true ]; then
+    heatmap_script="$script_dir/vis-scripts/heatmap_plabase.py"
+    run_stage heatmap all python "$heatmap_script" "$gene_counts_file" "$out_dir" "$script_dir/database/pathways_plabase.txt" "$script_dir/database/summary.txt" -j "$threads"
+    log "Generated heatmaps"
+fi